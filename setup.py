@@ -11,6 +11,7 @@ requires = [
     'pyramid_beaker',
     'waitress',
     'ldapom',
+    'cffi>=1.0',
 ]
 
 dev_requires = [
@@ -34,6 +35,8 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=requires,
+    setup_requires=['cffi>=1.0'],
+    cffi_modules=['src/esauth/ldap_ext_build.py:ffibuilder'],
     test_suite="nose.collector",
     extras_require={
         'develop': dev_requires,
@@ -44,6 +47,8 @@ setup(
         ],
         'console_scripts': [
             'esauth-make-config = esauth.scripts:generate_prod_config',
+            'esauth-import = esauth.scripts:import_entries',
+            'esauth-export = esauth.scripts:export_entries',
         ]
     },
     classifiers=[
@@ -0,0 +1,91 @@
+import time
+import threading
+import collections
+
+
+class NullCache(object):
+
+    """
+        Cache which stores nothing, used when caching disabled.
+    """
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class LRUCache(object):
+
+    """
+        Thread safe in-memory cache with time to live and least recently used eviction.
+
+        Values must not be modified after set, they are shared between threads.
+        Any object with the same get/set/delete/clear/stats methods may be used
+        as orm.Base._cache instead.
+    """
+
+    def __init__(self, max_size=1000, ttl=30, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Key to (expiration time, value), least recently used first
+        self._items = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._items.pop(key)
+            except KeyError:
+                self._misses += 1
+                return None
+            if expires <= self._clock():
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._items[key] = (expires, value)
+            self._hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (self._clock() + self.ttl, value)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self._evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'size': len(self._items),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+            }
@@ -0,0 +1,832 @@
+import sys
+import copy
+import time
+import Queue
+import inspect
+import logging
+import functools
+import threading
+import ldapom
+from ldapom.cdef import libldap, ffi
+
+MOD_ADD = libldap.LDAP_MOD_ADD
+MOD_DELETE = libldap.LDAP_MOD_DELETE
+MOD_REPLACE = libldap.LDAP_MOD_REPLACE
+
+logger = logging.getLogger(__name__)
+
+_ldap_ext = None
+
+
+def get_ldap_ext():
+    """
+        Return (ffi, lib) of extension module with libldap functions needed
+        for paged results and pipelined writes, built by setup.py (see ldap_ext_build).
+    """
+    global _ldap_ext
+    if _ldap_ext is None:
+        from esauth._ldap_ext import ffi as ext_ffi, lib
+        _ldap_ext = ext_ffi, lib
+    return _ldap_ext
+
+
+def get_ext_handle(ext_ffi, connection):
+    """
+        Cast ldapom connection handle for use with extension functions.
+    """
+    return ext_ffi.cast("LDAP *", int(ffi.cast("uintptr_t", connection._ld)))
+
+
+def mark_broken(connection):
+    """
+        Mark connection proxy (see ThreadLocalConnection), which server went
+        down, so its connection is discarded on release instead of reused.
+    """
+    mark = getattr(connection, 'mark_broken', None)
+    if mark is not None:
+        mark()
+
+
+def discard_on_server_down(function):
+    """
+        Decorator for functions and generators taking connection as first
+        argument, marking connection broken if LDAPServerDownError raised.
+    """
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def wrapper(connection, *args, **kwargs):
+            items = function(connection, *args, **kwargs)
+            try:
+                for item in items:
+                    yield item
+            except ldapom.LDAPServerDownError:
+                mark_broken(connection)
+                raise
+            finally:
+                items.close()
+    else:
+        @functools.wraps(function)
+        def wrapper(connection, *args, **kwargs):
+            try:
+                return function(connection, *args, **kwargs)
+            except ldapom.LDAPServerDownError:
+                mark_broken(connection)
+                raise
+    return wrapper
+
+
+def encode_values(connection, name, values):
+    """
+        Convert python values to wire format using attribute type from server schema.
+    """
+    attribute = connection.get_attribute_type(name)(name)
+    attribute._values = set(values)
+    return list(attribute._get_ldap_values())
+
+
+def build_mods(connection, changes):
+    """
+        Build NULL terminated LDAPMod array for changes, as ldapom.LDAPConnection.save does.
+
+        changes is a list of (operation, attribute name, values) tuples,
+        where operation is one of MOD_ADD, MOD_DELETE or MOD_REPLACE.
+        Returns array and list of allocated memory, which must be kept
+        referenced until request is sent.
+    """
+    prevent_garbage_collection = []
+
+    mods = ffi.new("LDAPMod*[{0}]".format(len(changes) + 1))
+    for i, (operation, name, values) in enumerate(changes):
+        ldap_values = encode_values(connection, name, values)
+
+        mod = ffi.new("LDAPMod *")
+        mod.mod_op = operation | libldap.LDAP_MOD_BVALUES
+        mod_type = ffi.new("char[]", name.encode('utf-8'))
+        mod.mod_type = mod_type
+        prevent_garbage_collection.extend([mod, mod_type])
+
+        bvals = ffi.new("BerValue*[{0}]".format(len(ldap_values) + 1))
+        prevent_garbage_collection.append(bvals)
+        for j, value in enumerate(ldap_values):
+            berval = ffi.new("BerValue *")
+            buf = ffi.new("char[]", len(value))
+            ffi.buffer(buf)[:] = value
+            berval.bv_len = len(value)
+            berval.bv_val = buf
+            bvals[j] = berval
+            prevent_garbage_collection.extend([berval, buf])
+        bvals[len(ldap_values)] = ffi.NULL
+
+        mod.mod_vals = {"modv_bvals": bvals}
+        mods[i] = mod
+    mods[len(changes)] = ffi.NULL
+    return mods, prevent_garbage_collection
+
+
+class EntryAlreadyExists(ldapom.LDAPError):
+    pass
+
+
+@discard_on_server_down
+def add(connection, dn, changes):
+    """
+        Send single add request to server, changes are as for modify().
+
+        Unlike ldapom.LDAPEntry.save, which replaces attributes of entry
+        found on server, raises EntryAlreadyExists if entry exists.
+    """
+    ext_ffi, lib = get_ldap_ext()
+    mods, prevent_garbage_collection = build_mods(connection, changes)
+    err = libldap.ldap_add_ext_s(connection._ld, dn.encode('utf-8'), mods, ffi.NULL, ffi.NULL)
+    if err == lib.LDAP_ALREADY_EXISTS:
+        raise EntryAlreadyExists(_get_error(err))
+    ldapom.connection.handle_ldap_error(err)
+
+
+@discard_on_server_down
+def modify(connection, dn, changes):
+    """
+        Send single modify request to server.
+
+        MOD_DELETE with empty values removes whole attribute.
+        ldapom can only replace attributes, so request built here the same
+        way ldapom.LDAPConnection.save does.
+    """
+    mods, prevent_garbage_collection = build_mods(connection, changes)
+    err = libldap.ldap_modify_ext_s(connection._ld, dn.encode('utf-8'), mods, ffi.NULL, ffi.NULL)
+    ldapom.connection.handle_ldap_error(err)
+
+
+def _get_error(err):
+    try:
+        ldapom.connection.handle_ldap_error(err)
+    except ldapom.LDAPError as e:
+        return e
+
+
+@discard_on_server_down
+def pipeline(connection, operations, window=100):
+    """
+        Send write operations asynchronously, keeping at most window of them in flight.
+
+        operations is an iterable of (key, operation, dn, changes) tuples,
+        where operation is one of 'add', 'modify' or 'delete' and changes
+        is a list as for modify() (ignored for delete). Yields (key, error)
+        tuples as results arrive, error is None on success.
+    """
+    ext_ffi, lib = get_ldap_ext()
+    ld = get_ext_handle(ext_ffi, connection)
+    # Message id to (key, memory referenced by request)
+    in_flight = {}
+
+    def wait_result():
+        while True:
+            result_p = ext_ffi.new("LDAPMessage **")
+            if lib.ldap_result(ld, lib.LDAP_RES_ANY, lib.LDAP_MSG_ALL, ext_ffi.NULL, result_p) == -1:
+                raise ldapom.LDAPServerDownError('Failed to read operation result')
+            msgid = lib.ldap_msgid(result_p[0])
+            err_p = ext_ffi.new("int *")
+            parse_err = lib.ldap_parse_result(
+                ld, result_p[0], err_p, ext_ffi.NULL, ext_ffi.NULL, ext_ffi.NULL, ext_ffi.NULL, 1
+            )
+            # Skip unsolicited notifications
+            if msgid in in_flight:
+                key = in_flight.pop(msgid)[0]
+                return key, _get_error(parse_err) or _get_error(err_p[0])
+
+    for key, operation, dn, changes in operations:
+        while len(in_flight) >= window:
+            yield wait_result()
+
+        msgid_p = ext_ffi.new("int *")
+        dn_p = ext_ffi.new("char[]", dn.encode('utf-8'))
+        prevent_garbage_collection = [dn_p]
+        if operation == 'delete':
+            err = lib.ldap_delete_ext(ld, dn_p, ext_ffi.NULL, ext_ffi.NULL, msgid_p)
+        else:
+            mods, prevent_garbage_collection = build_mods(connection, changes)
+            prevent_garbage_collection.extend([dn_p, mods])
+            ext_mods = ext_ffi.cast("LDAPMod **", int(ffi.cast("uintptr_t", mods)))
+            send = lib.ldap_add_ext if operation == 'add' else lib.ldap_modify_ext
+            err = send(ld, dn_p, ext_mods, ext_ffi.NULL, ext_ffi.NULL, msgid_p)
+
+        if err != lib.LDAP_SUCCESS:
+            yield key, _get_error(err)
+            continue
+        in_flight[msgid_p[0]] = (key, prevent_garbage_collection)
+
+    while in_flight:
+        yield wait_result()
+
+
+def _read_entries(paged_ffi, lib, ld, result):
+    entries = []
+    current_entry = lib.ldap_first_entry(ld, result)
+    while current_entry != paged_ffi.NULL:
+        dn_p = lib.ldap_get_dn(ld, current_entry)
+        dn = paged_ffi.string(dn_p).decode('utf-8')
+        lib.ldap_memfree(dn_p)
+
+        attributes = {}
+        ber_p = paged_ffi.new("BerElement **")
+        current_attribute = lib.ldap_first_attribute(ld, current_entry, ber_p)
+        while current_attribute != paged_ffi.NULL:
+            values_p = lib.ldap_get_values_len(ld, current_entry, current_attribute)
+            attributes[paged_ffi.string(current_attribute).decode('utf-8')] = [
+                paged_ffi.buffer(values_p[i].bv_val, values_p[i].bv_len)[:]
+                for i in range(lib.ldap_count_values_len(values_p))
+            ]
+            lib.ldap_value_free_len(values_p)
+            lib.ldap_memfree(current_attribute)
+            current_attribute = lib.ldap_next_attribute(ld, current_entry, ber_p[0])
+        lib.ber_free(ber_p[0], 0)
+
+        entries.append((dn, attributes))
+        current_entry = lib.ldap_next_entry(ld, current_entry)
+    return entries
+
+
+def _make_attributes(ext_ffi, retrieve_attributes):
+    """
+        Return NULL terminated array of attribute names for search and list
+        of allocated memory, which must be kept referenced until search is done.
+    """
+    prevent_garbage_collection = []
+    attrs_p = ext_ffi.new("char*[{0}]".format(len(retrieve_attributes) + 1))
+    for i, name in enumerate(retrieve_attributes):
+        attr_p = ext_ffi.new("char[]", name.encode('utf-8'))
+        prevent_garbage_collection.append(attr_p)
+        attrs_p[i] = attr_p
+    attrs_p[len(retrieve_attributes)] = ext_ffi.NULL
+    return attrs_p, prevent_garbage_collection
+
+
+def make_entry(connection, dn, attributes, retrieve_attributes=None):
+    """
+        Build ldapom entry from search result, as ldapom.LDAPConnection.search does.
+    """
+    entry = ldapom.LDAPEntry(connection, dn, retrieve_attributes=retrieve_attributes)
+    entry._attributes = set()
+    for name, values in attributes.items():
+        attribute = connection.get_attribute_type(name)(name)
+        attribute._set_ldap_values(values)
+        entry._attributes.add(attribute)
+    entry._fetched_attributes = copy.deepcopy(entry._attributes)
+    return entry
+
+
+@discard_on_server_down
+def paged_search(connection, search_filter, base, scope=ldapom.LDAP_SCOPE_SUBTREE, retrieve_attributes=None,
+                 page_size=500, size_limit=0):
+    """
+        Search with simple paged results control (RFC 2696).
+
+        Results are requested from server page_size entries at a time and
+        yielded as ldapom entries, so only one page is held in memory.
+        If server does not return paged results response control, search
+        stops after first page, as server returned all entries at once.
+        If size_limit set, search stops after that number of entries.
+    """
+    if size_limit:
+        page_size = min(page_size, size_limit)
+    paged_ffi, lib = get_ldap_ext()
+    ld = get_ext_handle(paged_ffi, connection)
+
+    if retrieve_attributes is None:
+        retrieve_attributes = ['*']
+    attrs_p, prevent_garbage_collection = _make_attributes(paged_ffi, retrieve_attributes)
+
+    cookie = paged_ffi.new("struct berval *")
+    try:
+        while True:
+            control_p = paged_ffi.new("LDAPControl **")
+            ldapom.connection.handle_ldap_error(
+                lib.ldap_create_page_control(ld, page_size, cookie, 0, control_p)
+            )
+            server_controls = paged_ffi.new("LDAPControl *[2]", [control_p[0], paged_ffi.NULL])
+            result_p = paged_ffi.new("LDAPMessage **")
+            err = lib.ldap_search_ext_s(
+                ld, base.encode('utf-8'), scope, search_filter.encode('utf-8'), attrs_p, 0,
+                server_controls, paged_ffi.NULL, paged_ffi.NULL, 0, result_p,
+            )
+            lib.ldap_control_free(control_p[0])
+            if err == lib.LDAP_NO_SUCH_OBJECT:
+                lib.ldap_msgfree(result_p[0])
+                return
+            if err != lib.LDAP_SUCCESS:
+                lib.ldap_msgfree(result_p[0])
+                ldapom.connection.handle_ldap_error(err)
+
+            result = result_p[0]
+            has_more = False
+            try:
+                entries = _read_entries(paged_ffi, lib, ld, result)
+                response_controls_p = paged_ffi.new("LDAPControl ***")
+                ldapom.connection.handle_ldap_error(lib.ldap_parse_result(
+                    ld, result, paged_ffi.NULL, paged_ffi.NULL, paged_ffi.NULL, paged_ffi.NULL,
+                    response_controls_p, 0,
+                ))
+                if response_controls_p[0] != paged_ffi.NULL:
+                    control = lib.ldap_control_find(
+                        lib.LDAP_CONTROL_PAGEDRESULTS, response_controls_p[0], paged_ffi.NULL
+                    )
+                    if control != paged_ffi.NULL:
+                        if cookie.bv_val != paged_ffi.NULL:
+                            lib.ber_memfree(cookie.bv_val)
+                            cookie.bv_val = paged_ffi.NULL
+                        count_p = paged_ffi.new("ber_int_t *")
+                        ldapom.connection.handle_ldap_error(
+                            lib.ldap_parse_pageresponse_control(ld, control, count_p, cookie)
+                        )
+                        has_more = cookie.bv_len > 0
+                    lib.ldap_controls_free(response_controls_p[0])
+            finally:
+                lib.ldap_msgfree(result)
+
+            for dn, attributes in entries:
+                yield make_entry(connection, dn, attributes, retrieve_attributes)
+                if size_limit:
+                    size_limit -= 1
+                    if not size_limit:
+                        return
+            if not has_more:
+                return
+    finally:
+        if cookie.bv_val != paged_ffi.NULL:
+            lib.ber_memfree(cookie.bv_val)
+
+
+class SortUnavailable(Exception):
+    pass
+
+
+@discard_on_server_down
+def sorted_search(connection, search_filter, base, sort_key, offset, count, scope=ldapom.LDAP_SCOPE_SUBTREE,
+                  retrieve_attributes=None):
+    """
+        Search with server side sorting (RFC 2891) and virtual list view controls.
+
+        Returns list of count entries starting at 1-based offset in sorted
+        results, and number of all matching entries. sort_key is as for
+        ldap_create_sort_keylist, e.g. '-sn:caseIgnoreOrderingMatch'.
+        Both controls are critical, SortUnavailable raised if server does
+        not support or rejects them (e.g. sssvlv overlay is not loaded).
+    """
+    ext_ffi, lib = get_ldap_ext()
+    ld = get_ext_handle(ext_ffi, connection)
+    rejected = (
+        lib.LDAP_ADMINLIMIT_EXCEEDED, lib.LDAP_UNAVAILABLE_CRITICAL_EXTENSION, lib.LDAP_INAPPROPRIATE_MATCHING,
+        lib.LDAP_SORT_CONTROL_MISSING, lib.LDAP_UNWILLING_TO_PERFORM, lib.LDAP_VLV_ERROR,
+    )
+
+    if retrieve_attributes is None:
+        retrieve_attributes = ['*']
+    attrs_p, prevent_garbage_collection = _make_attributes(ext_ffi, retrieve_attributes)
+
+    keylist_p = ext_ffi.new("LDAPSortKey ***")
+    key_p = ext_ffi.new("char[]", sort_key.encode('utf-8'))
+    ldapom.connection.handle_ldap_error(lib.ldap_create_sort_keylist(keylist_p, key_p))
+    sort_control_p = ext_ffi.new("LDAPControl **")
+    err = lib.ldap_create_sort_control(ld, keylist_p[0], 1, sort_control_p)
+    lib.ldap_free_sort_keylist(keylist_p[0])
+    ldapom.connection.handle_ldap_error(err)
+
+    vlv_info = ext_ffi.new("LDAPVLVInfo *")
+    vlv_info.ldvlv_version = 1
+    vlv_info.ldvlv_before_count = 0
+    vlv_info.ldvlv_after_count = count - 1
+    vlv_info.ldvlv_offset = offset
+    # Zero content count makes offset absolute position
+    vlv_info.ldvlv_count = 0
+    vlv_control_p = ext_ffi.new("LDAPControl **")
+    err = lib.ldap_create_vlv_control(ld, vlv_info, vlv_control_p)
+    if err != lib.LDAP_SUCCESS:
+        lib.ldap_control_free(sort_control_p[0])
+        ldapom.connection.handle_ldap_error(err)
+
+    server_controls = ext_ffi.new("LDAPControl *[3]", [sort_control_p[0], vlv_control_p[0], ext_ffi.NULL])
+    result_p = ext_ffi.new("LDAPMessage **")
+    err = lib.ldap_search_ext_s(
+        ld, base.encode('utf-8'), scope, search_filter.encode('utf-8'), attrs_p, 0,
+        server_controls, ext_ffi.NULL, ext_ffi.NULL, 0, result_p,
+    )
+    lib.ldap_control_free(sort_control_p[0])
+    lib.ldap_control_free(vlv_control_p[0])
+
+    result = result_p[0]
+    try:
+        if err == lib.LDAP_NO_SUCH_OBJECT:
+            return [], 0
+        if err in rejected:
+            raise SortUnavailable(_get_error(err))
+        ldapom.connection.handle_ldap_error(err)
+
+        entries = _read_entries(ext_ffi, lib, ld, result)
+        response_controls_p = ext_ffi.new("LDAPControl ***")
+        ldapom.connection.handle_ldap_error(lib.ldap_parse_result(
+            ld, result, ext_ffi.NULL, ext_ffi.NULL, ext_ffi.NULL, ext_ffi.NULL, response_controls_p, 0,
+        ))
+        if response_controls_p[0] == ext_ffi.NULL:
+            raise SortUnavailable('No virtual list view response control')
+        try:
+            control = lib.ldap_control_find(lib.LDAP_CONTROL_VLVRESPONSE, response_controls_p[0], ext_ffi.NULL)
+            if control == ext_ffi.NULL:
+                raise SortUnavailable('No virtual list view response control')
+            target_p = ext_ffi.new("ber_int_t *")
+            total_p = ext_ffi.new("ber_int_t *")
+            vlv_err_p = ext_ffi.new("int *")
+            ldapom.connection.handle_ldap_error(lib.ldap_parse_vlvresponse_control(
+                ld, control, target_p, total_p, ext_ffi.NULL, vlv_err_p
+            ))
+            if vlv_err_p[0] != lib.LDAP_SUCCESS:
+                raise SortUnavailable(_get_error(vlv_err_p[0]))
+        finally:
+            lib.ldap_controls_free(response_controls_p[0])
+    finally:
+        if result != ext_ffi.NULL:
+            lib.ldap_msgfree(result)
+
+    return [make_entry(connection, dn, attributes, retrieve_attributes) for dn, attributes in entries], total_p[0]
+
+
+def iter_concurrently(functions, buffer_size=1000, cleanup=None, inline=None):
+    """
+        Call functions returning iterables in separate threads and yield
+        their items as they arrive.
+
+        At most buffer_size items are kept in memory, threads wait while
+        consumer is behind. cleanup is called in each thread when it is
+        done, e.g. to release connection checked out by thread. Exception
+        raised in thread is reraised in consumer.
+
+        If inline function given, it is called in consumer thread (so it
+        uses connection of that thread) and its items are yielded first,
+        while threads run.
+    """
+    items = Queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def run(function):
+        try:
+            for item in function():
+                if not put((None, item)):
+                    break
+        except Exception:
+            put((sys.exc_info(), None))
+        finally:
+            if cleanup is not None:
+                cleanup()
+            put((None, done))
+
+    threads = [threading.Thread(target=run, args=(function,)) for function in functions]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        if inline is not None:
+            for item in inline():
+                yield item
+        running = len(threads)
+        while running:
+            exc_info, item = items.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if item is done:
+                running -= 1
+            else:
+                yield item
+    finally:
+        stop.set()
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def check_connection(connection):
+    """
+        Default pool health check: cheap base scope search, requesting no attributes.
+    """
+    try:
+        list(connection.search(base=connection._bind_dn, scope=ldapom.LDAP_SCOPE_BASE, retrieve_attributes=['1.1']))
+    except ldapom.LDAPError:
+        return False
+    return True
+
+
+def close_connection(connection):
+    """
+        Unbind connection and free its libldap handle, ldapom has no method for that.
+        Connection must not be used afterwards.
+    """
+    ext_ffi, lib = get_ldap_ext()
+    lib.ldap_unbind_ext_s(get_ext_handle(ext_ffi, connection), ext_ffi.NULL, ext_ffi.NULL)
+
+
+class ConnectionPool(object):
+
+    """
+        Bounded pool of bound ldapom connections.
+
+        Connections are created lazily by factory, up to size. Connection,
+        which was idle longer than check_interval seconds, is checked with
+        health_check before checkout. Connections older than max_lifetime
+        seconds are closed and replaced. Discarded connections are closed
+        with close function, otherwise their sockets would stay open.
+    """
+
+    def __init__(self, factory, size=10, timeout=30, max_lifetime=3600, check_interval=60,
+                 health_check=check_connection, close=close_connection):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.check_interval = check_interval
+        self.health_check = health_check
+        self.close = close
+
+        self._condition = threading.Condition()
+        # Idle connections as (connection, created, last_used) tuples
+        self._idle = []
+        self._created = {}
+        self._total = 0
+        self._in_use = 0
+        self._stats = {
+            'checkouts': 0,
+            'creations': 0,
+            'discards': 0,
+            'timeouts': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats.update({
+                'size': self.size,
+                'total': self._total,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+            })
+        return stats
+
+    def _forget(self, connection):
+        logger.debug('Discarding LDAP connection %r', connection)
+        with self._condition:
+            self._created.pop(id(connection), None)
+            self._stats['discards'] += 1
+        try:
+            self.close(connection)
+        except Exception:
+            logger.exception('Cannot close LDAP connection %r', connection)
+
+    def _create(self):
+        try:
+            connection = self.factory()
+        except Exception:
+            with self._condition:
+                self._total -= 1
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._created[id(connection)] = time.time()
+            self._stats['creations'] += 1
+        return connection
+
+    def _is_expired(self, connection):
+        return time.time() - self._created.get(id(connection), 0) > self.max_lifetime
+
+    def checkout(self):
+        started = time.time()
+        connection = None
+        with self._condition:
+            while True:
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                    break
+                if self._total < self.size:
+                    self._total += 1
+                    break
+                remaining = self.timeout - (time.time() - started)
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout('No free LDAP connection in {0} seconds'.format(self.timeout))
+                self._condition.wait(remaining)
+
+            waited = time.time() - started
+            self._in_use += 1
+            self._stats['checkouts'] += 1
+            self._stats['wait_time_total'] += waited
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+
+        if connection is not None:
+            healthy = not self._is_expired(connection) and (
+                time.time() - last_used < self.check_interval or self.health_check(connection)
+            )
+            if healthy:
+                return connection
+            # Replace connection, keeping its slot in pool
+            self._forget(connection)
+        return self._create()
+
+    def checkin(self, connection, discard=False):
+        """
+            Return connection to pool. Pass discard=True for broken connection,
+            it is closed and replaced by new one on checkout.
+        """
+        if discard or self._is_expired(connection):
+            self._forget(connection)
+            with self._condition:
+                self._in_use -= 1
+                self._total -= 1
+                self._condition.notify()
+            return
+        with self._condition:
+            self._in_use -= 1
+            self._idle.append((connection, time.time()))
+            self._condition.notify()
+
+
+class ThreadLocalConnection(object):
+
+    """
+        Connection proxy for ORM.
+
+        Attribute access is passed to connection, checked out from pool by
+        current thread on first use. Connection stays checked out by thread
+        until release() called, e.g. at the end of request. Connection
+        marked broken (see mark_broken()) is discarded on release.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._local = threading.local()
+
+    def get_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._pool.checkout()
+        return connection
+
+    def mark_broken(self):
+        self._local.broken = True
+
+    def release(self, discard=False):
+        connection = getattr(self._local, 'connection', None)
+        discard = discard or getattr(self._local, 'broken', False)
+        self._local.broken = False
+        if connection is not None:
+            self._local.connection = None
+            self._pool.checkin(connection, discard=discard)
+
+    def __getattr__(self, name):
+        return getattr(self.get_connection(), name)
+
+
+class RoutingConnection(object):
+
+    """
+        Connection proxy sending reads to consumers and everything else to provider.
+
+        provider and consumers are ThreadLocalConnection instances. Attribute
+        access is passed to provider, so writes and binds go there; ORM reads
+        use connection returned by for_read(). Thread gets next consumer
+        round robin on first read and keeps it until release(). Consumer,
+        which connection could not be checked out or which went down during
+        read (see read_failed()), is skipped for retry_interval seconds;
+        provider is used when no consumer is available.
+
+        After mark_written() reads of current thread go to provider until
+        release(), so request sees its own writes. For sticky_interval
+        seconds after its write later reads of the same thread go to
+        provider too, to let consumers catch up (e.g. page shown after
+        redirect by worker thread which handled form). Writes of other
+        threads do not affect routing.
+    """
+
+    def __init__(self, provider, consumers, retry_interval=30, sticky_interval=0, clock=time.time):
+        self.provider = provider
+        self.consumers = list(consumers)
+        self.retry_interval = retry_interval
+        self.sticky_interval = sticky_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._next = 0
+        # Consumer index to time it was found unavailable
+        self._failed = {}
+        self._stats = {
+            'consumer_reads': 0,
+            'provider_reads': 0,
+            'failovers': 0,
+        }
+
+    def _get_candidates(self):
+        """
+            Return indexes of available consumers, starting from next in turn.
+        """
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.consumers)
+            now = self._clock()
+            order = [(start + i) % len(self.consumers) for i in range(len(self.consumers))]
+            return [
+                index for index in order
+                if index not in self._failed or now - self._failed[index] > self.retry_interval
+            ]
+
+    def _mark_failed(self, index):
+        with self._lock:
+            self._failed[index] = self._clock()
+            self._stats['failovers'] += 1
+
+    def _use_provider(self):
+        if getattr(self._local, 'written', False):
+            return True
+        last_write = getattr(self._local, 'last_write', None)
+        return last_write is not None and self._clock() - last_write < self.sticky_interval
+
+    def for_read(self):
+        if self._use_provider():
+            reader = self.provider
+        else:
+            reader = getattr(self._local, 'reader', None)
+            if reader is None:
+                reader = self._local.reader = self._choose_consumer() or self.provider
+        with self._lock:
+            self._stats['provider_reads' if reader is self.provider else 'consumer_reads'] += 1
+        return reader
+
+    def _choose_consumer(self):
+        if not self.consumers:
+            return
+        for index in self._get_candidates():
+            consumer = self.consumers[index]
+            try:
+                consumer.get_connection()
+            except (ldapom.LDAPError, PoolTimeout) as e:
+                logger.warning('LDAP consumer %s unavailable: %s', index, e)
+                self._mark_failed(index)
+                continue
+            with self._lock:
+                self._failed.pop(index, None)
+            return consumer
+
+    def read_failed(self, reader):
+        """
+            Called when read from reader failed as its server is down.
+            Consumer is skipped from now on and its connection discarded.
+            Returns reader to repeat read with, None if reader is provider.
+        """
+        if reader is self.provider or reader not in self.consumers:
+            return None
+        index = self.consumers.index(reader)
+        logger.warning('LDAP consumer %s went down during read', index)
+        self._mark_failed(index)
+        reader.release(discard=True)
+        self._local.reader = self._choose_consumer() or self.provider
+        return self._local.reader
+
+    def use_reader(self, reader):
+        """
+            Send reads of current thread to reader returned by for_read() in
+            another thread, so threads working on behalf of request (see
+            orm.Base.search_entries) follow its routing, e.g. see its writes.
+        """
+        self._local.reader = reader
+
+    def mark_written(self):
+        self._local.written = True
+        self._local.last_write = self._clock()
+
+    def release(self):
+        self._local.written = False
+        self._local.reader = None
+        self.provider.release()
+        for consumer in self.consumers:
+            consumer.release()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            now = self._clock()
+            stats['unavailable_consumers'] = sorted(
+                index for index, failed in self._failed.items() if now - failed <= self.retry_interval
+            )
+        return stats
+
+    def __getattr__(self, name):
+        return getattr(self.provider, name)
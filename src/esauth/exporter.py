@@ -0,0 +1,103 @@
+import re
+import csv
+import json
+import base64
+import StringIO
+import esauth.orm as orm
+
+# Maximum LDIF line length, longer lines are folded (RFC 2849)
+LDIF_LINE_LENGTH = 76
+
+# Values which may be written to LDIF as is, others are base64 encoded
+LDIF_SAFE_STRING = re.compile(r'^(?:[\x01-\x09\x0b-\x0c\x0e-\x1f\x21-\x39\x3b\x3d-\x7f][\x01-\x09\x0b-\x0c\x0e-\x7f]*)?$')
+
+
+def iter_ndjson(rows, field_names):
+    for row in rows:
+        yield json.dumps(row, sort_keys=True) + '\n'
+
+
+def iter_csv(rows, field_names):
+    def format_row(values):
+        buf = StringIO.StringIO()
+        csv.writer(buf).writerow([
+            value.encode('utf-8') if isinstance(value, unicode) else value for value in values
+        ])
+        return buf.getvalue()
+
+    yield format_row(field_names)
+    for row in rows:
+        yield format_row([
+            ';'.join(unicode(v) for v in row[name]) if isinstance(row[name], list) else row[name]
+            for name in field_names
+        ])
+
+
+def format_ldif_line(name, value):
+    """
+        Return LDIF line for attribute value given as bytes, folded and with trailing newline.
+    """
+    if LDIF_SAFE_STRING.match(value) and not value.endswith(' '):
+        line = '{0}: {1}'.format(name, value)
+    else:
+        line = '{0}:: {1}'.format(name, base64.b64encode(value))
+    parts = [line[:LDIF_LINE_LENGTH]]
+    for i in range(LDIF_LINE_LENGTH, len(line), LDIF_LINE_LENGTH - 1):
+        parts.append(' ' + line[i:i + LDIF_LINE_LENGTH - 1])
+    return '\n'.join(parts) + '\n'
+
+
+def iter_ldif(entries, attribute_names):
+    """
+        Yield LDIF records of ldapom entries, attributes in given order.
+    """
+    for entry in entries:
+        attributes = dict((attr.name.lower(), attr) for attr in entry._attributes)
+        lines = [format_ldif_line('dn', entry.dn.encode('utf-8'))]
+        for name in attribute_names:
+            attr = attributes.get(name.lower())
+            if attr is None:
+                continue
+            for value in sorted(attr._get_ldap_values()):
+                lines.append(format_ldif_line(attr.name, value))
+        lines.append('\n')
+        yield ''.join(lines)
+
+
+def get_search_filter(model, search_filter=None):
+    all_filter = orm.wrap_filter(model.all_search_filter)
+    if not search_filter:
+        return all_filter
+    return '(&{0}{1})'.format(all_filter, orm.wrap_filter(search_filter))
+
+
+def iter_export(model, export_format, field_names, search_filter=None):
+    """
+        Yield chunks of model entries exported as ldif, ndjson or csv.
+
+        Entries matching all_search_filter and given LDAP filter are searched
+        requesting attributes of given fields only. Chunks are produced as
+        search results arrive, so with paging enabled (model.page_size) only
+        one page of entries is held in memory.
+    """
+    attribute_names = [model._fields[name].name for name in field_names]
+    search_filter = get_search_filter(model, search_filter)
+
+    if export_format == 'ldif':
+        attribute_names = ['objectClass'] + attribute_names
+        entries = model.search_entries(search_filter, retrieve_attributes=attribute_names)
+        return iter_ldif(entries, attribute_names)
+
+    pkey_raw_name = model._fields[model._primary_field].name
+    entries = model.search_entries(search_filter, retrieve_attributes=sorted(set(attribute_names) | {pkey_raw_name}))
+    rows = (
+        model.from_entry(entry, fetch=False, register=False).get_plain_values(field_names)
+        for entry in entries
+    )
+    return EXPORT_FORMATS[export_format](rows, field_names)
+
+
+EXPORT_FORMATS = {
+    'ndjson': iter_ndjson,
+    'csv': iter_csv,
+}
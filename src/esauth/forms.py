@@ -7,6 +7,13 @@ import esauth.models as models
 ValidationError = forms.ValidationError
 
 
+def populate_model(form, model):
+    # Models have no __dict__, so only fields known to model can be set
+    for name, field in form._fields.items():
+        if name in model._fields:
+            field.populate_obj(model, name)
+
+
 class RequiredTogether(validators.Required):
     def __init__(self, namespace, *args, **kwargs):
         self.namespace = namespace
@@ -49,7 +56,7 @@ class UserForm(forms.Form):
     login_shell = forms.StringField('Login shell', [RequiredTogether('posix_account'), validators.Optional(), validators.Length(min=3, max=255)])
 
     def validate_username(self, field):
-        if models.User.get(self.data['username']):
+        if field.data and models.User.exists(field.data):
             raise ValidationError(u"User {username} already exist".format(**self.data))
 
 
@@ -58,7 +65,7 @@ class GroupForm(forms.Form):
     members = forms.SelectMultipleField('Members')
 
     def validate_name(self, field):
-        if models.Group.get(self.data['name']):
+        if field.data and models.Group.exists(field.data):
             raise ValidationError(u"Group {name} already exist".format(**self.data))
 
 
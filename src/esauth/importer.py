@@ -0,0 +1,277 @@
+import os
+import sys
+import csv
+import json
+import base64
+import Queue
+import logging
+import threading
+import ldapom
+from webob.multidict import MultiDict
+import esauth.orm as orm
+import esauth.connection as connection
+import esauth.forms as forms
+import esauth.models as models
+
+logger = logging.getLogger(__name__)
+
+# Separator of multiple values in CSV column
+CSV_VALUES_SEPARATOR = ';'
+
+
+def iter_ldif_records(lines):
+    """
+        Parse LDIF content records, yielding dicts of lowercased attribute name to list of values.
+        Lines are read one by one, so input of any size may be parsed.
+        Values are byte strings, as binary ones (e.g. jpegPhoto) are not text.
+    """
+    record = {}
+    current = None
+
+    def add(line):
+        name, _, value = line.partition(':')
+        if value.startswith(':'):
+            value = base64.b64decode(value[1:].strip())
+        else:
+            value = value.strip()
+        record.setdefault(name.strip().lower(), []).append(value)
+
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line.startswith(' ') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            add(current)
+            current = None
+        if not line.strip():
+            if record and 'dn' in record:
+                yield record
+            record = {}
+        elif not line.startswith('#') and not line.startswith('version:'):
+            current = line
+    if current is not None:
+        add(current)
+    if record and 'dn' in record:
+        yield record
+
+
+def ldif_record_to_data(model, record):
+    """
+        Return form data for LDIF record, keys are model field names.
+        Empty values are dropped, as in CSV, e.g. placeholder member of empty group.
+        Only values of model fields are decoded, other attributes may be binary.
+    """
+    raw_fields = dict((name.lower(), field_name) for name, field_name in model._raw_fields.items())
+    data = {}
+    for name, values in record.items():
+        field_name = raw_fields.get(name)
+        if field_name is not None:
+            data[field_name] = [value.decode('utf-8') for value in values if value]
+    return data
+
+
+def iter_csv_records(lines):
+    """
+        Parse CSV with header row of model field names, yielding dicts of field name to list of values.
+    """
+    for row in csv.DictReader(lines):
+        yield dict(
+            (name, [value.decode('utf-8') for value in row[name].split(CSV_VALUES_SEPARATOR) if value])
+            for name in row if name
+        )
+
+
+READERS = {
+    'ldif': lambda model, lines: (ldif_record_to_data(model, record) for record in iter_ldif_records(lines)),
+    'csv': lambda model, lines: iter_csv_records(lines),
+}
+
+
+class Checkpoint(object):
+
+    """
+        Import progress, stored as number of the last record, all records
+        up to which are processed. Records are processed by several
+        workers out of order, so numbers processed ahead are kept in memory
+        until gap is filled.
+    """
+
+    def __init__(self, path, source, save_every=1000):
+        self.path = path
+        self.source = source
+        self.save_every = save_every
+        self.position = 0
+        self._processed = set()
+        self._lock = threading.Lock()
+        self._unsaved = 0
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return self.position
+        with open(self.path) as f:
+            state = json.load(f)
+        if state.get('source') == self.source:
+            self.position = state['position']
+        return self.position
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'source': self.source, 'position': self.position}, f)
+        os.rename(tmp_path, self.path)
+
+    def processed(self, number):
+        with self._lock:
+            self._processed.add(number)
+            while self.position + 1 in self._processed:
+                self.position += 1
+                self._processed.remove(self.position)
+                self._unsaved += 1
+            if self._unsaved >= self.save_every:
+                self._unsaved = 0
+                self.save()
+
+    def remove(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ImportStopped(Exception):
+    pass
+
+
+class Importer(object):
+
+    """
+        Validate records with model form and save them by several worker threads.
+
+        Records are passed to workers through bounded queue, so reading
+        stops while workers are behind. Each worker uses own pooled
+        connection, so there should be no more workers than pooled
+        connections.
+
+        Checkpoint advances over imported records and ones failed
+        validation only. Any other error, e.g. LDAP or connection pool
+        one, stops import, failed record and ones after it are imported
+        when run again.
+    """
+
+    form_classes = {
+        models.User: forms.UserForm,
+        models.Group: forms.GroupForm,
+    }
+
+    def __init__(self, model, checkpoint, workers=4, queue_size=1000):
+        self.model = model
+        self.form_class = self.form_classes[model]
+        self.checkpoint = checkpoint
+        self.workers = workers
+        self.queue_size = queue_size
+        self.imported = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._error = None
+
+    def get_form(self, data):
+        formdata = MultiDict()
+        for name, values in data.items():
+            for value in values:
+                formdata.add(name, value)
+        if self.model is models.User and 'password' in formdata and 'password2' not in formdata:
+            formdata['password2'] = formdata['password']
+        form = self.form_class(formdata=formdata)
+        if self.model is models.Group:
+            choices = models.User.get_choices()
+            form.members.choices = list(choices)
+            # Members may be given as dns in any form or as usernames
+            dns = dict((orm.normalize_dn(dn), dn) for dn, username in choices)
+            dns.update((username, dn) for dn, username in choices)
+            form.members.data = [dns.get(orm.normalize_dn(value), dns.get(value, value))
+                                 for value in form.members.data or []]
+        return form
+
+    def import_record(self, number, data):
+        form = self.get_form(data)
+        if not form.validate():
+            errors = '; '.join(
+                '{0}: {1}'.format(name, ', '.join(field_errors)) for name, field_errors in sorted(form.errors.items())
+            )
+            raise ValueError(errors)
+        obj = self.model()
+        forms.populate_model(form, obj)
+        try:
+            obj.save()
+        except connection.EntryAlreadyExists:
+            raise ValueError('{0} already exists'.format(obj.get_dn()))
+
+    def _work(self, records):
+        try:
+            while True:
+                item = records.get()
+                if item is None:
+                    break
+                if self._stop.is_set():
+                    # Drain queue, so reader is not blocked
+                    continue
+                number, data = item
+                try:
+                    self.import_record(number, data)
+                except ValueError as e:
+                    logger.error('Record %s not imported: %s', number, e)
+                    with self._lock:
+                        self.failed += 1
+                except Exception as e:
+                    if isinstance(e, (ldapom.LDAPError, connection.PoolTimeout)):
+                        logger.error('Import stopped at record %s: %s', number, e)
+                    else:
+                        logger.exception('Import stopped at record %s', number)
+                    with self._lock:
+                        if self._error is None:
+                            self._error = sys.exc_info()
+                    self._stop.set()
+                    continue
+                else:
+                    with self._lock:
+                        self.imported += 1
+                self.checkpoint.processed(number)
+        finally:
+            release = getattr(self.model._connection, 'release', None)
+            if release is not None:
+                release()
+
+    def run(self, records):
+        """
+            Import iterable of records, skipping ones processed according to checkpoint.
+            Raises ImportStopped if import stopped by error other than validation one.
+        """
+        start = self.checkpoint.load()
+        queue = Queue.Queue(maxsize=self.queue_size)
+        threads = [threading.Thread(target=self._work, args=(queue,)) for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            for number, data in enumerate(records, 1):
+                if self._stop.is_set():
+                    break
+                if number > start:
+                    queue.put((number, data))
+        except BaseException:
+            # Drop queued records on interrupt, checkpoint stays before them
+            try:
+                while True:
+                    queue.get_nowait()
+            except Queue.Empty:
+                pass
+            raise
+        finally:
+            for thread in threads:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+            self.checkpoint.save()
+        if self._error is not None:
+            raise ImportStopped(self._error[1]), None, self._error[2]
@@ -0,0 +1,104 @@
+"""
+    Build script of esauth._ldap_ext, run by setup.py through cffi_modules.
+
+    ldapom bindings include neither controls nor asynchronous operations, so
+    libldap functions needed for paged results (RFC 2696), server side sorting
+    (RFC 2891) with virtual list view and pipelined writes are declared here
+    and compiled at install time.
+"""
+import cffi
+
+LDAP_EXT_CDEF = """
+typedef int ber_int_t;
+typedef unsigned long ber_len_t;
+
+typedef struct berval {
+    ber_len_t bv_len;
+    char *bv_val;
+} BerValue;
+
+typedef ... LDAP;
+typedef ... LDAPMessage;
+typedef ... LDAPControl;
+typedef ... LDAPMod;
+typedef ... BerElement;
+typedef ... LDAPSortKey;
+
+typedef struct ldapvlvinfo {
+    ber_int_t ldvlv_version;
+    ber_int_t ldvlv_before_count;
+    ber_int_t ldvlv_after_count;
+    ber_int_t ldvlv_offset;
+    ber_int_t ldvlv_count;
+    struct berval *ldvlv_attrvalue;
+    struct berval *ldvlv_context;
+    ...;
+} LDAPVLVInfo;
+
+static char *const LDAP_CONTROL_PAGEDRESULTS;
+static char *const LDAP_CONTROL_VLVRESPONSE;
+#define LDAP_SUCCESS ...
+#define LDAP_NO_SUCH_OBJECT ...
+#define LDAP_ALREADY_EXISTS ...
+#define LDAP_ADMINLIMIT_EXCEEDED ...
+#define LDAP_UNAVAILABLE_CRITICAL_EXTENSION ...
+#define LDAP_INAPPROPRIATE_MATCHING ...
+#define LDAP_SORT_CONTROL_MISSING ...
+#define LDAP_UNWILLING_TO_PERFORM ...
+#define LDAP_VLV_ERROR ...
+#define LDAP_RES_ANY ...
+#define LDAP_MSG_ALL ...
+
+int ldap_create_page_control(LDAP *ld, ber_int_t pagesize, struct berval *cookie, int iscritical,
+                             LDAPControl **ctrlp);
+int ldap_parse_pageresponse_control(LDAP *ld, LDAPControl *ctrl, ber_int_t *count, struct berval *cookie);
+int ldap_create_sort_keylist(LDAPSortKey ***sortKeyList, char *keyString);
+void ldap_free_sort_keylist(LDAPSortKey **sortkeylist);
+int ldap_create_sort_control(LDAP *ld, LDAPSortKey **keyList, int isCritical, LDAPControl **ctrlp);
+int ldap_create_vlv_control(LDAP *ld, LDAPVLVInfo *ldvlistp, LDAPControl **ctrlp);
+int ldap_parse_vlvresponse_control(LDAP *ld, LDAPControl *ctrls, ber_int_t *target_posp, ber_int_t *list_countp,
+                                   struct berval **contextp, int *errcodep);
+LDAPControl *ldap_control_find(const char *oid, LDAPControl **ctrls, LDAPControl ***nextctrlp);
+void ldap_control_free(LDAPControl *ctrl);
+void ldap_controls_free(LDAPControl **ctrls);
+
+int ldap_search_ext_s(LDAP *ld, char *base, int scope, char *filter, char *attrs[], int attrsonly,
+                      LDAPControl **serverctrls, LDAPControl **clientctrls, struct timeval *timeout,
+                      int sizelimit, LDAPMessage **res);
+int ldap_parse_result(LDAP *ld, LDAPMessage *result, int *errcodep, char **matcheddnp, char **errmsgp,
+                      char ***referralsp, LDAPControl ***serverctrlsp, int freeit);
+
+int ldap_add_ext(LDAP *ld, const char *dn, LDAPMod **attrs, LDAPControl **sctrls, LDAPControl **cctrls,
+                 int *msgidp);
+int ldap_modify_ext(LDAP *ld, const char *dn, LDAPMod **mods, LDAPControl **sctrls, LDAPControl **cctrls,
+                    int *msgidp);
+int ldap_delete_ext(LDAP *ld, const char *dn, LDAPControl **sctrls, LDAPControl **cctrls, int *msgidp);
+int ldap_result(LDAP *ld, int msgid, int all, struct timeval *timeout, LDAPMessage **result);
+int ldap_msgid(LDAPMessage *msg);
+
+LDAPMessage *ldap_first_entry(LDAP *ld, LDAPMessage *result);
+LDAPMessage *ldap_next_entry(LDAP *ld, LDAPMessage *entry);
+char *ldap_get_dn(LDAP *ld, LDAPMessage *entry);
+char *ldap_first_attribute(LDAP *ld, LDAPMessage *entry, BerElement **berptr);
+char *ldap_next_attribute(LDAP *ld, LDAPMessage *entry, BerElement *ber);
+struct berval **ldap_get_values_len(LDAP *ld, LDAPMessage *entry, char *attr);
+int ldap_count_values_len(struct berval **vals);
+void ldap_value_free_len(struct berval **vals);
+
+int ldap_unbind_ext_s(LDAP *ld, LDAPControl **sctrls, LDAPControl **cctrls);
+
+int ldap_msgfree(LDAPMessage *msg);
+void ldap_memfree(void *p);
+void ber_memfree(void *p);
+void ber_free(BerElement *ber, int freebuf);
+"""
+
+ffibuilder = cffi.FFI()
+ffibuilder.cdef(LDAP_EXT_CDEF)
+ffibuilder.set_source('esauth._ldap_ext', """
+    #include <ldap.h>
+    #include <lber.h>
+""", libraries=['ldap', 'lber'])
+
+if __name__ == '__main__':
+    ffibuilder.compile(verbose=True)
@@ -2,14 +2,20 @@ import os
 import random
 import string
 import logging
+import functools
 
 import ldapom
 from pyramid.config import Configurator
-from pyramid.settings import asbool
-from pyramid.paster import bootstrap, setup_logging
+from pyramid.settings import asbool, aslist
+from pyramid.events import NewRequest
+from pyramid.paster import bootstrap, get_appsettings, setup_logging
+from pyramid.scripting import prepare
 import esauth.resources
 import esauth.assets
 import esauth.models
+import esauth.cache
+import esauth.connection
+import esauth.replica
 
 logger = logging.getLogger(__name__)
 
@@ -42,16 +48,103 @@ def configure_template_engine(config):
 
 def configure_ldap_connection(config):
     settings = config.get_settings()
-    ldap_connection = ldapom.LDAPConnection(
-        uri=settings.get('ldap.uri'),
+    ldap_pool = make_connection_pool(settings, settings.get('ldap.uri'))
+    ldap_connection = esauth.connection.ThreadLocalConnection(ldap_pool)
+    read_pools = [make_connection_pool(settings, uri) for uri in aslist(settings.get('ldap.read_uris', ''))]
+    if read_pools:
+        ldap_connection = esauth.connection.RoutingConnection(
+            ldap_connection,
+            [esauth.connection.ThreadLocalConnection(pool) for pool in read_pools],
+            retry_interval=float(settings.get('ldap.read.retry_interval', 30)),
+            sticky_interval=float(settings.get('ldap.read.sticky_interval', 5)),
+        )
+    config.registry['ldap_pool'] = ldap_pool
+    config.registry['ldap_read_pools'] = read_pools
+    config.registry['lc'] = config.registry['ldap_connection'] = ldap_connection
+    config.add_subscriber(release_ldap_connection_on_finish, NewRequest)
+    esauth.orm.Base._connection = ldap_connection
+    configure_model_bases(esauth.models.User, settings.get('ldap.users_base'))
+    configure_model_bases(esauth.models.Group, settings.get('ldap.groups_base'))
+    esauth.orm.Base.page_size = int(settings.get('ldap.page_size', 500))
+    esauth.orm.Base.bulk_window = int(settings.get('ldap.bulk_window', 100))
+    esauth.orm.Base.context_csn_base = settings.get('ldap.context_csn_base') or None
+
+
+def make_connection_pool(settings, uri):
+    connection_factory = functools.partial(
+        ldapom.LDAPConnection,
+        uri=uri,
         base=settings.get('ldap.login'),
         bind_dn=settings.get('ldap.bind_dn'),
         bind_password=settings.get('ldap.bind_password')
     )
-    config.registry['lc'] = config.registry['ldap_connection'] = ldap_connection
-    esauth.orm.Base._connection = ldap_connection
-    esauth.models.User.base_dn = settings.get('ldap.users_base')
-    esauth.models.Group.base_dn = settings.get('ldap.groups_base')
+    return esauth.connection.ConnectionPool(
+        connection_factory,
+        size=int(settings.get('ldap.pool.size', 10)),
+        timeout=float(settings.get('ldap.pool.timeout', 30)),
+        max_lifetime=float(settings.get('ldap.pool.max_lifetime', 3600)),
+        check_interval=float(settings.get('ldap.pool.check_interval', 60)),
+    )
+
+
+def configure_cache(config):
+    settings = config.get_settings()
+    max_size = int(settings.get('ldap.cache.max_size', 1000))
+    if max_size > 0:
+        cache_factory = config.maybe_dotted(settings.get('ldap.cache.backend', esauth.cache.LRUCache))
+        cache = cache_factory(max_size=max_size, ttl=float(settings.get('ldap.cache.ttl', 30)))
+        missing_cache = cache_factory(max_size=max_size, ttl=float(settings.get('ldap.cache.negative_ttl', 5)))
+    else:
+        cache = missing_cache = esauth.cache.NullCache()
+    config.registry['ldap_cache'] = cache
+    config.registry['ldap_missing_cache'] = missing_cache
+    esauth.orm.Base._cache = cache
+    esauth.orm.Base._missing_cache = missing_cache
+    esauth.orm.Base.search_cache_limit = int(settings.get('ldap.cache.search_limit', 100))
+
+
+def configure_replica(config):
+    settings = config.get_settings()
+    old_replica = config.registry.pop('ldap_replica', None)
+    if old_replica is not None:
+        old_replica.stop()
+    esauth.orm.Base._replica = None
+    if not asbool(settings.get('ldap.replica', False)):
+        return
+    replica = esauth.replica.Replica(
+        [esauth.models.User, esauth.models.Group],
+        interval=float(settings.get('ldap.replica.interval', 30)),
+        scan_interval=float(settings.get('ldap.replica.scan_interval', 0)),
+    )
+    replica.start()
+    config.registry['ldap_connection'].release()
+    config.registry['ldap_replica'] = replica
+    esauth.orm.Base._replica = replica
+
+
+def configure_model_bases(model, value):
+    """
+        Set model bases from setting value, one dn per line.
+        New entries are created under the first one.
+    """
+    bases = aslist(value or '', flatten=False)
+    model.base_dn = bases[0] if bases else None
+    model.search_bases = bases if len(bases) > 1 else None
+
+
+def release_ldap_connection_on_finish(event):
+    event.request.add_finished_callback(
+        lambda request: request.registry['ldap_connection'].release()
+    )
+
+
+def configure_identity_map(config):
+    config.add_subscriber(begin_identity_map, NewRequest)
+
+
+def begin_identity_map(event):
+    esauth.orm.identity_map.begin()
+    event.request.add_finished_callback(lambda request: esauth.orm.identity_map.end())
 
 
 def configure_common_debug_options(config):
@@ -104,6 +197,9 @@ def make_app(settings):
     if asbool(settings.get('debug')):
         configure_common_debug_options(config)
     configure_ldap_connection(config)
+    configure_identity_map(config)
+    configure_cache(config)
+    configure_replica(config)
     configure_views(config)
     configure_template_engine(config)
     configure_session(config)
@@ -118,6 +214,18 @@ def paste_wsgi_app(global_config, **settings):  # pragma: no cover
     return make_app(settings)
 
 
-def scripting_boostrap(config_uri):  # pragma: no cover
+def scripting_boostrap(config_uri, replica=True):  # pragma: no cover
+    """
+        Set up application for script. Scripts doing single pass over
+        entries pass replica=False, so ldap.replica is ignored and all
+        entries are not loaded at start.
+    """
     setup_logging(config_uri)
-    return bootstrap(config_uri)
+    if replica:
+        return bootstrap(config_uri)
+    settings = dict(get_appsettings(config_uri))
+    settings['ldap.replica'] = 'false'
+    app = make_app(settings)
+    env = prepare(registry=esauth.registry)
+    env['app'] = app
+    return env
@@ -1,38 +1,156 @@
 
+import time
 import esauth.orm as orm
+import esauth.connection
+
+
+class Members(object):
+
+    """
+        Lazy sequence of dns of existing group members.
+
+        Member values are requested from server and checked for existence
+        only when sequence used. Checked dns are kept, so iteration, len()
+        and indexing check them once. iter_chunks() checks chunk by chunk,
+        to process part of huge group without checking all of it.
+        count() gives number of member values without existence checks.
+    """
+
+    chunk_size = 1000
+
+    def __init__(self, load_values):
+        self._load_values = load_values
+        self._dns = None
+
+    def _get_values(self):
+        return [dn for dn in self._load_values() or () if dn]
+
+    def _get_dns(self):
+        if self._dns is None:
+            self._dns = User.filter_existing(self._get_values())
+        return self._dns
+
+    def iter_chunks(self, chunk_size=None):
+        """
+            Yield lists of existing member dns, checking chunk_size of member values at a time.
+        """
+        if self._dns is not None:
+            values, check = self._dns, list
+        else:
+            values, check = self._get_values(), User.filter_existing
+        chunk_size = chunk_size or self.chunk_size
+        for i in range(0, len(values), chunk_size):
+            chunk = check(values[i:i + chunk_size])
+            if chunk:
+                yield chunk
+
+    def count(self):
+        return len(self._get_values())
+
+    def __iter__(self):
+        return iter(self._get_dns())
+
+    def __len__(self):
+        return len(self._get_dns())
+
+    def __getitem__(self, index):
+        return self._get_dns()[index]
+
+    def __contains__(self, dn):
+        if self._dns is not None:
+            dns = self._dns
+        else:
+            dns = self._get_values()
+        normalized = orm.normalize_dn(dn)
+        if not any(orm.normalize_dn(member_dn) == normalized for member_dn in dns):
+            return False
+        return self._dns is not None or bool(User.filter_existing([dn]))
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return repr(list(self))
 
 
 class Group(orm.Base):
 
     all_search_filter = 'objectClass=groupOfNames'
     object_classes = {'groupOfNames'}
+    search_fields = ('name',)
 
     name = orm.SingleValueField('cn', primary=True)
-    members = orm.Field('member', default=[])
+    # Groups may have many thousands of members, they are fetched only when used
+    members = orm.Field('member', default=[], lazy=True)
 
     @members.decoder
-    def decode_members(self, value):
-        ret = []
-        for member_dn in value:
-            if not member_dn:
-                continue
-            member = User.get(member_dn)
-            if not member:
-                continue
-            ret.append(member_dn)
-        return ret
+    def decode_members(self, load_value):
+        return Members(load_value)
 
     @members.encoder
     def encode_members(self, value):
+        value = [member_dn for member_dn in value or () if member_dn]
         if not value:
             value = ['']
         return value
 
+    def update_members(self, add=(), remove=()):
+        """
+            Add and remove members of saved group with single modify request
+            carrying only changed values, instead of replacing whole member list.
+            Dns already in group are not added again, absent ones are not removed.
+        """
+        if self._saved_state is None:
+            raise ValueError('Group {0} is not saved'.format(self.name))
+        # Current values are needed to send only changed ones
+        self.refresh_saved_state(['member'])
+        old_values = self._saved_state.get('member', frozenset())
+        new_values = (old_values - set(remove)) | set(add)
+        # Empty value keeps groupOfNames valid while there are no members, see encode_members
+        new_values = new_values - {''} or frozenset([''])
+
+        changes = []
+        if old_values - new_values:
+            changes.append((esauth.connection.MOD_DELETE, 'member', sorted(old_values - new_values)))
+        if new_values - old_values:
+            changes.append((esauth.connection.MOD_ADD, 'member', sorted(new_values - old_values)))
+        if not changes:
+            return
+        esauth.connection.modify(self._connection, self.get_dn(), changes)
+        self.members = sorted(new_values)
+        self._saved_state = dict(self._saved_state, member=frozenset(new_values))
+        self._written()
+
+    def add_members(self, dns):
+        self.update_members(add=dns)
+
+    def remove_members(self, dns):
+        self.update_members(remove=dns)
+
 
 class User(orm.Base):
 
     all_search_filter = 'objectClass=inetOrgPerson'
-    object_classes = {'See pre_save'}
+    object_classes = {'See get_extra_attributes'}
+    search_fields = ('username', 'first_name', 'last_name')
+    export_fields = (
+        'username', 'first_name', 'last_name', 'description',
+        'uid_number', 'gid_number', 'home_directory', 'login_shell',
+    )
+
+    # Seconds to keep member choices, when users not added or removed through ORM
+    choices_ttl = 60
+    # (entries version, expiration time, choices) shared between threads
+    _choices = None
 
     username = orm.SingleValueField('uid', primary=True)
     first_name = orm.SingleValueField('givenName', default='')
@@ -54,10 +172,68 @@ class User(orm.Base):
     def full_name(self):
         return u"{0} {1}".format(self.first_name, self.last_name)
 
-    def pre_save(self, entry):
-        entry.objectClass = ['top', 'inetOrgPerson']
-        for attr_name in ('uidNumber', 'gidNumber', 'homeDirectory', 'loginShell'):
-            if entry.get_attribute(attr_name):
-                entry.objectClass = ['top', 'posixAccount', 'inetOrgPerson']
+    @classmethod
+    def get_choices(cls):
+        """
+            Return cached tuple of (dn, username) of all users, sorted by username.
+            Rebuilt when users added or removed through ORM, or after choices_ttl.
+            Only usernames are requested, unless users are served by replica.
+        """
+        cached = cls._choices
+        if cached is not None:
+            version, expires, choices = cached
+            if version == cls._entries_version and expires > time.time():
+                return choices
+        version = cls._entries_version
+        if cls._replica is not None and cls._replica.covers(cls):
+            users = cls.all()
+        else:
+            users = cls.query().only('username')
+        choices = tuple(sorted(((user.get_dn(), user.username) for user in users), key=lambda c: c[1]))
+        cls._choices = (version, time.time() + cls.choices_ttl, choices)
+        return choices
+
+    @property
+    def groups(self):
+        """
+            Groups user is member of, found by single (member=<dn>) search.
+        """
+        return sorted(Group.query().filter(members=self.get_dn()), key=lambda group: group.name)
+
+    def get_extra_attributes(self):
+        object_classes = ['top', 'inetOrgPerson']
+        for field_name in ('uid_number', 'gid_number', 'home_directory', 'login_shell'):
+            if getattr(self, field_name):
+                object_classes = ['top', 'posixAccount', 'inetOrgPerson']
                 break
-        entry.cn = u"{0} {1}".format(self.first_name, self.last_name)
+        return {
+            'objectClass': object_classes,
+            'cn': u"{0} {1}".format(self.first_name, self.last_name),
+        }
+
+
+# Seconds to keep dashboard counts, when entries not added or removed through ORM
+COUNTS_TTL = 10
+# (entries versions, expiration time, counts) shared between threads
+_counts = None
+
+
+def get_counts():
+    """
+        Return dict of user, POSIX account, group and empty group counts.
+        Counted by searches requesting no attributes, cached like User.get_choices().
+    """
+    global _counts
+    version = (User._entries_version, Group._entries_version)
+    cached = _counts
+    if cached is not None and cached[0] == version and cached[1] > time.time():
+        return cached[2]
+    counts = {
+        'users': User.query().count(),
+        'posix_accounts': User.query().filter(objectClass='posixAccount').count(),
+        'groups': Group.query().count(),
+        # Group members encoder stores single empty value for group without members
+        'empty_groups': Group.query().filter(members='').count(),
+    }
+    _counts = (version, time.time() + COUNTS_TTL, counts)
+    return counts
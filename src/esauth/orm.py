@@ -1,40 +1,197 @@
+import copy
+import time
+import functools
+import itertools
+import threading
 import ldapom
+import esauth.cache
+import esauth.connection
+
+
+# Operational attribute with time of last entry change, in GeneralizedTime format
+TIMESTAMP_ATTRIBUTE = 'modifyTimestamp'
+# Change sequence number of OpenLDAP entries, unlike modifyTimestamp changes on each write
+CSN_ATTRIBUTE = 'entryCSN'
+# CSN of latest change in database, kept on its suffix entry by syncprov overlay
+CONTEXT_CSN_ATTRIBUTE = 'contextCSN'
 
 
 class InvalidDefinition(Exception):
     pass
 
 
+class _NotLoaded(object):
+
+    """
+        Raw value of lazy field, which was not requested from server yet.
+    """
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return 'NOT_LOADED'
+
+
+NOT_LOADED = _NotLoaded()
+
+
+def escape_filter_value(value):
+    """
+        Escape value for use in LDAP search filter (RFC 4515).
+    """
+    for char, escaped in (('\\', r'\5c'), ('*', r'\2a'), ('(', r'\28'), (')', r'\29'), ('\0', r'\00')):
+        value = value.replace(char, escaped)
+    return value
+
+
+def normalize_dn(dn):
+    return ','.join(part.strip() for part in dn.lower().split(','))
+
+
+def wrap_filter(search_filter):
+    if search_filter.startswith('('):
+        return search_filter
+    return '({0})'.format(search_filter)
+
+
+def to_values(value):
+    if value is None:
+        return frozenset()
+    if isinstance(value, (set, frozenset, list, tuple)):
+        return frozenset(value)
+    return frozenset([value])
+
+
+class IdentityMap(object):
+
+    """
+        Thread local map of normalized dn to loaded model instance.
+        Active only between begin() and end(), e.g. during request.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def begin(self):
+        self._local.objects = {}
+
+    def end(self):
+        self._local.objects = None
+
+    @property
+    def active(self):
+        return getattr(self._local, 'objects', None) is not None
+
+    def get(self, model, dn):
+        if not self.active:
+            return
+        obj = self._local.objects.get(normalize_dn(dn))
+        if isinstance(obj, model):
+            return obj
+
+    def add(self, obj):
+        if self.active:
+            self._local.objects[normalize_dn(obj.get_dn())] = obj
+
+    def remove(self, obj):
+        if self.active:
+            self._local.objects.pop(normalize_dn(obj.get_dn()), None)
+
+
+identity_map = IdentityMap()
+
+
+class hybridmethod(object):
+
+    """
+        Method which gets class as first argument and instance (or None, if
+        called on class) as second one.
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __get__(self, obj, obj_type):
+        return functools.partial(self.func, obj_type, obj)
+
+
+# Source of Base._entries_version values, unique across models
+_entries_versions = itertools.count(1)
+
+
 class Field(object):
 
+    """
+        Model attribute stored in LDAP attribute name.
+
+        Lazy fields are not requested when entries loaded, their values are
+        fetched from server on first access. Decoder of lazy field gets
+        function returning raw value instead of value itself, so decoded
+        value may be built without fetching anything.
+    """
+
     _encoder = None
     _decoder = None
 
-    def __init__(self, name, default=None, primary=False, singlevalue=None, nullable=False, null_if_blank=True):
+    # Instance slot names and descriptors for raw and decoded values, set by metaclass
+    _value_key = None
+    _decoded_key = None
+    _value_slot = None
+    _decoded_slot = None
+
+    def __init__(self, name, default=None, primary=False, singlevalue=None, nullable=False, null_if_blank=True,
+                 lazy=False):
         self.default = default
         self.name = name
         self.primary = primary
         self.nullable = nullable
         self.null_if_blank = null_if_blank
+        self.lazy = lazy
 
     def _get_value(self, obj, raw=False):
-        key = '_field_{0}_value'.format(self.name)
-        value = getattr(obj, key)
+        if self._decoder and self.lazy and not raw:
+            return self._decoder(obj, functools.partial(self._get_value, obj, raw=True))
+        value = self._value_slot.__get__(obj, None)
+        if value is NOT_LOADED:
+            value = obj._fetch_field(self)
         if self._decoder and not raw:
             value = self._decoder(obj, value)
         return value
 
+    def _is_loaded(self, obj):
+        return self._value_slot.__get__(obj, None) is not NOT_LOADED
+
     def _set_value(self, obj, value):
-        key = '_field_{0}_value'.format(self.name)
         if self._encoder:
             value = self._encoder(obj, value)
-        setattr(obj, key, value)
+        self._value_slot.__set__(obj, value)
+        self._reset_decoded(obj)
+
+    def _reset_decoded(self, obj):
+        try:
+            self._decoded_slot.__delete__(obj)
+        except AttributeError:
+            pass
+
+    def _decode(self, obj):
+        return self._get_value(obj)
 
     def __set__(self, obj, value):
         self._set_value(obj, value)
 
     def __get__(self, obj, obj_type):
-        return self._get_value(obj)
+        if obj is None:
+            return self
+        try:
+            return self._decoded_slot.__get__(obj, None)
+        except AttributeError:
+            value = self._decode(obj)
+            self._decoded_slot.__set__(obj, value)
+            return value
 
     def encoder(self, func):
         self._encoder = func
@@ -45,10 +202,10 @@ class Field(object):
 
 class SingleValueField(Field):
     ""
-    def __get__(self, obj, obj_type):
+    def _decode(self, obj):
         value = self._get_value(obj)
         if isinstance(value, set) and len(value) == 1:
-            return list(value)[0]
+            return next(iter(value))
         if isinstance(value, set) and len(value) > 1:
             raise ValueError("Single value field {0}.{1} has multiple values: {2}".format(
                 obj.__class__.__name__,
@@ -58,12 +215,297 @@ class SingleValueField(Field):
         return value
 
 
+class Query(object):
+
+    """
+        Lazy search query for model.
+
+        Usage example:
+
+        ::
+
+            User.query().filter(username__startswith='jo').only('uid', 'sn').limit(50)
+            User.query().contains_any('jo', 'username', 'last_name').order_by('-last_name').paginate(2, 50)
+
+        Filter arguments are model field or ldap attribute names with optional
+        lookup suffix, values are escaped. Compiled filter templates are cached
+        per model class.
+    """
+
+    lookups = {
+        'exact': '({attr}={value})',
+        'startswith': '({attr}={value}*)',
+        'endswith': '({attr}=*{value})',
+        'contains': '({attr}=*{value}*)',
+        'gte': '({attr}>={value})',
+        'lte': '({attr}<={value})',
+        'present': '({attr}=*)',
+    }
+
+    def __init__(self, model):
+        self.model = model
+        self._conditions = []
+        self._attributes = None
+        self._size_limit = 0
+        self._scope = ldapom.LDAP_SCOPE_SUBTREE
+        # (attribute name, reverse) used by paginate()
+        self._order = None
+
+    def _clone(self):
+        query = copy.copy(self)
+        query._conditions = list(self._conditions)
+        return query
+
+    def _attribute_name(self, name):
+        field = self.model._fields.get(name)
+        if field is not None:
+            return field.name
+        return name
+
+    def _add_conditions(self, negate, kwargs):
+        query = self._clone()
+        for key, value in sorted(kwargs.items()):
+            name, _, lookup = key.partition('__')
+            lookup = lookup or 'exact'
+            if lookup not in self.lookups:
+                raise ValueError('Unknown lookup {0}'.format(lookup))
+            query._conditions.append((negate, self._attribute_name(name), lookup, value))
+        return query
+
+    def filter(self, **kwargs):
+        return self._add_conditions(False, kwargs)
+
+    def exclude(self, **kwargs):
+        return self._add_conditions(True, kwargs)
+
+    def contains_any(self, value, *names):
+        """
+            Match entries where any of given attributes contains value.
+        """
+        query = self._clone()
+        attrs = tuple(self._attribute_name(name) for name in names)
+        query._conditions.append((False, attrs, 'contains', value))
+        return query
+
+    def order_by(self, name):
+        """
+            Set attribute to sort paginate() results by, prefix name with - for descending order.
+        """
+        query = self._clone()
+        query._order = (self._attribute_name(name.lstrip('-')), name.startswith('-'))
+        return query
+
+    def only(self, *names):
+        query = self._clone()
+        query._attributes = [self._attribute_name(name) for name in names]
+        return query
+
+    def limit(self, size_limit):
+        query = self._clone()
+        query._size_limit = size_limit
+        return query
+
+    def scope(self, scope):
+        query = self._clone()
+        query._scope = scope
+        return query
+
+    def _get_template(self):
+        key = tuple((negate, attr, lookup) for negate, attr, lookup, value in self._conditions)
+        template = self.model._filter_templates.get(key)
+        if template is None:
+            parts = [wrap_filter(self.model.all_search_filter)]
+            index = 0
+            for negate, attrs, lookup in key:
+                lookup_template = self.lookups[lookup]
+                # Tuple of attributes means any of them should match
+                if isinstance(attrs, tuple):
+                    part = '(|{0})'.format(''.join(
+                        lookup_template.format(attr=attr, value='{%d}' % index) for attr in attrs
+                    ))
+                else:
+                    part = lookup_template.format(attr=attrs, value='{%d}' % index)
+                if '{value}' in lookup_template:
+                    index += 1
+                if negate:
+                    part = '(!{0})'.format(part)
+                parts.append(part)
+            template = '(&{0})'.format(''.join(parts)) if len(parts) > 1 else parts[0]
+            self.model._filter_templates[key] = template
+        return template
+
+    def get_filter(self):
+        values = [
+            escape_filter_value(unicode(value))
+            for negate, attr, lookup, value in self._conditions
+            if '{value}' in self.lookups[lookup]
+        ]
+        return self._get_template().format(*values)
+
+    def get_attributes(self):
+        if self._attributes is None:
+            return self.model._load_attributes
+        pkey_raw_name = self.model._fields[self.model._primary_field].name
+        return sorted(set(self._attributes) | {pkey_raw_name})
+
+    def __iter__(self):
+        entries = self.model.search_entries(
+            self.get_filter(),
+            retrieve_attributes=self.get_attributes(),
+            scope=self._scope,
+            size_limit=self._size_limit,
+        )
+        for entry in entries:
+            yield self.model.from_entry(entry, fetch=False, register=self._attributes is None)
+
+    def first(self):
+        for obj in self.limit(1):
+            return obj
+
+    def count(self):
+        entries = self.model.search_entries(
+            self.get_filter(),
+            retrieve_attributes=['1.1'],
+            scope=self._scope,
+            size_limit=self._size_limit,
+        )
+        return sum(1 for entry in entries)
+
+    def paginate(self, number, per_page):
+        """
+            Return Page of models sorted by order_by() attribute (primary by default).
+
+            With single search base and no size limit, server sorts entries
+            and returns only ones of the page (server side sorting and
+            virtual list view controls, sssvlv overlay of OpenLDAP). If
+            server rejects controls, only primary and sort attributes of all
+            matching entries are requested and sorted here, then entries of
+            the page itself are fetched by primary attribute.
+        """
+        pkey_raw_name = self.model._fields[self.model._primary_field].name
+        sort_attr, reverse = self._order or (pkey_raw_name, False)
+        bases = self.model.get_search_bases()
+        if len(bases) == 1 and not self._size_limit:
+            try:
+                return self._paginate_on_server(bases[0], sort_attr, reverse, number, per_page)
+            except esauth.connection.SortUnavailable:
+                pass
+
+        entries = self.model.search_entries(
+            self.get_filter(),
+            retrieve_attributes=sorted({pkey_raw_name, sort_attr}),
+            scope=self._scope,
+            size_limit=self._size_limit,
+        )
+        keys = sorted(
+            ((_sort_value(entry, sort_attr), normalize_dn(entry.dn), _sort_value(entry, pkey_raw_name, lower=False))
+             for entry in entries),
+            reverse=reverse,
+        )
+
+        page = Page([], number, per_page, len(keys))
+        window = keys[(page.number - 1) * per_page:page.number * per_page]
+        if not window:
+            return page
+
+        search_filter = '(&{0}(|{1}))'.format(self.get_filter(), ''.join(
+            '({0}={1})'.format(pkey_raw_name, escape_filter_value(pkey_value))
+            for sort_value, dn, pkey_value in window
+        ))
+        entries = self.model.search_entries(
+            search_filter, retrieve_attributes=self.get_attributes(), scope=self._scope
+        )
+        found = dict(
+            (normalize_dn(entry.dn), self.model.from_entry(entry, fetch=False, register=self._attributes is None))
+            for entry in entries
+        )
+        page.items = [found[dn] for sort_value, dn, pkey_value in window if dn in found]
+        return page
+
+    def _paginate_on_server(self, base, sort_attr, reverse, number, per_page):
+        # Values compared case insensitively as strings, as when sorted in paginate()
+        sort_key = '{0}{1}:caseIgnoreOrderingMatch'.format('-' if reverse else '', sort_attr)
+
+        def search(number):
+            return self.model._read(lambda connection: esauth.connection.sorted_search(
+                connection,
+                search_filter=self.get_filter(),
+                base=base,
+                sort_key=sort_key,
+                offset=(number - 1) * per_page + 1,
+                count=per_page,
+                scope=self._scope,
+                retrieve_attributes=self.get_attributes(),
+            ))
+
+        number = max(1, number)
+        entries, total = search(number)
+        page = Page([], number, per_page, total)
+        if page.number != number:
+            # Requested page is past the last one
+            entries, total = search(page.number)
+            page = Page([], page.number, per_page, total)
+        page.items = [
+            self.model.from_entry(entry, fetch=False, register=self._attributes is None) for entry in entries
+        ]
+        return page
+
+
+def _sort_value(entry, name, lower=True):
+    attribute = entry.get_attribute(name)
+    if attribute is None or not attribute._values:
+        return u''
+    values = [unicode(value) for value in attribute._values]
+    if lower:
+        values = [value.lower() for value in values]
+    return min(values)
+
+
+class Page(object):
+
+    """
+        Slice of query results, see Query.paginate().
+        Page number is clamped to range of existing pages.
+    """
+
+    def __init__(self, items, number, per_page, total):
+        self.items = items
+        self.per_page = per_page
+        self.total = total
+        self.pages = max(1, (total + per_page - 1) // per_page)
+        self.number = min(max(1, number), self.pages)
+
+    @property
+    def has_previous(self):
+        return self.number > 1
+
+    @property
+    def has_next(self):
+        return self.number < self.pages
+
+    def __iter__(self):
+        return iter(self.items)
+
+
 class _Meta(type):
 
+    def __new__(mcs, name, bases, attrs):
+        # Field values are stored in slots, so instances do not need __dict__
+        if '__NO_ORM_METACLASS__' not in attrs:
+            slots = set(attrs.get('__slots__', ()))
+            for field in attrs.values():
+                if isinstance(field, Field):
+                    slots.add('_field_{0}_value'.format(field.name))
+                    slots.add('_field_{0}_decoded'.format(field.name))
+            attrs['__slots__'] = tuple(sorted(slots))
+        return super(_Meta, mcs).__new__(mcs, name, bases, attrs)
+
     def __init__(cls, name, bases, attrs):
         primary_fields = []
         cls._fields = {}
         cls._raw_fields = {}
+        cls._load_attributes = []
+        cls._filter_templates = {}
         if '__NO_ORM_METACLASS__' in attrs:
             return
 
@@ -73,10 +515,18 @@ class _Meta(type):
 
             cls._fields[field_name] = field
             cls._raw_fields[field.name] = field_name
+            field._value_key = '_field_{0}_value'.format(field.name)
+            field._decoded_key = '_field_{0}_decoded'.format(field.name)
+            field._value_slot = cls.__dict__[field._value_key]
+            field._decoded_slot = cls.__dict__[field._decoded_key]
 
             if field.primary:
                 primary_fields.append(field_name)
 
+        # Attributes requested when entries loaded, lazy ones are fetched on access
+        cls._load_attributes = sorted(name for name, field_name in cls._raw_fields.items()
+                                      if not cls._fields[field_name].lazy)
+
         if len(primary_fields) > 1:
             raise InvalidDefinition(
                 'Model {1}.{0} has more than one primary attribute'.format(name, cls.__module__)
@@ -93,18 +543,68 @@ class Base(object):
 
     _connection = None
 
+    # Process wide cache of loaded entries and search results, see esauth.cache
+    _cache = esauth.cache.NullCache()
+
+    # Short lived cache of dns known to be missing, see exists()
+    _missing_cache = esauth.cache.NullCache()
+
+    # Largest search result stored in _cache, result is stored as one cache item
+    search_cache_limit = 100
+
+    # In-memory replica serving reads of loaded models, see esauth.replica
+    _replica = None
+
+    # Changed each time entries of model added or removed, see _entries_changed()
+    _entries_version = 0
+
+    # Latest entryCSN seen by get_directory_state()
+    _latest_csn = None
+
+    # Changed each time entry of model written through ORM, see _written()
+    _written_version = 0
+
+    # (written version, expiration time, state) of get_directory_state()
+    _directory_state = None
+
+    # Seconds to keep directory state, when entries not written through ORM
+    directory_state_ttl = 5
+
+    # Entry with contextCSN covering model entries, e.g. database suffix, see get_directory_state()
+    context_csn_base = None
+
+    # Number of entries per page for paged searches, 0 disables paging
+    page_size = 0
+
+    # Max number of write operations in flight for bulk_save and bulk_remove
+    bulk_window = 100
+
+    # Base for new entries, also searched unless search_bases set
     base_dn = None
+    # List of bases searched concurrently, see search_entries()
+    search_bases = None
     all_search_filter = None
     object_classes = ['top']
 
+    # Fields matched by list views search box
+    search_fields = ()
+
+    # Fields allowed in exports, all fields if None
+    export_fields = None
+
     __metaclass__ = _Meta
     __NO_ORM_METACLASS__ = True
+    __slots__ = ('_saved_state', '_parent_dn')
 
     # Setted by metaclass
     _fields = {}
     _primary_field = None
 
     def __init__(self, **kwargs):
+        # Attribute values as stored on server, None if model was not loaded or saved
+        self._saved_state = None
+        # Parent of loaded entry, None means base_dn
+        self._parent_dn = None
         for field_name, field in self._fields.items():
             setattr(self, field_name, kwargs.pop(field_name, field.default))
 
@@ -114,49 +614,514 @@ class Base(object):
     def get_pkey_value(self):
         return getattr(self, self._primary_field)
 
+    def get_plain_values(self, field_names):
+        """
+            Return dict of field name to value as loaded, without decoding.
+            Single value fields give value or None, others sorted list of non-empty values.
+        """
+        values = {}
+        for field_name in field_names:
+            field = self._fields[field_name]
+            value = [v for v in to_values(field._get_value(self, raw=True)) if v != '']
+            if isinstance(field, SingleValueField):
+                values[field_name] = value[0] if value else None
+            else:
+                values[field_name] = sorted(value)
+        return values
+
     @classmethod
-    def from_entry(cls, entry):
+    def from_entry(cls, entry, fetch=True, register=True):
+        """
+            Build model from ldapom entry.
+            Pass fetch=False if entry attributes already loaded (e.g. entry
+            returned by search), to avoid additional request to server.
+            If model with the same dn already loaded during request, it is returned instead.
+            Pass register=False for partially loaded entries, to keep them out of identity map.
+        """
+        obj = identity_map.get(cls, entry.dn) if identity_map.active else None
+        if obj is not None:
+            return obj
         obj = cls()
-        entry.fetch()
-        for attr in entry._attributes:
-            key = cls._raw_fields.get(attr.name)
-            if not key:
-                continue
-            value = getattr(entry, attr.name)
-            setattr(obj, key, value)
+        if fetch:
+            entry.fetch()
+        obj._load_entry(entry)
+        if register:
+            identity_map.add(obj)
         return obj
 
-    def refresh(self):
-        entry = self._connection.get_entry(self.get_dn())
-        entry.fetch()
+    def _load_entry(self, entry):
+        self._set_parent_dn(entry.dn)
+        loaded = set()
         for attr in entry._attributes:
             key = self._raw_fields.get(attr.name)
             if not key:
                 continue
             value = getattr(entry, attr.name)
             setattr(self, key, value)
+            loaded.add(key)
+        for field_name, field in self._fields.items():
+            if field.lazy and field_name not in loaded:
+                field._value_slot.__set__(self, NOT_LOADED)
+                field._reset_decoded(self)
+        # Entry may be loaded partially, values are checked on save only
+        self._saved_state = self.get_state(validate=False)
+
+    def _fetch_field(self, field):
+        """
+            Request value of lazy field from server and return it raw.
+        """
+        field_name = self._raw_fields[field.name]
+
+        def fetch(connection):
+            entry = connection.get_entry(self.get_dn(), retrieve_attributes=[field.name])
+            entry.fetch()
+            return entry
+
+        entry = self._read(fetch)
+        if entry.get_attribute(field.name) is not None:
+            value = getattr(entry, field.name)
+        else:
+            value = copy.copy(field.default)
+        if field._encoder:
+            value = field._encoder(self, value)
+        # Decoded value of lazy field is built without raw one, so it stays valid
+        field._value_slot.__set__(self, value)
+        if self._saved_state is not None:
+            self._saved_state[field.name] = to_values(self._get_field_raw_value(field_name, field, validate=False))
+        return field._value_slot.__get__(self, None)
+
+    def refresh(self):
+        def fetch(connection):
+            entry = connection.get_entry(self.get_dn())
+            entry.fetch()
+            return entry
+
+        entry = self._read(fetch)
+        for field in self._fields.values():
+            field._reset_decoded(self)
+        self._load_entry(entry)
+        self._written()
+        self._cache.set(self._entry_cache_key(self.get_dn()), self._get_cache_value())
+
+    @classmethod
+    def _entry_cache_key(cls, dn):
+        return 'entry', normalize_dn(dn)
+
+    @classmethod
+    def _search_cache_key(cls):
+        return 'search', cls.base_dn
+
+    def _get_cache_value(self):
+        # Values of lazy fields not loaded yet are cached as NOT_LOADED
+        values = dict(
+            (field_name, copy.copy(field._value_slot.__get__(self, None)))
+            for field_name, field in self._fields.items()
+        )
+        return self.get_dn(), values, dict(self._saved_state)
+
+    @classmethod
+    def _from_cache_value(cls, value):
+        """
+            Build model from cached value, or return model already loaded during request.
+        """
+        dn, values, saved_state = value
+        obj = identity_map.get(cls, dn)
+        if obj is not None:
+            return obj
+        obj = cls()
+        obj._set_parent_dn(dn)
+        for field_name, field_value in values.items():
+            cls._fields[field_name]._value_slot.__set__(obj, copy.copy(field_value))
+        obj._saved_state = dict(saved_state)
+        identity_map.add(obj)
+        return obj
+
+    def _invalidate_cache(self):
+        """
+            Drop cached entry and all cached search results under model base dn.
+        """
+        self._cache.delete(self._entry_cache_key(self.get_dn()))
+        self._cache.delete(self._search_cache_key())
+
+    @classmethod
+    def _entries_changed(cls):
+        cls._entries_version = next(_entries_versions)
+
+    @classmethod
+    def _get_read_connection(cls):
+        """
+            Return connection for reads: consumer, if connection routes reads (see RoutingConnection).
+        """
+        for_read = getattr(cls._connection, 'for_read', None)
+        if for_read is None:
+            return cls._connection
+        return for_read()
+
+    @classmethod
+    def _read(cls, function):
+        """
+            Return function(connection) called with read connection. If
+            consumer went down, function is called again with next consumer
+            or provider (see RoutingConnection.read_failed).
+        """
+        connection = cls._get_read_connection()
+        while True:
+            try:
+                return function(connection)
+            except ldapom.LDAPServerDownError:
+                read_failed = getattr(cls._connection, 'read_failed', None)
+                failed, connection = connection, read_failed(connection) if read_failed is not None else None
+                if connection is None:
+                    esauth.connection.mark_broken(failed)
+                    raise
+
+    @classmethod
+    def _iter_read(cls, function):
+        """
+            Yield items of iterable returned by function(connection), as _read()
+            does. Read is repeated only if consumer went down before first item.
+        """
+        connection = cls._get_read_connection()
+        while True:
+            started = False
+            try:
+                for item in function(connection):
+                    started = True
+                    yield item
+                return
+            except ldapom.LDAPServerDownError:
+                read_failed = getattr(cls._connection, 'read_failed', None)
+                failed, connection = connection, (
+                    read_failed(connection) if read_failed is not None and not started else None
+                )
+                if connection is None:
+                    esauth.connection.mark_broken(failed)
+                    raise
+
+    def _written(self, removed=False, created=False):
+        """
+            Update caches and replica after entry saved or removed.
+        """
+        mark_written = getattr(self._connection, 'mark_written', None)
+        if mark_written is not None:
+            mark_written()
+        type(self)._written_version = next(_entries_versions)
+        self._invalidate_cache()
+        if removed or created:
+            self._entries_changed()
+        if created:
+            self._missing_cache.delete(self._entry_cache_key(self.get_dn()))
+        if self._replica is not None:
+            if removed:
+                self._replica.discard(self)
+            else:
+                self._replica.store(self)
+
+    @classmethod
+    def _get_latest_csn(cls, search_filter):
+        latest = None
+        for entry in cls.search_entries(search_filter, retrieve_attributes=[CSN_ATTRIBUTE]):
+            csn = entry.get_attribute(CSN_ATTRIBUTE)
+            if csn is not None and csn.value > latest:
+                latest = csn.value
+        return latest
+
+    @classmethod
+    def _get_context_csn(cls):
+        def read(connection):
+            return list(connection.search(
+                search_filter='(objectClass=*)', base=cls.context_csn_base,
+                scope=ldapom.LDAP_SCOPE_BASE, retrieve_attributes=[CONTEXT_CSN_ATTRIBUTE],
+            ))
+        for entry in cls._read(read):
+            csn = entry.get_attribute(CONTEXT_CSN_ATTRIBUTE)
+            if csn is not None and csn.value:
+                # One value per server id in multi-provider setup
+                return max(to_values(csn.value))
+
+    @classmethod
+    def get_directory_state(cls):
+        """
+            Return (latest entryCSN, number of entries) of model entries.
+
+            entryCSN starts with modification time in microseconds and
+            includes change counter, so every write changes it. Number of
+            entries changes when entry removed. CSNs are requested only for
+            entries modified since previous call, unless latest entry was
+            removed. State is kept for directory_state_ttl seconds, unless
+            entry written through ORM meanwhile.
+
+            If context_csn_base set, its contextCSN is returned with None
+            instead, read by single base search. It changes on any write
+            to database, removals included.
+        """
+        version = cls._written_version
+        cached = cls._directory_state
+        if cached is not None and cached[0] == version and cached[1] > time.time():
+            return cached[2]
+
+        if cls.context_csn_base is not None:
+            context_csn = cls._get_context_csn()
+            if context_csn is not None:
+                cls._directory_state = (version, time.time() + cls.directory_state_ttl, (context_csn, None))
+                return context_csn, None
+
+        all_filter = wrap_filter(cls.all_search_filter)
+        count = sum(1 for entry in cls.search_entries(all_filter, retrieve_attributes=['1.1']))
+        latest = None
+        if cls._latest_csn is not None:
+            latest = cls._get_latest_csn('(&{0}({1}>={2}))'.format(
+                all_filter, CSN_ATTRIBUTE, escape_filter_value(cls._latest_csn)
+            ))
+        if latest is None:
+            latest = cls._get_latest_csn(all_filter)
+        cls._latest_csn = latest
+        cls._directory_state = (version, time.time() + cls.directory_state_ttl, (latest, count))
+        return latest, count
+
+    @classmethod
+    def get_search_bases(cls):
+        return cls.search_bases or [cls.base_dn]
+
+    @classmethod
+    def search_entries(cls, search_filter, retrieve_attributes=None, scope=ldapom.LDAP_SCOPE_SUBTREE, size_limit=0):
+        """
+            Search entries under each of search bases.
+            Paged results control used if cls.page_size set.
+
+            When there are several bases, they are searched concurrently:
+            the first one with connection of current thread, each other one
+            in own thread with own pooled connection. So search over N bases
+            takes N - 1 pooled connections besides one already held by request.
+        """
+        searches = [
+            functools.partial(cls._search_base, base, search_filter, retrieve_attributes, scope, size_limit)
+            for base in cls.get_search_bases()
+        ]
+        if len(searches) == 1:
+            return searches[0]()
+
+        def release_connection():
+            release = getattr(cls._connection, 'release', None)
+            if release is not None:
+                release()
+
+        use_reader = getattr(cls._connection, 'use_reader', None)
+        if use_reader is not None:
+            # Threads read where current thread does, e.g. from provider after write
+            reader = cls._get_read_connection()
+            searches[1:] = [
+                functools.partial(cls._search_routed, use_reader, reader, search) for search in searches[1:]
+            ]
+
+        entries = esauth.connection.iter_concurrently(
+            searches[1:],
+            buffer_size=cls.page_size or 1000,
+            cleanup=release_connection,
+            inline=searches[0],
+        )
+        if size_limit:
+            entries = itertools.islice(entries, size_limit)
+        return entries
+
+    @staticmethod
+    def _search_routed(use_reader, reader, search):
+        use_reader(reader)
+        return search()
+
+    @classmethod
+    def _search_base(cls, base, search_filter, retrieve_attributes, scope, size_limit):
+        def search(connection):
+            if cls.page_size:
+                return esauth.connection.paged_search(
+                    connection,
+                    search_filter=search_filter,
+                    base=base,
+                    scope=scope,
+                    retrieve_attributes=retrieve_attributes,
+                    page_size=cls.page_size,
+                    size_limit=size_limit,
+                )
+            entries = connection.search(
+                search_filter=search_filter,
+                base=base,
+                scope=scope,
+                retrieve_attributes=retrieve_attributes,
+            )
+            if size_limit:
+                entries = itertools.islice(entries, size_limit)
+            return entries
+
+        return cls._iter_read(search)
+
+    @classmethod
+    def search(cls, search_filter):
+        """
+            Search models by filter, requesting only model attributes.
+            Models are built from search results without fetching each entry
+            and yielded lazily, page by page if paging enabled.
+            Results are cached after all of them consumed, unless there are
+            more of them than search_cache_limit.
+        """
+        search_key = cls._search_cache_key()
+        cached = (cls._cache.get(search_key) or {}).get((cls, search_filter))
+        if cached is not None:
+            for value in cached:
+                yield cls._from_cache_value(value)
+            return
+
+        cached = [] if not isinstance(cls._cache, esauth.cache.NullCache) else None
+        for entry in cls.search_entries(search_filter, retrieve_attributes=cls._load_attributes):
+            obj = cls.from_entry(entry, fetch=False)
+            if cached is not None:
+                if len(cached) < cls.search_cache_limit:
+                    cached.append(obj._get_cache_value())
+                else:
+                    cached = None
+            yield obj
+        if cached is None:
+            return
+        results = dict(cls._cache.get(search_key) or {})
+        results[(cls, search_filter)] = cached
+        cls._cache.set(search_key, results)
 
     @classmethod
     def all(cls):
-        for entry in cls._connection.search(search_filter=cls.all_search_filter, base=cls.base_dn):
-            yield cls.from_entry(entry)
+        if cls._replica is not None and cls._replica.covers(cls):
+            return cls._replica.all(cls)
+        return cls.search(cls.all_search_filter)
 
     @classmethod
-    def get(cls, entry_id):
-        if entry_id.endswith(cls.base_dn):
-            dn = entry_id
+    def query(cls):
+        return Query(cls)
+
+    @classmethod
+    def filter_existing(cls, dns, batch_size=100, scan_threshold=1000):
+        """
+            Return those of given dns which exist directly under search bases.
+
+            Lookups are batched into OR filters by primary attribute, so
+            resolving N dns costs N/batch_size searches. When more than
+            scan_threshold dns passed, single subtree search used instead.
+            No attributes requested, only entry dns.
+        """
+        pkey_raw_name = cls._fields[cls._primary_field].name
+        bases = set(normalize_dn(base) for base in cls.get_search_bases())
+        candidates = []
+        for dn in dns:
+            rdn, _, parent_dn = dn.partition(',')
+            rdn_name, _, rdn_value = rdn.partition('=')
+            if normalize_dn(parent_dn) not in bases or rdn_name.strip().lower() != pkey_raw_name.lower():
+                continue
+            candidates.append((dn, rdn_value.strip()))
+
+        if cls._replica is not None and cls._replica.covers(cls):
+            return [dn for dn, value in candidates if cls._replica.exists(cls, dn)]
+
+        found = set()
+        unknown = []
+        for dn, value in candidates:
+            if identity_map.get(cls, dn) is not None:
+                found.add(normalize_dn(dn))
+            else:
+                unknown.append((dn, value))
+
+        if len(unknown) > scan_threshold:
+            search_filters = [wrap_filter(cls.all_search_filter)]
         else:
-            dn = "{0}={1},{2}".format(
-                cls._fields[cls._primary_field].name,
-                entry_id,
-                cls.base_dn,
-            )
+            search_filters = []
+            for i in range(0, len(unknown), batch_size):
+                search_filters.append('(&{0}(|{1}))'.format(
+                    wrap_filter(cls.all_search_filter),
+                    ''.join('({0}={1})'.format(pkey_raw_name, escape_filter_value(value))
+                            for dn, value in unknown[i:i + batch_size]),
+                ))
+
+        for search_filter in search_filters:
+            for entry in cls.search_entries(search_filter, retrieve_attributes=['1.1']):
+                found.add(normalize_dn(entry.dn))
+        return [dn for dn, value in candidates if normalize_dn(dn) in found]
+
+    @classmethod
+    def get_candidate_dns(cls, entry_id):
+        """
+            Return list of possible dns for primary key value, one per search base.
+            If entry_id is dn under one of search bases already, it is returned alone.
+        """
+        bases = cls.get_search_bases()
+        normalized_id = normalize_dn(entry_id)
+        for base in bases:
+            if normalized_id.endswith(',' + normalize_dn(base)):
+                return [entry_id]
+        return [
+            "{0}={1},{2}".format(cls._fields[cls._primary_field].name, entry_id, base)
+            for base in bases
+        ]
+
+    @classmethod
+    def _get_loaded(cls, dn):
+        """
+            Return model from identity map, replica or cache, without requests to server.
+        """
+        obj = identity_map.get(cls, dn)
+        if obj is None and cls._replica is not None and cls._replica.covers(cls):
+            obj = cls._replica.get(cls, dn)
+        if obj is None:
+            cached = cls._cache.get(cls._entry_cache_key(dn))
+            if cached is not None:
+                obj = cls._from_cache_value(cached)
+        return obj
+
+    @classmethod
+    def _get_unknown_dns(cls, dns):
+        return [dn for dn in dns if not cls._missing_cache.get(cls._entry_cache_key(dn))]
+
+    @classmethod
+    def _set_missing(cls, dns):
+        for dn in dns:
+            cls._missing_cache.set(cls._entry_cache_key(dn), True)
+
+    @classmethod
+    def get(cls, entry_id):
+        """
+            Get model by primary key value or dn, None if entry does not exist.
+            With several search bases entry is looked up by primary key under all of them.
+        """
+        dns = cls.get_candidate_dns(entry_id)
+        for dn in dns:
+            obj = cls._get_loaded(dn)
+            if obj is not None:
+                return obj
+        if cls._replica is not None and cls._replica.covers(cls):
+            return
+
+        dns = cls._get_unknown_dns(dns)
+        if len(dns) == 1:
+            def load(connection):
+                entry = connection.get_entry(dns[0], retrieve_attributes=cls._load_attributes)
+                if entry.exists():
+                    return cls.from_entry(entry)
 
-        entry = cls._connection.get_entry(dn)
-        if not entry.exists():
+            obj = cls._read(load)
+            if obj is None:
+                cls._set_missing(dns)
+                return
+        elif dns:
+            obj = cls.query().filter(**{cls._primary_field: entry_id}).first()
+            if obj is None:
+                cls._set_missing(dns)
+                return
+        else:
             return
 
-        return cls.from_entry(entry)
+        cls._cache.set(cls._entry_cache_key(obj.get_dn()), obj._get_cache_value())
+        return obj
+
+    def _set_parent_dn(self, dn):
+        parent_dn = dn.partition(',')[2].strip()
+        if normalize_dn(parent_dn) == normalize_dn(self.base_dn or ''):
+            parent_dn = None
+        self._parent_dn = parent_dn
 
     def get_dn(self, pkey_value=None):
         pkey_raw_name = self._fields[self._primary_field].name
@@ -164,31 +1129,210 @@ class Base(object):
         return "{0}={1},{2}".format(
             pkey_raw_name,
             pkey_value,
-            self.base_dn
+            self._parent_dn or self.base_dn
         )
 
-    def pre_save(self, entry):
-        pass
+    def get_extra_attributes(self):
+        """
+            Attributes, computed from model fields and saved along with them.
+        """
+        return {
+            'objectClass': self.object_classes,
+        }
+
+    def _get_field_raw_value(self, field_name, field, validate=True):
+        value = field._get_value(self, raw=True)
+        if validate and not field.nullable and value is None:
+            raise ValueError('Field {0}.{1} must not be None'.format(self.__class__.__name__, field_name))
+        if field.null_if_blank and not value:
+            value = None
+        return value
+
+    def get_state(self, validate=True):
+        """
+            Return dict of attribute name to frozenset of values, as they would be saved.
+            Lazy fields not loaded yet are left out, so they are not changed by save().
+            Pass validate=False to skip check of non-nullable fields, e.g. to record loaded state.
+        """
+        state = {}
+        for field_name, field in self._fields.items():
+            if not field._is_loaded(self):
+                continue
+            state[field.name] = to_values(self._get_field_raw_value(field_name, field, validate=validate))
+        for name, value in self.get_extra_attributes().items():
+            state[name] = to_values(value)
+        return state
+
+    def get_changes(self, state=None):
+        """
+            Return list of modify operations needed to bring saved state to the current one.
+            Values of multivalue fields are added and deleted one by one,
+            other attributes are replaced.
+        """
+        if state is None:
+            state = self.get_state()
+        replace_only = set(self.get_extra_attributes())
+        for field in self._fields.values():
+            if isinstance(field, SingleValueField):
+                replace_only.add(field.name)
+
+        deletes, adds = [], []
+        for name in sorted(state):
+            old_values = self._saved_state.get(name, frozenset())
+            new_values = state[name]
+            if old_values == new_values:
+                continue
+            if not new_values:
+                deletes.append((esauth.connection.MOD_DELETE, name, []))
+            elif not old_values:
+                adds.append((esauth.connection.MOD_ADD, name, sorted(new_values)))
+            elif name in replace_only:
+                adds.append((esauth.connection.MOD_REPLACE, name, sorted(new_values)))
+            else:
+                if old_values - new_values:
+                    deletes.append((esauth.connection.MOD_DELETE, name, sorted(old_values - new_values)))
+                if new_values - old_values:
+                    adds.append((esauth.connection.MOD_ADD, name, sorted(new_values - old_values)))
+        return deletes + adds
+
+    def refresh_saved_state(self, names):
+        """
+            Reload saved values of given attributes from server.
+
+            Model may come from cache, replica or read consumer, so its saved
+            state may be behind the entry. Values are read through
+            cls._connection (provider) just before changes are computed, so
+            added and deleted values match the entry being modified.
+        """
+        names = sorted(names)
+        if not names:
+            return
+        entries = self._connection.search(
+            search_filter='(objectClass=*)',
+            base=self.get_dn(),
+            scope=ldapom.LDAP_SCOPE_BASE,
+            retrieve_attributes=names,
+        )
+        for entry in entries:
+            saved_state = dict(self._saved_state)
+            for name in names:
+                attr = entry.get_attribute(name)
+                saved_state[name] = to_values(getattr(entry, name)) if attr is not None else frozenset()
+            self._saved_state = saved_state
 
     def save(self):
         if not getattr(self, self._primary_field, None):
             raise ValueError('Primary field {0} not set'.format(self._primary_field))
 
-        entry = ldapom.LDAPEntry(self._connection, self.get_dn())
+        state = self.get_state()
+        pkey_raw_name = self._fields[self._primary_field].name
+        if self._saved_state is not None and self._saved_state.get(pkey_raw_name) == state[pkey_raw_name]:
+            self.refresh_saved_state(
+                name for name, values in state.items() if values != self._saved_state.get(name, frozenset())
+            )
+            changes = self.get_changes(state)
+            if changes:
+                esauth.connection.modify(self._connection, self.get_dn(), changes)
+            self._saved_state = state
+            self._written()
+            return
 
-        for field_name, field in self._fields.items():
-            value = field._get_value(self, raw=True)
-            if not field.nullable and value is None:
-                raise ValueError('Field {0}.{1} must not be None'.format(self.__class__.__name__, field_name))
-            if field.null_if_blank and not value:
-                value = None
-            if value is None:
-                delattr(entry, field.name)
-            else:
-                setattr(entry, field.name, value)
-        entry.objectClass = self.object_classes
-        self.pre_save(entry)
-        entry.save()
+        try:
+            esauth.connection.add(self._connection, self.get_dn(), self._get_add_changes(state))
+        except esauth.connection.EntryAlreadyExists:
+            # Created elsewhere, while dn may be remembered as missing by exists()
+            self._missing_cache.delete(self._entry_cache_key(self.get_dn()))
+            raise
+        self._saved_state = state
+        self._written(created=True)
+        identity_map.add(self)
+
+    @staticmethod
+    def _get_add_changes(state):
+        return [(esauth.connection.MOD_ADD, name, sorted(values)) for name, values in sorted(state.items()) if values]
+
+    def _get_write_operation(self, state):
+        """
+            Return (operation, changes) to write state in bulk, or None if nothing changed.
+        """
+        if not getattr(self, self._primary_field, None):
+            raise ValueError('Primary field {0} not set'.format(self._primary_field))
+        pkey_raw_name = self._fields[self._primary_field].name
+        if self._saved_state is not None and self._saved_state.get(pkey_raw_name) == state[pkey_raw_name]:
+            changes = self.get_changes(state)
+            return ('modify', changes) if changes else None
+        return 'add', self._get_add_changes(state)
+
+    @classmethod
+    def _bulk_write(cls, models, get_operation, on_success, window):
+        results = [None] * len(models)
+        operations = []
+        for index, obj in enumerate(models):
+            try:
+                operation = get_operation(obj)
+            except ValueError as e:
+                results[index] = (obj, e)
+                continue
+            if operation is None:
+                results[index] = (obj, None)
+                continue
+            operations.append((index, operation[0], obj.get_dn(), operation[1]))
+
+        pipeline = esauth.connection.pipeline(cls._connection, operations, window or cls.bulk_window)
+        for index, error in pipeline:
+            obj = models[index]
+            if error is None:
+                on_success(obj)
+            results[index] = (obj, error)
+        return results
+
+    @classmethod
+    def bulk_save(cls, models, window=None):
+        """
+            Save many models, sending requests asynchronously over one connection.
+
+            New models are added (existing entries are not replaced, as with
+            save(), this is reported as error), loaded models are modified.
+            Unlike save(), changes are computed against state models were
+            loaded with, so models should be loaded fresh, not from cache.
+            Returns list of (model, error) tuples in the order of models,
+            error is None on success.
+        """
+        models = list(models)
+        states = {}
+        created = set()
+
+        def get_operation(obj):
+            state = states[id(obj)] = obj.get_state()
+            operation = obj._get_write_operation(state)
+            if operation is not None and operation[0] == 'add':
+                created.add(id(obj))
+            return operation
+
+        def on_success(obj):
+            obj._saved_state = states[id(obj)]
+            obj._written(created=id(obj) in created)
+            identity_map.add(obj)
+
+        return cls._bulk_write(models, get_operation, on_success, window)
+
+    @classmethod
+    def bulk_remove(cls, models, window=None):
+        """
+            Remove many models, sending requests asynchronously over one connection.
+            Returns list of (model, error) tuples, as bulk_save does.
+        """
+        def get_operation(obj):
+            if not getattr(obj, obj._primary_field, None):
+                raise ValueError('Primary field {0} not set'.format(obj._primary_field))
+            return 'delete', None
+
+        def on_success(obj):
+            obj._saved_state = None
+            obj._written(removed=True)
+            identity_map.remove(obj)
+
+        return cls._bulk_write(list(models), get_operation, on_success, window)
 
     def rename(self, newname):
         raise NotImplementedError()
@@ -198,7 +1342,42 @@ class Base(object):
             raise ValueError('Primary field {0} not set'.format(self._primary_field))
         entry = ldapom.LDAPEntry(self._connection, self.get_dn())
         entry.delete()
+        self._saved_state = None
+        self._written(removed=True)
+        identity_map.remove(self)
 
-    def exists(self):
-        entry = ldapom.LDAPEntry(self._connection, self.get_dn())
-        return entry.exists()
+    @hybridmethod
+    def exists(cls, obj, entry_id=None):
+        """
+            Check entry exists, requesting no attributes from server.
+
+            Called on class takes primary key value or dn (User.exists('john')),
+            called on instance checks instance dn (user.exists()).
+            Missing dns are remembered for a short time in cls._missing_cache.
+        """
+        if obj is not None:
+            dns = [obj.get_dn()]
+        else:
+            dns = cls.get_candidate_dns(entry_id)
+            if cls._replica is not None and cls._replica.covers(cls):
+                return any(cls._replica.exists(cls, dn) for dn in dns)
+            for dn in dns:
+                if identity_map.get(cls, dn) is not None or cls._cache.get(cls._entry_cache_key(dn)) is not None:
+                    return True
+            dns = cls._get_unknown_dns(dns)
+            if not dns:
+                return False
+
+        if len(dns) == 1:
+            found = cls._read(lambda connection: any(True for entry in connection.search(
+                search_filter=wrap_filter(cls.all_search_filter),
+                base=dns[0],
+                scope=ldapom.LDAP_SCOPE_BASE,
+                retrieve_attributes=['1.1'],
+            )))
+        else:
+            # Entry may be under any of search bases
+            found = cls.query().filter(**{cls._primary_field: entry_id}).limit(1).count() > 0
+        if not found:
+            cls._set_missing(dns)
+        return found
@@ -0,0 +1,211 @@
+import time
+import logging
+import threading
+import esauth.orm as orm
+
+logger = logging.getLogger(__name__)
+
+
+class Replica(object):
+
+    """
+        In-memory copy of model entries for read-mostly deployments.
+
+        load() reads all entries of given models, sync() applies changes made
+        on server since previous load or sync: entries with newer
+        modifyTimestamp are reloaded and deleted ones found by comparing
+        entry dns. start() runs sync() every interval seconds in background.
+
+        Finding deleted entries requests dns of all entries, so its cost
+        grows with directory size. It runs at most every scan_interval
+        seconds, deleted entries (and old dns of renamed ones) stay in
+        replica until then. If orm.Base.context_csn_base set, sync reads
+        only its contextCSN while nothing changed on server.
+
+        While replica set as orm.Base._replica, Model.get(), Model.all() and
+        Model.filter_existing() of loaded models are served from memory, and
+        changes saved through ORM are applied to replica immediately.
+    """
+
+    def __init__(self, models, interval=30, scan_interval=0):
+        self.models = list(models)
+        self.interval = interval
+        self.scan_interval = scan_interval
+        self._lock = threading.Lock()
+        # Model to dict of normalized dn to cached model value, updated in place under lock
+        self._entries = {}
+        # Model to latest seen modifyTimestamp
+        self._timestamps = {}
+        # Normalized dns written through ORM since current sync started
+        self._local_writes = set()
+        self._stop = threading.Event()
+        self._thread = None
+        self._syncs = 0
+        self._last_sync = None
+        # contextCSN at previous sync and at previous scan of dns, see sync()
+        self._context_csn = None
+        self._scanned_csn = None
+        self._last_scan = None
+        self._scans = 0
+
+    def covers(self, model):
+        return model in self._entries
+
+    def get(self, model, dn):
+        value = self._entries[model].get(orm.normalize_dn(dn))
+        if value is not None:
+            return model._from_cache_value(value)
+
+    def exists(self, model, dn):
+        return orm.normalize_dn(dn) in self._entries[model]
+
+    def all(self, model):
+        with self._lock:
+            items = sorted(self._entries[model].items())
+        for dn, value in items:
+            yield model._from_cache_value(value)
+
+    def store(self, obj):
+        dn = orm.normalize_dn(obj.get_dn())
+        value = obj._get_cache_value()
+        with self._lock:
+            self._local_writes.add(dn)
+            entries = self._entries.get(type(obj))
+            if entries is not None:
+                entries[dn] = value
+
+    def discard(self, obj):
+        dn = orm.normalize_dn(obj.get_dn())
+        with self._lock:
+            self._local_writes.add(dn)
+            entries = self._entries.get(type(obj))
+            if entries is not None:
+                entries.pop(dn, None)
+
+    def _read(self, model, search_filter):
+        """
+            Return dict of normalized dn to cached value and latest modifyTimestamp.
+        """
+        entries = {}
+        latest = None
+        retrieve_attributes = sorted(model._raw_fields) + [orm.TIMESTAMP_ATTRIBUTE]
+        for entry in model.search_entries(search_filter, retrieve_attributes=retrieve_attributes):
+            obj = model()
+            obj._load_entry(entry)
+            entries[orm.normalize_dn(entry.dn)] = obj._get_cache_value()
+            timestamp = entry.get_attribute(orm.TIMESTAMP_ATTRIBUTE)
+            if timestamp is not None and timestamp.value > latest:
+                latest = timestamp.value
+        return entries, latest
+
+    def _get_context_csn(self):
+        model = self.models[0]
+        if model.context_csn_base is not None:
+            return model._get_context_csn()
+
+    def load(self):
+        # Read before entries, so changes made during load are synced
+        context_csn = self._get_context_csn()
+        for model in self.models:
+            entries, latest = self._read(model, orm.wrap_filter(model.all_search_filter))
+            with self._lock:
+                self._entries[model] = entries
+                self._timestamps[model] = latest
+            model._entries_changed()
+        self._context_csn = self._scanned_csn = context_csn
+        self._last_sync = self._last_scan = time.time()
+
+    def sync(self):
+        """
+            Apply changes made on server since previous load or sync.
+            Entries written through ORM meanwhile are left as written,
+            they are picked up by the next sync.
+        """
+        if not all(self.covers(model) for model in self.models):
+            return self.load()
+
+        context_csn = self._get_context_csn()
+        changed_since_sync = context_csn is None or context_csn != self._context_csn
+        scan = (
+            (context_csn is None or context_csn != self._scanned_csn) and
+            time.time() - self._last_scan >= self.scan_interval
+        )
+        if not changed_since_sync and not scan:
+            self._syncs += 1
+            self._last_sync = time.time()
+            return
+
+        with self._lock:
+            self._local_writes = set()
+
+        for model in self.models:
+            all_filter = orm.wrap_filter(model.all_search_filter)
+            since = self._timestamps[model]
+            if since is None:
+                changed, latest = self._read(model, all_filter)
+            else:
+                changed, latest = self._read(model, '(&{0}({1}>={2}))'.format(
+                    all_filter, orm.TIMESTAMP_ATTRIBUTE, orm.escape_filter_value(since)
+                ))
+            existing = None
+            if scan:
+                existing = set(
+                    orm.normalize_dn(entry.dn)
+                    for entry in model.search_entries(all_filter, retrieve_attributes=['1.1'])
+                )
+
+            with self._lock:
+                entries = self._entries[model]
+                dns = set(entries)
+                for dn, value in changed.items():
+                    if dn not in self._local_writes:
+                        entries[dn] = value
+                if existing is not None:
+                    for dn in set(entries) - existing - self._local_writes:
+                        del entries[dn]
+                if set(entries) != dns:
+                    model._entries_changed()
+                if latest > since:
+                    self._timestamps[model] = latest
+
+        self._context_csn = context_csn
+        if scan:
+            self._scanned_csn = context_csn
+            self._last_scan = time.time()
+            self._scans += 1
+        self._syncs += 1
+        self._last_sync = time.time()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sync()
+            except Exception:
+                logger.exception('Replica sync failed')
+            finally:
+                for connection in set(model._connection for model in self.models):
+                    release = getattr(connection, 'release', None)
+                    if release is not None:
+                        release()
+
+    def start(self):
+        self.load()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='esauth-replica')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        return {
+            'entries': dict((model.__name__, len(self._entries.get(model, ()))) for model in self.models),
+            'syncs': self._syncs,
+            'scans': self._scans,
+            'last_sync': self._last_sync,
+            'last_scan': self._last_scan,
+        }
@@ -28,17 +28,17 @@ class UserListResource(object):
         user = models.User.get(username)
         if not user:
             raise KeyError(username)
+        return self.get_resource(user)
 
+    def __iter__(self):
+        for user in models.User.all():
+            yield self.get_resource(user)
+
+    def get_resource(self, user):
         resource = UserResource(self.request, user)
         resource.__parent__ = self
         return resource
 
-    def __iter__(self):
-        for user in models.User.all():
-            resource = UserResource(self.request, user)
-            resource.__parent__ = self
-            yield resource
-
 
 class GroupResource(object):
 
@@ -65,17 +65,17 @@ class GroupListResource(object):
         group = models.Group.get(name)
         if not group:
             raise KeyError(group)
+        return self.get_resource(group)
 
+    def __iter__(self):
+        for entry in models.Group.all():
+            yield self.get_resource(entry)
+
+    def get_resource(self, group):
         resource = GroupResource(self.request, group)
         resource.__parent__ = self
         return resource
 
-    def __iter__(self):
-        for entry in models.Group.all():
-            resource = GroupResource(self.request, entry)
-            resource.__parent__ = self
-            yield resource
-
 
 class Root(dict):
 
@@ -1,5 +1,7 @@
 
+import os
 import sys
+import gzip
 import string
 import random
 import argparse
@@ -102,3 +104,93 @@ def generate_prod_config():
     print >> sys.stderr, """
 Config file written to {0}
 """.format(args.output_file)
+
+
+def import_entries():
+    parser = argparse.ArgumentParser(description='Import users or groups from LDIF or CSV file.')
+    parser.add_argument('config_uri')
+    parser.add_argument('input_file')
+    parser.add_argument('--type', '-t', choices=['users', 'groups'], default='users')
+    parser.add_argument('--format', '-f', choices=['ldif', 'csv'], help='guessed by file extension by default')
+    parser.add_argument('--workers', '-w', type=int, default=4, help='at most ldap.pool.size')
+    parser.add_argument('--queue-size', type=int, default=1000)
+    parser.add_argument('--checkpoint', help='progress file, default is input file name with .checkpoint suffix')
+    args = parser.parse_args()
+
+    from esauth.main import scripting_boostrap
+    import esauth.models as models
+    import esauth.importer as importer
+
+    input_format = args.format or args.input_file.rsplit('.', 1)[-1].lower()
+    if input_format not in importer.READERS:
+        parser.error('Cannot guess input format, use --format')
+
+    env = scripting_boostrap(args.config_uri, replica=False)
+    # Each worker holds own pooled connection
+    workers = min(args.workers, env['registry']['ldap_pool'].size)
+    if workers < args.workers:
+        print >> sys.stderr, "Using {0} workers, as many as pooled LDAP connections".format(workers)
+    model = {'users': models.User, 'groups': models.Group}[args.type]
+    checkpoint = importer.Checkpoint(
+        args.checkpoint or args.input_file + '.checkpoint',
+        source=os.path.abspath(args.input_file),
+    )
+    entries_importer = importer.Importer(model, checkpoint, workers=workers, queue_size=args.queue_size)
+    try:
+        with open(args.input_file, 'rb') as f:
+            entries_importer.run(importer.READERS[input_format](model, f))
+    except KeyboardInterrupt:
+        print >> sys.stderr, "Interrupted, {0} records processed, run again to resume".format(checkpoint.position)
+        sys.exit(1)
+    except importer.ImportStopped as e:
+        print >> sys.stderr, "Stopped by error: {0}, {1} records processed, run again to resume".format(
+            e, checkpoint.position
+        )
+        sys.exit(1)
+    finally:
+        env['closer']()
+
+    checkpoint.remove()
+    print >> sys.stderr, "{0} imported, {1} failed".format(entries_importer.imported, entries_importer.failed)
+
+
+def export_entries():
+    parser = argparse.ArgumentParser(description='Export users or groups as LDIF, NDJSON or CSV.')
+    parser.add_argument('config_uri')
+    parser.add_argument('--type', '-t', choices=['users', 'groups'], default='users')
+    parser.add_argument('--format', '-f', choices=['ldif', 'ndjson', 'csv'], default='ldif')
+    parser.add_argument('--output-file', '-o', default='-', help='stdout by default')
+    parser.add_argument('--fields', help='comma separated model field names, all exportable fields by default')
+    parser.add_argument('--filter', help='LDAP filter entries should match, e.g. (uid=j*)')
+    parser.add_argument('--gzip', '-z', action='store_true', help='compress output, default for .gz output file')
+    parser.add_argument('--page-size', type=int, default=500)
+    args = parser.parse_args()
+
+    from esauth.main import scripting_boostrap
+    import esauth.models as models
+    import esauth.exporter as exporter
+
+    model = {'users': models.User, 'groups': models.Group}[args.type]
+    allowed = model.export_fields or sorted(model._fields)
+    field_names = [name.strip() for name in (args.fields or '').split(',') if name.strip()] or list(allowed)
+    unknown = [name for name in field_names if name not in allowed]
+    if unknown:
+        parser.error('Unknown fields: {0}'.format(', '.join(unknown)))
+
+    env = scripting_boostrap(args.config_uri, replica=False)
+    model.page_size = args.page_size
+    stream = sys.stdout if args.output_file == '-' else open(args.output_file, 'wb')
+    output = stream
+    try:
+        if args.gzip or args.output_file.endswith('.gz'):
+            output = gzip.GzipFile(fileobj=stream, mode='wb')
+        for chunk in exporter.iter_export(model, args.format, field_names, search_filter=args.filter):
+            output.write(chunk)
+        if output is not stream:
+            # Writes gzip trailer, stream itself is left open
+            output.close()
+        stream.flush()
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+        env['closer']()
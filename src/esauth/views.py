@@ -1,13 +1,54 @@
+import datetime
+import hashlib
 from pyramid.view import view_config, view_defaults, forbidden_view_config
 from pyramid import security
-from pyramid.httpexceptions import HTTPFound
+from pyramid.httpexceptions import HTTPFound, HTTPNotModified, HTTPBadRequest
 from pyramid.traversal import model_path
 from pyramid.decorator import reify
+import esauth.connection
 import esauth.resources as resources
 import esauth.forms as forms
+import esauth.exporter as exporter
 import esauth.models as models
 
 LOGIN_URL = '/login'
+PER_PAGE = 50
+MAX_PER_PAGE = 500
+
+
+def get_directory_validators():
+    """
+        Return ETag and Last-Modified datetime computed from state of user and group entries.
+    """
+    states = [model.get_directory_state() for model in (models.User, models.Group)]
+    etag = hashlib.md5(repr(states)).hexdigest()
+    timestamps = [latest for latest, count in states if latest]
+    last_modified = None
+    if timestamps:
+        # entryCSN starts with modification time
+        last_modified = datetime.datetime.strptime(max(timestamps)[:14], '%Y%m%d%H%M%S')
+    return etag, last_modified
+
+
+def conditional_view(view):
+    """
+        View decorator answering conditional GET with 304 Not Modified when
+        directory did not change, before view is called and template rendered.
+        Pages with pending flash messages are always rendered.
+    """
+    def wrapper(context, request):
+        if request.method != 'GET' or request.session.peek_flash():
+            return view(context, request)
+        etag, last_modified = get_directory_validators()
+        if etag in request.if_none_match:
+            response = HTTPNotModified()
+        else:
+            response = view(context, request)
+        response.etag = etag
+        response.last_modified = last_modified
+        response.cache_control = 'private, no-cache'
+        return response
+    return wrapper
 
 
 class BaseFormView(object):
@@ -25,8 +66,9 @@ class BaseFormView(object):
         return getattr(self, method)()
 
     def get_form_kwargs(self):
+        # Empty POST is still form data, e.g. group with all members unchecked
         return {
-            'formdata': self.request.POST or None,
+            'formdata': self.request.POST if self.request.method == 'POST' else None,
         }
 
     def get_form(self):
@@ -71,9 +113,15 @@ class BaseModelFormView(BaseFormView):
             'msg': self.flash_message.format(**form_data)
         })
 
-    def form_valid(self, form):
-        form.populate_obj(self.model)
+    def populate_model(self, form):
+        forms.populate_model(form, self.model)
+
+    def save_model(self, form):
+        self.populate_model(form)
         self.model.save()
+
+    def form_valid(self, form):
+        self.save_model(form)
         if self.flash_message:
             self.add_message(form.data)
         return super(BaseModelFormView, self).form_valid(form)
@@ -83,7 +131,14 @@ class BaseModelFormView(BaseFormView):
 
 
 class CreateModelFormView(BaseModelFormView):
-    pass
+
+    def form_valid(self, form):
+        try:
+            return super(CreateModelFormView, self).form_valid(form)
+        except esauth.connection.EntryAlreadyExists:
+            # Created elsewhere after form validated
+            form[self.model._primary_field].errors.append(u'Already exists')
+            return self.form_invalid(form)
 
 
 class EditModelFormView(BaseModelFormView):
@@ -116,7 +171,7 @@ class UserCreateFormView(CreateModelFormView):
     flash_message = 'User {username} successfully created!'
 
 
-@view_config(context=resources.UserResource, renderer='user/form.jinja2', name='edit')
+@view_config(context=resources.UserResource, renderer='user/form.jinja2', name='edit', decorator=conditional_view)
 class UserEditFormView(EditModelFormView):
     form_class = forms.UserForm
     model_class = models.User
@@ -125,8 +180,14 @@ class UserEditFormView(EditModelFormView):
     def get_form(self):
         form = super(UserEditFormView, self).get_form()
         del form.username
+        groups = self.context.__parent__.__parent__['groups']
+        self.response['groups'] = [groups.get_resource(group) for group in self.model.groups]
         return form
 
+    def get(self):
+        self.get_form()
+        return self.response
+
     def get_success_url(self):
         return model_path(self.context.__parent__)
 
@@ -139,13 +200,11 @@ class GroupAddView(CreateModelFormView):
 
     def get_form(self):
         form = super(GroupAddView, self).get_form()
-        form.members.choices = []
-        for user in models.User.all():
-            form.members.choices.append((user.get_dn(), user.username))
+        form.members.choices = list(models.User.get_choices())
         return form
 
 
-@view_config(context=resources.GroupResource, renderer='group/form.jinja2', name='edit')
+@view_config(context=resources.GroupResource, renderer='group/form.jinja2', name='edit', decorator=conditional_view)
 class GroupEditView(GroupAddView):
 
     flash_message = 'Group successfully updated!'
@@ -155,6 +214,12 @@ class GroupEditView(GroupAddView):
         del form.name
         return form
 
+    def save_model(self, form):
+        # Send only membership changes, groups may have many thousands of members
+        current = set(self.model.members)
+        submitted = set(form.members.data or [])
+        self.model.update_members(add=submitted - current, remove=current - submitted)
+
     def get_success_url(self):
         return model_path(self.context.__parent__)
 
@@ -169,23 +234,146 @@ class UserRemoveView(RemoveModelFormView):
     flash_message = 'User successfully removed!'
 
 
-@view_config(context=resources.Root, renderer='base_with_menu.jinja2')
-def dashboard_view(context, request):  # pragma: no cover
-    return {}
+@view_config(context=resources.Root, renderer='dashboard.jinja2')
+def dashboard_view(context, request):
+    return {
+        'counts': models.get_counts(),
+    }
 
 
-@view_config(context=resources.UserListResource, renderer='user/list.jinja2')
-def users_list_view(context, request):
+@view_config(context=resources.Root, name='stats', renderer='json')
+def stats_view(context, request):
+    stats = {
+        'ldap_pool': request.registry['ldap_pool'].stats(),
+        'ldap_cache': request.registry['ldap_cache'].stats(),
+        'ldap_missing_cache': request.registry['ldap_missing_cache'].stats(),
+    }
+    if request.registry.get('ldap_read_pools'):
+        stats['ldap_read_pools'] = [pool.stats() for pool in request.registry['ldap_read_pools']]
+        stats['ldap_routing'] = request.registry['ldap_connection'].stats()
+    if 'ldap_replica' in request.registry:
+        stats['ldap_replica'] = request.registry['ldap_replica'].stats()
+    return stats
+
+
+@view_config(context=resources.UserListResource, name='exists', renderer='json')
+def user_exists_view(context, request):
+    username = request.GET.get('username')
+    return {'exists': bool(username) and models.User.exists(username)}
+
+
+@view_config(context=resources.GroupListResource, name='exists', renderer='json')
+def group_exists_view(context, request):
+    name = request.GET.get('name')
+    return {'exists': bool(name) and models.Group.exists(name)}
+
+
+def get_int_param(request, name, default, max_value=None):
+    try:
+        value = int(request.GET.get(name, default))
+    except ValueError:
+        return default
+    if value < 1:
+        return default
+    if max_value is not None:
+        value = min(value, max_value)
+    return value
+
+
+def get_list_page(context, request, model, sort_fields, default_sort):
+    """
+        Return template values for paginated, sorted and searchable list of models.
+    """
+    sort = request.GET.get('sort', default_sort)
+    if sort.lstrip('-') not in sort_fields:
+        sort = default_sort
+    q = request.GET.get('q', '').strip()
+    per_page = get_int_param(request, 'per_page', PER_PAGE, MAX_PER_PAGE)
+
+    query = model.query().order_by(sort)
+    if q:
+        query = query.contains_any(q, *model.search_fields)
+    page = query.paginate(get_int_param(request, 'page', 1), per_page)
     return {
-        'users': context,
+        'page': page,
+        'items': [context.get_resource(obj) for obj in page],
+        'list_params': {'sort': sort, 'q': q, 'per_page': per_page},
     }
 
 
-@view_config(context=resources.GroupListResource, renderer='group/list.jinja2')
+def get_export_fields(request, model):
+    """
+        Return model field names requested by ?fields=a,b, all allowed fields by default.
+    """
+    allowed = model.export_fields or sorted(model._fields)
+    requested = [name.strip() for name in request.GET.get('fields', '').split(',') if name.strip()]
+    if not requested:
+        return list(allowed)
+    unknown = [name for name in requested if name not in allowed]
+    if unknown:
+        raise HTTPBadRequest('Unknown fields: {0}'.format(', '.join(unknown)))
+    return requested
+
+
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', exporter.iter_ndjson),
+    'csv': ('text/csv', exporter.iter_csv),
+}
+
+
+def export_view(context, request, model):
+    """
+        Stream entries as NDJSON (?format=ndjson, default) or CSV (?format=csv).
+
+        Only requested attributes are retrieved and entries are read page by
+        page as response is written, so memory use does not depend on
+        number of entries.
+    """
+    export_format = request.GET.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPBadRequest('Unknown format: {0}'.format(export_format))
+    content_type, serializer = EXPORT_FORMATS[export_format]
+    field_names = get_export_fields(request, model)
+    connection = request.registry['ldap_connection']
+
+    def iter_rows():
+        try:
+            for obj in model.query().only(*field_names):
+                yield obj.get_plain_values(field_names)
+        finally:
+            # Response is written after request finished, so release connection again
+            connection.release()
+
+    response = request.response
+    response.content_type = content_type
+    response.charset = 'utf-8'
+    response.content_disposition = 'attachment; filename="{0}.{1}"'.format(context.__name__, export_format)
+    response.app_iter = serializer(iter_rows(), field_names)
+    return response
+
+
+@view_config(context=resources.UserListResource, name='export')
+def users_export_view(context, request):
+    return export_view(context, request, models.User)
+
+
+@view_config(context=resources.GroupListResource, name='export')
+def groups_export_view(context, request):
+    return export_view(context, request, models.Group)
+
+
+@view_config(context=resources.UserListResource, renderer='user/list.jinja2', decorator=conditional_view)
+def users_list_view(context, request):
+    response = get_list_page(context, request, models.User, ('username', 'first_name', 'last_name'), 'username')
+    response['users'] = context
+    return response
+
+
+@view_config(context=resources.GroupListResource, renderer='group/list.jinja2', decorator=conditional_view)
 def group_list_view(context, request):
-    return {
-        'groups': context,
-    }
+    response = get_list_page(context, request, models.Group, ('name',), 'name')
+    response['groups'] = context
+    return response
 
 
 @forbidden_view_config(renderer='403.jinja2')
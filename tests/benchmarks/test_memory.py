@@ -0,0 +1,58 @@
+import sys
+import logging
+import esauth.models as models
+import tests.unit.base as base
+
+logger = logging.getLogger(__name__)
+
+
+class DictBackedUser(object):
+
+    """
+        Same values as User stored in instance __dict__, as models did before.
+        Decoded values were not kept then, so only raw values and saved state are stored.
+    """
+
+    def __init__(self, user):
+        for field in user._fields.values():
+            setattr(self, field._value_key, field._get_value(user, raw=True))
+        self._saved_state = user._saved_state
+
+
+def instance_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+class UserMemoryBenchmark(base.UnitTestCase):
+
+    """
+        Bytes per User instance, not counting attribute values themselves.
+        Sizes are logged, run nosetests with --nologcapture to see them.
+    """
+
+    def make_user(self):
+        user = models.User(
+            username={u'john'},
+            first_name={u'John'},
+            last_name={u'Smith'},
+            uid_number=10000,
+            gid_number=10000,
+            home_directory={u'/home/john'},
+            login_shell={u'/bin/bash'},
+        )
+        user.username
+        user.full_name
+        return user
+
+    def test_no_instance_dict(self):
+        self.assertFalse(hasattr(self.make_user(), '__dict__'))
+
+    def test_bytes_per_user(self):
+        user = self.make_user()
+        slots_size = instance_size(user)
+        dict_size = instance_size(DictBackedUser(user))
+        logger.info('User: %d bytes with __dict__, %d bytes with __slots__', dict_size, slots_size)
+        self.assertLess(slots_size, dict_size)
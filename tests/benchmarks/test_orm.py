@@ -0,0 +1,34 @@
+import timeit
+import logging
+import esauth.models as models
+import tests.unit.base as base
+
+logger = logging.getLogger(__name__)
+
+
+class AttributeAccessBenchmark(base.UnitTestCase):
+
+    """
+        Micro-benchmark of model attribute access.
+        Timings are logged, run nosetests with --nologcapture to see them.
+    """
+
+    number = 100000
+
+    def report(self, name, elapsed):
+        logger.info('%s: %.3f usec per access', name, elapsed * 1000000 / self.number)
+
+    def test_user_single_value_field(self):
+        user = models.User(username={u'john'}, first_name={u'John'}, last_name={u'Smith'})
+        elapsed = timeit.timeit(lambda: user.username, number=self.number)
+        self.report('User.username', elapsed)
+
+    def test_user_multi_value_field(self):
+        user = models.User(username={u'john'}, uid_number=10000)
+        elapsed = timeit.timeit(lambda: user.uid_number, number=self.number)
+        self.report('User.uid_number', elapsed)
+
+    def test_user_full_name(self):
+        user = models.User(username={u'john'}, first_name={u'John'}, last_name={u'Smith'})
+        elapsed = timeit.timeit(lambda: user.full_name, number=self.number)
+        self.report('User.full_name', elapsed)
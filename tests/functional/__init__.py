@@ -7,6 +7,17 @@ import subprocess as sp
 
 CONFIG_DIR_PATH = os.path.join(os.path.dirname(__file__), 'test_server_conf/')
 SLAPD_ERR_LOG = '/tmp/esauth-test-slapd.log'
+SLAPD_DATA_DIRS = ['/tmp/esauth-test-slapd-data', '/tmp/esauth-test-slapd-nosort']
+# Included by slapd.conf, written by TestLDAPServer.start()
+SLAPD_MODULES_CONF = '/tmp/esauth-test-slapd-modules.conf'
+# Usual locations of slapd modules, ESAUTH_TEST_SLAPD_MODULEPATH overrides them
+SLAPD_MODULE_DIRS = [
+    '/usr/lib/ldap',
+    '/usr/lib/openldap',
+    '/usr/lib64/openldap',
+    '/usr/libexec/openldap',
+    '/usr/local/libexec/openldap',
+]
 logger = logging.getLogger(__name__)
 
 LDAP_INIT_DATA = """
@@ -23,9 +34,31 @@ objectClass: organizationalRole
 cn: admin
 description: LDAP administrator
 userPassword:: e1NTSEF9SU1nWldWb1REZnV0RS9uZi9wWnh2K1dvUVlRS256V08=
+
+dn: dc=nosort,dc=com
+objectClass: top
+objectClass: dcObject
+objectClass: organization
+dc: nosort
+o: No server side sorting
 """
 
 
+def get_modules_conf():
+    """
+        Return slapd.conf lines loading sssvlv overlay module, empty if
+        module is not found, e.g. as overlay is built into slapd.
+    """
+    module_dirs = SLAPD_MODULE_DIRS
+    if os.environ.get('ESAUTH_TEST_SLAPD_MODULEPATH'):
+        module_dirs = [os.environ['ESAUTH_TEST_SLAPD_MODULEPATH']]
+    for module_dir in module_dirs:
+        for name in ('sssvlv.la', 'sssvlv.so'):
+            if os.path.exists(os.path.join(module_dir, name)):
+                return 'modulepath\t{0}\nmoduleload\t{1}\n'.format(module_dir, name)
+    return ''
+
+
 class TestServerError(Exception):
     pass
 
@@ -33,8 +66,11 @@ class TestServerError(Exception):
 class TestLDAPServer(object):
 
     def start(self):
-        if not os.path.isdir("/tmp/esauth-test-slapd-data"):
-            os.makedirs('/tmp/esauth-test-slapd-data')
+        for data_dir in SLAPD_DATA_DIRS:
+            if not os.path.isdir(data_dir):
+                os.makedirs(data_dir)
+        with open(SLAPD_MODULES_CONF, 'w') as f:
+            f.write(get_modules_conf())
 
         cmd = ['slapd', '-h', 'ldap://localhost:3389', '-f', 'slapd.conf', '-d3']
         self.proc = sp.Popen(cmd, cwd=CONFIG_DIR_PATH, stdout=open(SLAPD_ERR_LOG, 'w'), stderr=sp.STDOUT)
@@ -47,8 +83,9 @@ class TestLDAPServer(object):
         self.proc.terminate()
         self.proc.wait()
         logger.info('Test LDAP server stopped')
-        if os.path.isdir('/tmp/esauth-test-slapd-data'):
-            shutil.rmtree('/tmp/esauth-test-slapd-data')
+        for data_dir in SLAPD_DATA_DIRS:
+            if os.path.isdir(data_dir):
+                shutil.rmtree(data_dir)
 
     def add(self, data):
         cmd = ['ldapadd', '-w', 'admin', '-D', "cn=admin,dc=test,dc=com", '-H', 'ldap://localhost:3389']
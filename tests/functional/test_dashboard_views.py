@@ -0,0 +1,26 @@
+import esauth.models as models
+import tests.functional.base as base
+
+
+class DashboardViewTestCase(base.FunctionalBaseTestCase):
+
+    def setUp(self):
+        super(DashboardViewTestCase, self).setUp()
+        self.app.login(userid=1)
+
+    def test_counts(self):
+        user = models.User(username='one', first_name='one', last_name='one')
+        user.save()
+        models.User(username='two', first_name='two', last_name='two', uid_number=10001,
+                    gid_number=10001, home_directory='/home/two', login_shell='/bin/sh').save()
+        models.Group(name='admins', members=[user.get_dn()]).save()
+        models.Group(name='empty').save()
+
+        ret = self.app.get('/', status=200)
+
+        self.assertEqual(ret.view_return['counts'], {
+            'users': 2,
+            'posix_accounts': 1,
+            'groups': 2,
+            'empty_groups': 1,
+        })
@@ -0,0 +1,26 @@
+import json
+import esauth.models as models
+import esauth.exporter as exporter
+import tests.functional.base as base
+
+
+class ExporterTestCase(base.FunctionalBaseTestCase):
+
+    def setUp(self):
+        super(ExporterTestCase, self).setUp()
+        models.User(username='john', first_name='John', last_name='Smith').save()
+        models.User(username='jane', first_name='Jane', last_name='Doe').save()
+
+    def test_ndjson_with_filter(self):
+        chunks = exporter.iter_export(models.User, 'ndjson', ['username', 'last_name'], search_filter='uid=john')
+        self.assertEqual([json.loads(chunk) for chunk in chunks], [{'username': 'john', 'last_name': 'Smith'}])
+
+    def test_ldif(self):
+        ldif = ''.join(exporter.iter_export(models.User, 'ldif', ['username'], search_filter='(uid=jane)'))
+        self.assertEqual(ldif, (
+            'dn: uid=jane,ou=users,dc=test,dc=com\n'
+            'objectClass: inetOrgPerson\n'
+            'objectClass: top\n'
+            'uid: jane\n'
+            '\n'
+        ))
@@ -51,6 +51,15 @@ class GroupViewsTestCase(base.FunctionalBaseTestCase):
         group.refresh()
         self.assertEqual(group.members, [u2.get_dn()])
 
+    def test_group_edit_post_remove_all_members(self):
+        u1 = models.User(username='user1', first_name='hello', last_name='hello')
+        u1.save()
+        group = models.Group(name='one', members=[u1.get_dn()])
+        group.save()
+        self.app.post('/groups/one/edit', status=302, params={})
+        group.refresh()
+        self.assertEqual(group.members, [])
+
     def test_group_remove_get(self):
         group = models.Group(name='one')
         group.save()
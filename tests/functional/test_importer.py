@@ -0,0 +1,62 @@
+import esauth.models as models
+import esauth.importer as importer
+import esauth.exporter as exporter
+import tests.functional.base as base
+
+
+class ImporterTestCase(base.FunctionalBaseTestCase):
+
+    def run_import(self, model, lines, start=0):
+        checkpoint = importer.Checkpoint(None, 'input')
+        checkpoint.position = start
+        unit = importer.Importer(model, checkpoint, workers=2, queue_size=2)
+        unit.run(importer.iter_csv_records(lines))
+        return unit
+
+    def test_import_users(self):
+        unit = self.run_import(models.User, [
+            'username,first_name,last_name,password\n',
+            'one,One,One,secret\n',
+            'two,Two,Two,\n',
+            'x,Bad,Bad,\n',
+            'one,Again,Again,\n',
+        ])
+        self.assertEqual((unit.imported, unit.failed), (2, 2))
+        self.assertEqual(unit.checkpoint.position, 4)
+        self.assertEqual(sorted(user.username for user in models.User.all()), ['one', 'two'])
+
+    def test_import_groups_members_by_username_or_dn(self):
+        models.User(username='one', first_name='one', last_name='one').save()
+        models.User(username='two', first_name='two', last_name='two').save()
+        unit = self.run_import(models.Group, [
+            'name,members\n',
+            'staff,one;UID=two,ou=users,dc=test,dc=com\n',
+        ])
+        self.assertEqual(unit.imported, 1)
+        self.assertEqual(sorted(models.Group.get('staff').members), [
+            'uid=one,ou=users,dc=test,dc=com', 'uid=two,ou=users,dc=test,dc=com',
+        ])
+
+    def test_resume_skips_processed(self):
+        unit = self.run_import(models.User, [
+            'username,first_name,last_name\n',
+            'one,One,One\n',
+            'two,Two,Two\n',
+        ], start=1)
+        self.assertEqual(unit.imported, 1)
+        self.assertEqual([user.username for user in models.User.all()], ['two'])
+
+    def test_exported_ldif_imported(self):
+        models.User(username='one', first_name='one', last_name='one').save()
+        models.Group(name='empty', members=[]).save()
+        models.Group(name='staff', members=['uid=one,ou=users,dc=test,dc=com']).save()
+        ldif = ''.join(exporter.iter_export(models.Group, 'ldif', ['name', 'members']))
+        for group in list(models.Group.all()):
+            group.remove()
+
+        unit = importer.Importer(models.Group, importer.Checkpoint(None, 'input'), workers=2)
+        unit.run(importer.READERS['ldif'](models.Group, ldif.splitlines(True)))
+
+        self.assertEqual((unit.imported, unit.failed), (2, 0))
+        self.assertEqual(list(models.Group.get('empty').members), [])
+        self.assertEqual(list(models.Group.get('staff').members), ['uid=one,ou=users,dc=test,dc=com'])
@@ -0,0 +1,38 @@
+import esauth.main
+import esauth.models as models
+from tests.functional import server
+import tests.functional.base as base
+
+
+class ReadRoutingTestCase(base.FunctionalBaseTestCase):
+
+    def setUp(self):
+        server.add(base.LDAP_ROOTS)
+        self.app = base.PyramidTestApp(esauth.main.make_app({
+            'debug': 'true',
+            'ldap.users_base': 'ou=users,dc=test,dc=com',
+            'ldap.groups_base': 'ou=groups,dc=test,dc=com',
+            'ldap.bind_dn': 'cn=admin,dc=test,dc=com',
+            'ldap.bind_password': 'admin',
+            'ldap.uri': 'ldap://localhost:3389',
+            'ldap.read_uris': 'ldap://localhost:3389\nldap://127.0.0.1:3389',
+            'ldap.read.sticky_interval': '0',
+        }))
+        self.app.login(userid=1)
+
+    def test_reads_go_to_consumers(self):
+        models.User(username='one', first_name='one', last_name='one').save()
+        # Reads of this thread stay on provider after write until release
+        models.User._connection.release()
+        self.app.get('/users', status=200)
+        stats = self.app.get('/stats', status=200).json
+        self.assertGreater(stats['ldap_routing']['consumer_reads'], 0)
+        self.assertEqual(len(stats['ldap_read_pools']), 2)
+
+    def test_read_after_write_in_request(self):
+        self.app.post('/users/add', status=302, params={
+            'username': 'two',
+            'first_name': 'two',
+            'last_name': 'two',
+        })
+        self.assertEqual(models.User.get('two').last_name, 'two')
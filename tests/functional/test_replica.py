@@ -0,0 +1,73 @@
+import mock
+import esauth.orm as orm
+import esauth.models as models
+import esauth.replica as replica
+from tests.functional import server
+import tests.functional.base as base
+
+USER_LDIF = """
+dn: uid={0},ou=users,dc=test,dc=com
+objectClass: top
+objectClass: inetOrgPerson
+uid: {0}
+cn: {0} {0}
+givenName: {0}
+sn: {0}
+"""
+
+
+class ReplicaTestCase(base.FunctionalBaseTestCase):
+
+    def setUp(self):
+        super(ReplicaTestCase, self).setUp()
+        server.add(USER_LDIF.format('first'))
+        self.unit = replica.Replica([models.User, models.Group])
+        self.unit.load()
+        orm.Base._replica = self.unit
+
+    def tearDown(self):
+        orm.Base._replica = None
+        super(ReplicaTestCase, self).tearDown()
+
+    def test_reads_served_from_memory(self):
+        with mock.patch.object(orm.Base, '_connection') as connection:
+            user = models.User.get('first')
+            users = list(models.User.all())
+            self.assertIsNone(models.User.get('missing'))
+            self.assertIsNone(models.Group.get('missing'))
+        self.assertEqual(connection.mock_calls, [])
+        self.assertEqual(user.last_name, 'first')
+        self.assertEqual([u.username for u in users], ['first'])
+
+    def test_sync_applies_server_changes(self):
+        server.add(USER_LDIF.format('second'))
+        server.delete('uid=first,ou=users,dc=test,dc=com')
+        self.assertIsNotNone(models.User.get('first'))
+        self.unit.sync()
+        self.assertIsNone(models.User.get('first'))
+        self.assertEqual(models.User.get('second').first_name, 'second')
+
+    def test_deleted_found_every_scan_interval(self):
+        self.unit.scan_interval = 300
+        server.delete('uid=first,ou=users,dc=test,dc=com')
+        self.unit.sync()
+        self.assertIsNotNone(models.User.get('first'))
+        self.unit._last_scan -= 300
+        self.unit.sync()
+        self.assertIsNone(models.User.get('first'))
+        self.assertEqual(self.unit.stats()['scans'], 1)
+
+    def test_orm_writes_applied(self):
+        group = models.Group(name='admins', members=['uid=first,ou=users,dc=test,dc=com'])
+        group.save()
+        self.assertEqual(models.Group.get('admins').members, ['uid=first,ou=users,dc=test,dc=com'])
+        models.User.get('first').remove()
+        self.assertIsNone(models.User.get('first'))
+        self.assertEqual(models.Group.get('admins').members, [])
+
+    def test_write_during_iteration(self):
+        users = self.unit.all(models.User)
+        self.assertEqual(next(users).username, 'first')
+        models.User.get('first').remove()
+        self.assertEqual(list(users), [])
+        self.assertEqual(self.unit.stats()['entries']['User'], 0)
@@ -0,0 +1,57 @@
+import esauth.models as models
+from tests.functional import server
+import tests.functional.base as base
+
+SITE_LDIF = """
+dn: ou=site2,dc=test,dc=com
+objectClass: organizationalUnit
+objectClass: top
+ou: site2
+
+dn: uid=remote,ou=site2,dc=test,dc=com
+objectClass: top
+objectClass: inetOrgPerson
+uid: remote
+cn: remote remote
+givenName: remote
+sn: remote
+"""
+
+
+class SearchBasesTestCase(base.FunctionalBaseTestCase):
+
+    def setUp(self):
+        super(SearchBasesTestCase, self).setUp()
+        server.add(SITE_LDIF)
+        models.User.search_bases = ['ou=users,dc=test,dc=com', 'ou=site2,dc=test,dc=com']
+        models.User(username='local', first_name='local', last_name='local').save()
+
+    def tearDown(self):
+        models.User.search_bases = None
+        server.delete('ou=site2,dc=test,dc=com')
+        super(SearchBasesTestCase, self).tearDown()
+
+    def test_all_merges_bases(self):
+        self.assertEqual(sorted(user.username for user in models.User.all()), ['local', 'remote'])
+
+    def test_get_by_primary_key_and_dn(self):
+        user = models.User.get('remote')
+        self.assertEqual(user.get_dn(), 'uid=remote,ou=site2,dc=test,dc=com')
+        self.assertEqual(models.User.get('uid=remote,ou=site2,dc=test,dc=com').username, 'remote')
+        self.assertIsNone(models.User.get('missing'))
+        self.assertTrue(models.User.exists('remote'))
+        self.assertFalse(models.User.exists('missing'))
+
+    def test_save_loaded_from_other_base(self):
+        user = models.User.get('remote')
+        user.last_name = 'changed'
+        user.save()
+        self.assertEqual(models.User.get('uid=remote,ou=site2,dc=test,dc=com').last_name, 'changed')
+
+    def test_group_members_from_several_bases(self):
+        group = models.Group(name='all', members=[
+            'uid=local,ou=users,dc=test,dc=com',
+            'uid=remote,ou=site2,dc=test,dc=com',
+            'uid=missing,ou=site2,dc=test,dc=com',
+        ])
+        self.assertEqual(len(group.members), 2)
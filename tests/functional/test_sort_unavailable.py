@@ -0,0 +1,47 @@
+import mock
+import ldapom
+import esauth.connection
+import esauth.models as models
+from tests.functional import server
+import tests.functional.base as base
+
+NOSORT_LDIF = """
+dn: ou=users,dc=nosort,dc=com
+objectClass: organizationalUnit
+objectClass: top
+ou: users
+"""
+
+
+class SortUnavailableTestCase(base.FunctionalBaseTestCase):
+
+    """
+        Users under database without sssvlv overlay, see slapd.conf.
+    """
+
+    def setUp(self):
+        super(SortUnavailableTestCase, self).setUp()
+        server.add(NOSORT_LDIF)
+        self.base_dn = models.User.base_dn
+        models.User.base_dn = 'ou=users,dc=nosort,dc=com'
+        for username in ('carol', 'alice', 'bob'):
+            models.User(username=username, first_name=username, last_name='x').save()
+
+    def tearDown(self):
+        models.User.base_dn = self.base_dn
+        server.delete('ou=users,dc=nosort,dc=com')
+        super(SortUnavailableTestCase, self).tearDown()
+
+    def test_sorted_search_rejected(self):
+        with self.assertRaises(esauth.connection.SortUnavailable):
+            esauth.connection.sorted_search(
+                models.User._connection, '(objectClass=inetOrgPerson)', 'ou=users,dc=nosort,dc=com',
+                'uid:caseIgnoreOrderingMatch', 1, 2, scope=ldapom.LDAP_SCOPE_SUBTREE,
+            )
+
+    def test_paginate_sorted_locally(self):
+        with mock.patch('esauth.connection.sorted_search', wraps=esauth.connection.sorted_search) as sorted_search:
+            page = models.User.query().order_by('-username').paginate(2, 2)
+        self.assertTrue(sorted_search.called)
+        self.assertEqual(page.total, 3)
+        self.assertEqual([user.username for user in page.items], ['alice'])
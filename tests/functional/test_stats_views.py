@@ -0,0 +1,14 @@
+import tests.functional.base as base
+
+
+class StatsViewTestCase(base.FunctionalBaseTestCase):
+
+    def setUp(self):
+        super(StatsViewTestCase, self).setUp()
+        self.app.login(userid=1)
+
+    def test_stats(self):
+        ret = self.app.get('/stats', status=200)
+        self.assertIn('ldap_pool', ret.json)
+        self.assertEqual(ret.json['ldap_pool']['in_use'], 0)
+        self.assertIn('hits', ret.json['ldap_cache'])
@@ -1,3 +1,5 @@
+import json
+import mock
 import esauth.models as models
 import esauth.resources as resources
 import tests.functional.base as base
@@ -17,6 +19,65 @@ class UserViewsTestCase(base.FunctionalBaseTestCase):
         ret = self.app.get('/users', status=200)
         self.assertIsInstance(ret.view_context, resources.UserListResource)
 
+    def test_user_list_paginated(self):
+        for username in ('carol', 'alice', 'bob'):
+            models.User(username=username, first_name=username, last_name='x').save()
+        ret = self.app.get('/users?per_page=2&page=2&sort=-username', status=200)
+        self.assertEqual([user.model.username for user in ret.view_return['items']], ['alice'])
+        self.assertEqual(ret.view_return['page'].pages, 2)
+
+        ret = self.app.get('/users?q=BO&sort=unknown', status=200)
+        self.assertEqual([user.model.username for user in ret.view_return['items']], ['bob'])
+        self.assertEqual(ret.view_return['list_params']['sort'], 'username')
+
+    def test_user_list_sorted_on_server(self):
+        for username in ('carol', 'alice', 'bob'):
+            models.User(username=username, first_name=username, last_name='x').save()
+        with mock.patch('esauth.models.User.search_entries') as search_entries:
+            ret = self.app.get('/users?per_page=2&page=2&sort=-username', status=200)
+        self.assertFalse(search_entries.called)
+        self.assertEqual([user.model.username for user in ret.view_return['items']], ['alice'])
+
+    def test_user_list_not_modified(self):
+        models.User(username='hello', first_name='hello', last_name='hello').save()
+        etag = self.app.get('/users', status=200).headers['ETag']
+
+        ret = self.app.get('/users', headers={'If-None-Match': etag}, status=304)
+        self.assertFalse(hasattr(ret, 'renderer_name'))
+        self.assertEqual(ret.headers['ETag'], etag)
+
+        models.User.get('hello').remove()
+        ret = self.app.get('/users', headers={'If-None-Match': etag}, status=200)
+        self.assertNotEqual(ret.headers['ETag'], etag)
+
+    def test_user_list_etag_changes_within_second(self):
+        models.User(username='hello', first_name='hello', last_name='hello').save()
+        etags = set()
+        for last_name in ('one', 'two', 'three'):
+            user = models.User.get('hello')
+            user.last_name = last_name
+            user.save()
+            etags.add(self.app.get('/users', status=200).headers['ETag'])
+        self.assertEqual(len(etags), 3)
+
+    def test_user_export_ndjson(self):
+        models.User(username='hello', first_name='hello', last_name='world', password='secret').save()
+        ret = self.app.get('/users/export?fields=username,last_name', status=200)
+        self.assertEqual(ret.content_type, 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in ret.body.splitlines()], [
+            {'username': 'hello', 'last_name': 'world'},
+        ])
+
+    def test_user_export_csv(self):
+        models.User(username='hello', first_name='hello', last_name='world', password='secret').save()
+        ret = self.app.get('/users/export?format=csv', status=200)
+        self.assertEqual(ret.content_type, 'text/csv')
+        self.assertEqual(ret.body.splitlines()[1], 'hello,hello,world,,,,,')
+        self.assertNotIn('secret', ret.body)
+
+    def test_user_export_unknown_field(self):
+        self.app.get('/users/export?fields=password', status=400)
+
     def test_user_create_get_form(self):
         self.app.get('/users/add', status=200)
 
@@ -81,6 +142,20 @@ class UserViewsTestCase(base.FunctionalBaseTestCase):
         ret = self.app.get('/users/hello/edit', status=200)
         self.assertIsInstance(ret.view_context, resources.UserResource)
 
+    def test_user_exists_view(self):
+        models.User(username='hello', first_name='hello', last_name='hello').save()
+        self.assertEqual(self.app.get('/users/exists?username=hello', status=200).json, {'exists': True})
+        self.assertEqual(self.app.get('/users/exists?username=nobody', status=200).json, {'exists': False})
+
+    def test_user_edit_shows_groups(self):
+        user = models.User(username='hello', first_name='hello', last_name='hello')
+        user.save()
+        models.Group(name='admins', members=[user.get_dn()]).save()
+        models.Group(name='others', members=[]).save()
+        ret = self.app.get('/users/hello/edit', status=200)
+        self.assertEqual([group.model.name for group in ret.view_return['groups']], ['admins'])
+        self.assertIn('/groups/admins/edit', ret)
+
     def test_user_edit_save(self):
         user = models.User(username='hello', first_name='hello', last_name='hello')
         user.save()
@@ -0,0 +1,41 @@
+import mock
+import esauth.cache as cache
+import tests.unit.base as base
+
+
+class LRUCacheTestCase(base.UnitTestCase):
+
+    def setUp(self):
+        self.clock = mock.Mock(return_value=100)
+        self.unit = cache.LRUCache(max_size=2, ttl=10, clock=self.clock)
+
+    def test_get_set(self):
+        self.assertIsNone(self.unit.get('a'))
+        self.unit.set('a', 1)
+        self.assertEqual(self.unit.get('a'), 1)
+        stats = self.unit.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_expiration(self):
+        self.unit.set('a', 1)
+        self.clock.return_value = 110
+        self.assertIsNone(self.unit.get('a'))
+        self.assertEqual(self.unit.stats()['expirations'], 1)
+        self.assertEqual(self.unit.stats()['size'], 0)
+
+    def test_least_recently_used_evicted(self):
+        self.unit.set('a', 1)
+        self.unit.set('b', 2)
+        self.unit.get('a')
+        self.unit.set('c', 3)
+        self.assertIsNone(self.unit.get('b'))
+        self.assertEqual(self.unit.get('a'), 1)
+        self.assertEqual(self.unit.get('c'), 3)
+        self.assertEqual(self.unit.stats()['evictions'], 1)
+
+    def test_delete(self):
+        self.unit.set('a', 1)
+        self.unit.delete('a')
+        self.unit.delete('missing')
+        self.assertIsNone(self.unit.get('a'))
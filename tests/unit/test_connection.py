@@ -0,0 +1,276 @@
+import threading
+import mock
+import ldapom
+import esauth.connection as connection
+import tests.unit.base as base
+
+
+class ConnectionPoolTestCase(base.UnitTestCase):
+
+    def setUp(self):
+        self.factory = mock.Mock(side_effect=lambda: mock.Mock())
+        self.health_check = mock.Mock(return_value=True)
+        self.close = mock.Mock()
+        self.unit = connection.ConnectionPool(
+            self.factory, size=2, timeout=0.01, health_check=self.health_check, close=self.close
+        )
+
+    def test_checkout_creates_lazily(self):
+        self.assertEqual(self.factory.call_count, 0)
+        self.unit.checkout()
+        self.assertEqual(self.factory.call_count, 1)
+
+    def test_checkin_reuses(self):
+        conn = self.unit.checkout()
+        self.unit.checkin(conn)
+        self.assertIs(self.unit.checkout(), conn)
+        self.assertEqual(self.factory.call_count, 1)
+
+    def test_timeout(self):
+        self.unit.checkout()
+        self.unit.checkout()
+        with self.assertRaises(connection.PoolTimeout):
+            self.unit.checkout()
+        self.assertEqual(self.unit.stats()['timeouts'], 1)
+
+    def test_stats(self):
+        conn = self.unit.checkout()
+        self.unit.checkout()
+        self.unit.checkin(conn)
+        stats = self.unit.stats()
+        self.assertEqual(stats['in_use'], 1)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['creations'], 2)
+        self.assertEqual(stats['checkouts'], 2)
+
+    def test_health_check_after_idle(self):
+        self.unit.check_interval = 0
+        self.health_check.return_value = False
+        conn = self.unit.checkout()
+        self.unit.checkin(conn)
+
+        new_conn = self.unit.checkout()
+
+        self.health_check.assert_called_with(conn)
+        self.assertIsNot(new_conn, conn)
+        self.close.assert_called_once_with(conn)
+        self.assertEqual(self.unit.stats()['discards'], 1)
+        self.assertEqual(self.unit.stats()['total'], 1)
+
+    def test_max_lifetime(self):
+        self.unit.max_lifetime = -1
+        conn = self.unit.checkout()
+        self.unit.checkin(conn)
+        self.assertEqual(self.unit.stats()['total'], 0)
+        self.close.assert_called_once_with(conn)
+        self.assertIsNot(self.unit.checkout(), conn)
+
+    def test_checkin_discard(self):
+        conn = self.unit.checkout()
+        self.unit.checkin(conn, discard=True)
+        self.close.assert_called_once_with(conn)
+        self.assertEqual(self.unit.stats()['total'], 0)
+        self.assertIsNot(self.unit.checkout(), conn)
+
+    def test_close_error_ignored(self):
+        self.unit.max_lifetime = -1
+        self.close.side_effect = ValueError()
+        self.unit.checkin(self.unit.checkout())
+        self.assertEqual(self.unit.stats()['discards'], 1)
+
+    @mock.patch('esauth.connection.get_ext_handle')
+    @mock.patch('esauth.connection.get_ldap_ext')
+    def test_close_connection_unbinds(self, get_ldap_ext, get_ext_handle):
+        ext_ffi, lib = mock.Mock(), mock.Mock()
+        get_ldap_ext.return_value = ext_ffi, lib
+        conn = mock.Mock()
+        connection.close_connection(conn)
+        get_ext_handle.assert_called_with(ext_ffi, conn)
+        lib.ldap_unbind_ext_s.assert_called_once_with(get_ext_handle.return_value, ext_ffi.NULL, ext_ffi.NULL)
+
+    def test_factory_error_frees_slot(self):
+        self.factory.side_effect = ValueError()
+        with self.assertRaises(ValueError):
+            self.unit.checkout()
+        self.assertEqual(self.unit.stats()['total'], 0)
+        self.assertEqual(self.unit.stats()['in_use'], 0)
+
+
+class ThreadLocalConnectionTestCase(base.UnitTestCase):
+
+    def setUp(self):
+        self.pool = mock.Mock(spec=connection.ConnectionPool)
+        self.unit = connection.ThreadLocalConnection(self.pool)
+
+    def test_checkout_once(self):
+        self.unit.search()
+        self.unit.get_entry()
+        self.pool.checkout.assert_called_once_with()
+        self.pool.checkout.return_value.search.assert_called_with()
+
+    def test_release(self):
+        self.unit.search()
+        self.unit.release()
+        self.pool.checkin.assert_called_once_with(self.pool.checkout.return_value, discard=False)
+        self.unit.release()
+        self.assertEqual(self.pool.checkin.call_count, 1)
+
+    def test_release_broken(self):
+        self.unit.search()
+        self.unit.mark_broken()
+        self.unit.release()
+        self.pool.checkin.assert_called_once_with(self.pool.checkout.return_value, discard=True)
+        self.unit.search()
+        self.unit.release()
+        self.pool.checkin.assert_called_with(self.pool.checkout.return_value, discard=False)
+
+
+class DiscardOnServerDownTestCase(base.UnitTestCase):
+
+    def setUp(self):
+        self.connection = mock.Mock(spec=connection.ThreadLocalConnection)
+
+    def test_function(self):
+        @connection.discard_on_server_down
+        def function(conn):
+            raise ldapom.LDAPServerDownError('down')
+
+        with self.assertRaises(ldapom.LDAPServerDownError):
+            function(self.connection)
+        self.connection.mark_broken.assert_called_once_with()
+
+    def test_generator(self):
+        @connection.discard_on_server_down
+        def generator(conn):
+            yield 1
+            raise ldapom.LDAPServerDownError('down')
+
+        items = generator(self.connection)
+        self.assertEqual(next(items), 1)
+        self.assertFalse(self.connection.mark_broken.called)
+        with self.assertRaises(ldapom.LDAPServerDownError):
+            next(items)
+        self.connection.mark_broken.assert_called_once_with()
+
+    def test_other_error(self):
+        @connection.discard_on_server_down
+        def function(conn):
+            raise ldapom.LDAPError('failed')
+
+        with self.assertRaises(ldapom.LDAPError):
+            function(self.connection)
+        self.assertFalse(self.connection.mark_broken.called)
+
+
+class RoutingConnectionTestCase(base.UnitTestCase):
+
+    def setUp(self):
+        self.provider = mock.Mock()
+        self.consumers = [mock.Mock(spec=connection.ThreadLocalConnection) for i in range(2)]
+        self.clock = mock.Mock(return_value=100)
+        self.unit = connection.RoutingConnection(
+            self.provider, self.consumers, retry_interval=30, sticky_interval=5, clock=self.clock,
+        )
+
+    def test_round_robin(self):
+        self.assertIs(self.unit.for_read(), self.consumers[0])
+        self.assertIs(self.unit.for_read(), self.consumers[0])
+        self.unit.release()
+        self.assertIs(self.unit.for_read(), self.consumers[1])
+        self.unit.release()
+        self.assertIs(self.unit.for_read(), self.consumers[0])
+        self.assertEqual(self.unit.stats()['consumer_reads'], 4)
+
+    def test_unavailable_consumer_skipped(self):
+        self.consumers[0].get_connection.side_effect = ldapom.LDAPServerDownError('down')
+        self.assertIs(self.unit.for_read(), self.consumers[1])
+        self.unit.release()
+        self.assertIs(self.unit.for_read(), self.consumers[1])
+        self.assertEqual(self.unit.stats()['unavailable_consumers'], [0])
+
+        self.consumers[0].get_connection.side_effect = None
+        self.clock.return_value = 131
+        self.unit.release()
+        self.assertIs(self.unit.for_read(), self.consumers[0])
+
+    def test_provider_when_no_consumer_available(self):
+        for consumer in self.consumers:
+            consumer.get_connection.side_effect = connection.PoolTimeout()
+        self.assertIs(self.unit.for_read(), self.provider)
+        self.assertEqual(self.unit.stats()['failovers'], 2)
+
+    def test_reads_after_write_go_to_provider(self):
+        self.assertIs(self.unit.for_read(), self.consumers[0])
+        self.unit.mark_written()
+        self.assertIs(self.unit.for_read(), self.provider)
+        self.unit.release()
+        self.assertIs(self.unit.for_read(), self.provider)
+        self.unit.release()
+        self.clock.return_value = 106
+        self.assertIs(self.unit.for_read(), self.consumers[1])
+
+    def test_write_of_other_thread_not_sticky(self):
+        thread = threading.Thread(target=self.unit.mark_written)
+        thread.start()
+        thread.join()
+        self.assertIs(self.unit.for_read(), self.consumers[0])
+
+    def test_read_failed_switches_to_next_consumer(self):
+        self.assertIs(self.unit.for_read(), self.consumers[0])
+        self.assertIs(self.unit.read_failed(self.consumers[0]), self.consumers[1])
+        self.consumers[0].release.assert_called_once_with(discard=True)
+        self.assertIs(self.unit.for_read(), self.consumers[1])
+        self.assertEqual(self.unit.stats()['unavailable_consumers'], [0])
+
+        self.assertIs(self.unit.read_failed(self.consumers[1]), self.provider)
+        self.assertIs(self.unit.for_read(), self.provider)
+        self.assertIsNone(self.unit.read_failed(self.provider))
+
+    def test_use_reader_in_other_thread(self):
+        reader = self.unit.for_read()
+        readers = []
+
+        def worker():
+            self.unit.use_reader(reader)
+            readers.append(self.unit.for_read())
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        self.assertEqual(readers, [self.consumers[0]])
+
+    def test_other_attributes_from_provider(self):
+        self.unit.can_bind('dn', 'password')
+        self.provider.can_bind.assert_called_with('dn', 'password')
+        self.unit.release()
+        self.provider.release.assert_called_with()
+        for consumer in self.consumers:
+            consumer.release.assert_called_with()
+
+
+class IterConcurrentlyTestCase(base.UnitTestCase):
+
+    def test_items_merged(self):
+        cleanup = mock.Mock()
+        ret = connection.iter_concurrently([lambda: [1, 2], lambda: [3]], buffer_size=1, cleanup=cleanup)
+        self.assertEqual(sorted(ret), [1, 2, 3])
+        self.assertEqual(cleanup.call_count, 2)
+
+    def test_inline_in_current_thread(self):
+        threads = []
+
+        def inline():
+            threads.append(threading.current_thread())
+            return [1]
+
+        ret = connection.iter_concurrently([lambda: [2]], inline=inline)
+        self.assertEqual(list(ret), [1, 2])
+        self.assertEqual(threads, [threading.current_thread()])
+
+    def test_exception_reraised(self):
+        def failing():
+            yield 1
+            raise ValueError('failed')
+
+        with self.assertRaises(ValueError):
+            list(connection.iter_concurrently([failing, lambda: [2]]))
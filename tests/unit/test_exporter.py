@@ -0,0 +1,35 @@
+import mock
+import esauth.exporter as exporter
+import tests.unit.base as base
+
+
+class LDIFTestCase(base.UnitTestCase):
+
+    def test_format_line(self):
+        self.assertEqual(exporter.format_ldif_line('uid', 'john'), 'uid: john\n')
+        self.assertEqual(exporter.format_ldif_line('sn', u'Tw\xf6'.encode('utf-8')), 'sn:: VHfDtg==\n')
+        self.assertEqual(exporter.format_ldif_line('sn', ' lead'), 'sn:: IGxlYWQ=\n')
+        self.assertEqual(exporter.format_ldif_line('sn', ':colon'), 'sn:: OmNvbG9u\n')
+
+    def test_long_line_folded(self):
+        line = exporter.format_ldif_line('description', 'x' * 100)
+        parts = line.splitlines()
+        self.assertEqual(len(parts[0]), 76)
+        self.assertTrue(parts[1].startswith(' '))
+        self.assertEqual(parts[0] + parts[1][1:], 'description: ' + 'x' * 100)
+
+    def test_iter_ldif(self):
+        uid = mock.Mock()
+        uid.name = 'uid'
+        uid._get_ldap_values.return_value = {'john'}
+        object_class = mock.Mock()
+        object_class.name = 'objectClass'
+        object_class._get_ldap_values.return_value = {'top', 'inetOrgPerson'}
+        entry = mock.Mock(dn=u'uid=john,dc=test,dc=com', _attributes={uid, object_class})
+        self.assertEqual(list(exporter.iter_ldif([entry], ['objectClass', 'uid', 'sn'])), [
+            'dn: uid=john,dc=test,dc=com\n'
+            'objectClass: inetOrgPerson\n'
+            'objectClass: top\n'
+            'uid: john\n'
+            '\n'
+        ])
@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+import mock
+import ldapom
+import esauth.models as models
+import esauth.connection
+import esauth.importer as importer
+import tests.unit.base as base
+
+LDIF = """version: 1
+
+# first
+dn: uid=one,ou=users,dc=test,dc=com
+objectClass: inetOrgPerson
+uid: one
+givenName: On
+ e
+sn:: VHfDtg==
+
+dn: uid=two,ou=users,dc=test,dc=com
+uid: two
+"""
+
+
+class ReadersTestCase(base.UnitTestCase):
+
+    def test_ldif_records(self):
+        records = list(importer.iter_ldif_records(LDIF.splitlines(True)))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['dn'], [u'uid=one,ou=users,dc=test,dc=com'])
+        self.assertEqual(records[0]['givenname'], [u'One'])
+        self.assertEqual(records[0]['sn'], ['Tw\xc3\xb6'])
+        self.assertEqual(records[1]['uid'], [u'two'])
+
+    def test_ldif_record_to_data(self):
+        record = next(importer.iter_ldif_records(LDIF.splitlines(True)))
+        data = importer.ldif_record_to_data(models.User, record)
+        self.assertEqual(data, {'username': [u'one'], 'first_name': [u'One'], 'last_name': [u'Tw\xf6']})
+
+    def test_ldif_binary_value_not_decoded(self):
+        lines = ['dn: uid=one,ou=users,dc=test,dc=com\n', 'uid: one\n', 'jpegPhoto:: /9j/4A==\n']
+        record = next(importer.iter_ldif_records(lines))
+        self.assertEqual(record['jpegphoto'], ['\xff\xd8\xff\xe0'])
+        self.assertEqual(importer.ldif_record_to_data(models.User, record), {'username': [u'one']})
+
+    def test_ldif_empty_values_dropped(self):
+        record = {'dn': [u'cn=empty,ou=groups,dc=test,dc=com'], 'cn': [u'empty'], 'member': [u'']}
+        self.assertEqual(importer.ldif_record_to_data(models.Group, record), {'name': [u'empty'], 'members': []})
+
+    def test_csv_records(self):
+        lines = ['name,members\n', 'admins,one;two\n', 'empty,\n']
+        self.assertEqual(list(importer.iter_csv_records(lines)), [
+            {'name': [u'admins'], 'members': [u'one', u'two']},
+            {'name': [u'empty'], 'members': []},
+        ])
+
+
+class CheckpointTestCase(base.UnitTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'import.checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_position_waits_for_gaps(self):
+        checkpoint = importer.Checkpoint(self.path, 'input.csv')
+        checkpoint.processed(2)
+        self.assertEqual(checkpoint.position, 0)
+        checkpoint.processed(1)
+        self.assertEqual(checkpoint.position, 2)
+        checkpoint.processed(4)
+        self.assertEqual(checkpoint.position, 2)
+
+    def test_save_and_load(self):
+        checkpoint = importer.Checkpoint(self.path, 'input.csv', save_every=2)
+        checkpoint.processed(1)
+        self.assertFalse(os.path.exists(self.path))
+        checkpoint.processed(2)
+        self.assertEqual(importer.Checkpoint(self.path, 'input.csv').load(), 2)
+        self.assertEqual(importer.Checkpoint(self.path, 'other.csv').load(), 0)
+        checkpoint.remove()
+        self.assertFalse(os.path.exists(self.path))
+
+
+class ImporterTestCase(base.UnitTestCase):
+
+    def run_import(self, errors, workers=1):
+        def import_record(number, data):
+            if number in errors:
+                raise errors[number]
+
+        unit = importer.Importer(models.User, importer.Checkpoint(None, 'input'), workers=workers, queue_size=2)
+        unit.import_record = mock.Mock(side_effect=import_record)
+        unit.run([{}] * 5)
+        return unit
+
+    def test_validation_error_checkpointed(self):
+        unit = self.run_import({2: ValueError('bad')}, workers=2)
+        self.assertEqual((unit.imported, unit.failed), (4, 1))
+        self.assertEqual(unit.checkpoint.position, 5)
+
+    def test_error_stops_import(self):
+        for error in [ldapom.LDAPServerDownError('down'), esauth.connection.PoolTimeout(), KeyError('x')]:
+            unit = importer.Importer(models.User, importer.Checkpoint(None, 'input'), workers=1)
+            unit.import_record = mock.Mock(side_effect=[None, error, None])
+            with self.assertRaises(importer.ImportStopped):
+                unit.run([{}] * 5)
+            self.assertEqual(unit.imported, 1)
+            self.assertEqual(unit.checkpoint.position, 1)
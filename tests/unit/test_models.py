@@ -1,11 +1,154 @@
 import mock
+import ldapom
 import esauth.models as models
+import esauth.connection
 import tests.unit.base as base
 
 
 class GroupTestCase(base.UnitTestCase):
-    pass
+
+    @mock.patch('esauth.models.User.filter_existing')
+    def test_members_decoded_once(self, filter_existing):
+        filter_existing.return_value = ['uid=one,ou=users,dc=example,dc=com']
+        group = models.Group(name='one', members=['uid=one,ou=users,dc=example,dc=com'])
+
+        self.assertEqual(group.members, ['uid=one,ou=users,dc=example,dc=com'])
+        self.assertEqual(group.members, ['uid=one,ou=users,dc=example,dc=com'])
+        self.assertEqual(filter_existing.call_count, 1)
+
+    @mock.patch('esauth.models.User.filter_existing')
+    def test_members_reassign_resets_cache(self, filter_existing):
+        group = models.Group(name='one', members=['uid=one,ou=users,dc=example,dc=com'])
+        list(group.members)
+        group.members = ['uid=two,ou=users,dc=example,dc=com']
+        list(group.members)
+        self.assertEqual(filter_existing.call_count, 2)
+
+    @mock.patch('esauth.models.User.filter_existing')
+    def test_members_lazy(self, filter_existing):
+        filter_existing.side_effect = lambda dns: [dn for dn in dns if 'missing' not in dn]
+        group = models.Group(name='one', members=[
+            'uid=one,ou=users,dc=example,dc=com',
+            'uid=missing,ou=users,dc=example,dc=com',
+            'uid=two,ou=users,dc=example,dc=com',
+        ])
+        members = group.members
+        self.assertFalse(filter_existing.called)
+        self.assertEqual(members.count(), 3)
+        self.assertFalse(filter_existing.called)
+
+        self.assertIn('UID=one,ou=users,dc=example,dc=com', members)
+        self.assertNotIn('uid=missing,ou=users,dc=example,dc=com', members)
+        self.assertNotIn('uid=other,ou=users,dc=example,dc=com', members)
+        self.assertEqual(list(members.iter_chunks(2)), [
+            ['uid=one,ou=users,dc=example,dc=com'], ['uid=two,ou=users,dc=example,dc=com'],
+        ])
+        self.assertEqual(len(members), 2)
+        self.assertEqual(members[1], 'uid=two,ou=users,dc=example,dc=com')
+
+    def get_saved_group(self, members):
+        group = models.Group(name='one', members=members)
+        group._saved_state = group.get_state()
+        patcher = mock.patch.object(models.Group, '_connection', mock.Mock(spec=ldapom.LDAPConnection))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Entry on server has the same members
+        entry = mock.Mock(spec=ldapom.LDAPEntry)
+        entry.member = set(members) or {''}
+        models.Group._connection.search.return_value = [entry]
+        return group
+
+    @mock.patch('esauth.connection.modify')
+    def test_add_members_sends_only_new(self, modify):
+        group = self.get_saved_group(['uid=one,ou=users,dc=example,dc=com'])
+        group.add_members(['uid=one,ou=users,dc=example,dc=com', 'uid=two,ou=users,dc=example,dc=com'])
+        modify.assert_called_once_with(group._connection, 'cn=one,ou=groups,dc=example,dc=com', [
+            (esauth.connection.MOD_ADD, 'member', ['uid=two,ou=users,dc=example,dc=com']),
+        ])
+        self.assertEqual(group.get_changes(), [])
+
+    @mock.patch('esauth.connection.modify')
+    def test_members_placeholder(self, modify):
+        group = self.get_saved_group([])
+        group.add_members(['uid=one,ou=users,dc=example,dc=com'])
+        self.assertEqual(modify.call_args[0][2], [
+            (esauth.connection.MOD_DELETE, 'member', ['']),
+            (esauth.connection.MOD_ADD, 'member', ['uid=one,ou=users,dc=example,dc=com']),
+        ])
+        models.Group._connection.search.return_value[0].member = {'uid=one,ou=users,dc=example,dc=com'}
+        group.remove_members(['uid=one,ou=users,dc=example,dc=com'])
+        self.assertEqual(modify.call_args[0][2], [
+            (esauth.connection.MOD_DELETE, 'member', ['uid=one,ou=users,dc=example,dc=com']),
+            (esauth.connection.MOD_ADD, 'member', ['']),
+        ])
+
+    @mock.patch('esauth.connection.modify')
+    def test_remove_absent_members_sends_nothing(self, modify):
+        group = self.get_saved_group(['uid=one,ou=users,dc=example,dc=com'])
+        group.remove_members(['uid=two,ou=users,dc=example,dc=com'])
+        self.assertFalse(modify.called)
+
+    @mock.patch('esauth.connection.modify')
+    def test_update_members_uses_current_entry(self, modify):
+        group = self.get_saved_group(['uid=one,ou=users,dc=example,dc=com'])
+        # Member removed on server after group was loaded
+        models.Group._connection.search.return_value[0].member = {''}
+        group.remove_members(['uid=one,ou=users,dc=example,dc=com'])
+        self.assertFalse(modify.called)
+
+    def test_update_members_of_unsaved_group(self):
+        self.assertRaises(ValueError, models.Group(name='one').add_members, ['uid=one,ou=users,dc=example,dc=com'])
 
 
 class UserTestCase(base.UnitTestCase):
-    pass
+
+    @mock.patch('esauth.models.Group.search_entries')
+    def test_groups(self, search_entries):
+        search_entries.return_value = []
+        user = models.User(username='one', first_name='a', last_name='b')
+        self.assertEqual(user.groups, [])
+        search_filter = search_entries.call_args[0][0]
+        self.assertEqual(search_filter, '(&(objectClass=groupOfNames)(member=uid=one,ou=users,dc=example,dc=com))')
+
+    @mock.patch('esauth.models.User.query')
+    def test_choices_cached_until_users_change(self, query):
+        models.User._choices = None
+        all_users = query.return_value.only
+        all_users.return_value = [
+            models.User(username='two', first_name='a', last_name='b'),
+            models.User(username='one', first_name='a', last_name='b'),
+        ]
+        self.assertEqual(models.User.get_choices(), (
+            ('uid=one,ou=users,dc=example,dc=com', 'one'),
+            ('uid=two,ou=users,dc=example,dc=com', 'two'),
+        ))
+        models.User.get_choices()
+        self.assertEqual(all_users.call_count, 1)
+        all_users.assert_called_with('username')
+
+        models.User._entries_changed()
+        models.User.get_choices()
+        self.assertEqual(all_users.call_count, 2)
+
+    @mock.patch('esauth.connection.add')
+    def test_created_user_changes_entries_version(self, add):
+        version = models.User._entries_version
+        models.User(username='one', first_name='a', last_name='b').save()
+        self.assertNotEqual(models.User._entries_version, version)
+
+    def test_extra_attributes(self):
+        user = models.User(username='john', first_name='John', last_name='Smith')
+        self.assertEqual(user.get_extra_attributes(), {
+            'objectClass': ['top', 'inetOrgPerson'],
+            'cn': u'John Smith',
+        })
+
+    def test_extra_attributes_posix(self):
+        user = models.User(username='john', first_name='John', last_name='Smith', uid_number=10000)
+        self.assertEqual(user.get_extra_attributes()['objectClass'], ['top', 'posixAccount', 'inetOrgPerson'])
+
+    def test_changes_description_only(self):
+        user = models.User(username='john', first_name='John', last_name='Smith')
+        user._saved_state = user.get_state()
+        user.description = u'New'
+        self.assertEqual(user.get_changes(), [(esauth.connection.MOD_ADD, 'description', [u'New'])])
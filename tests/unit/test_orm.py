@@ -2,6 +2,8 @@ import types
 import mock
 import ldapom
 import esauth.orm as orm
+import esauth.cache
+import esauth.connection
 import tests.unit.base as base
 
 
@@ -9,6 +11,7 @@ class TestField(object):
     def __init__(self, name='', primary=False):
         self.primary = primary
         self.name = name
+        self.lazy = False
 
 
 class BaseMetaTestCase(base.UnitTestCase):
@@ -74,6 +77,7 @@ class BaseTestCase(base.UnitTestCase):
             'one': orm.Field('raw_one', primary=True),
             'two': orm.Field('raw_two'),
             'base_dn': 'dc=test',
+            'page_size': 0,
         })
 
     @mock.patch('ldapom.LDAPEntry', spec=ldapom.LDAPEntry)
@@ -106,8 +110,67 @@ class BaseTestCase(base.UnitTestCase):
         self.assertIsInstance(ret, types.GeneratorType)
         ret = list(ret)
 
-        self.unit._connection.search.assert_called_with(search_filter='class=x', base='dc=test')
+        self.unit._connection.search.assert_called_with(
+            search_filter='class=x',
+            base='dc=test',
+            scope=ldapom.LDAP_SCOPE_SUBTREE,
+            retrieve_attributes=['raw_one', 'raw_two'],
+        )
         self.assertEqual(len(ret), 2)
+        from_entry.assert_called_with(e2, fetch=False)
+
+    @mock.patch('esauth.connection.paged_search')
+    @mock.patch('esauth.orm.Base.from_entry')
+    def test_all_paged(self, from_entry, paged_search):
+        self.unit.all_search_filter = 'class=x'
+        self.unit.page_size = 10
+        self.unit._connection = mock.Mock(spec=ldapom.LDAPConnection)
+        paged_search.return_value = [mock.Mock(spec=ldapom.LDAPEntry)]
+
+        ret = list(self.unit.all())
+
+        paged_search.assert_called_with(
+            self.unit._connection,
+            search_filter='class=x',
+            base='dc=test',
+            scope=ldapom.LDAP_SCOPE_SUBTREE,
+            retrieve_attributes=['raw_one', 'raw_two'],
+            page_size=10,
+            size_limit=0,
+        )
+        self.assertFalse(self.unit._connection.search.called)
+        self.assertEqual(len(ret), 1)
+
+    def test_from_entry_no_fetch(self):
+        entry = mock.Mock(spec=ldapom.LDAPEntry)
+        entry.dn = 'raw_one=x,dc=test'
+        attr = mock.Mock()
+        attr.name = 'raw_two'
+        entry._attributes = [attr]
+        entry.raw_two = 'value'
+
+        obj = self.unit.from_entry(entry, fetch=False)
+
+        self.assertFalse(entry.fetch.called)
+        self.assertEqual(obj.two, 'value')
+
+    def test_from_entry_fetch(self):
+        entry = mock.Mock(spec=ldapom.LDAPEntry)
+        entry.dn = 'raw_one=x,dc=test'
+        entry._attributes = []
+        self.unit.from_entry(entry)
+        entry.fetch.assert_called_with()
+
+    def test_from_entry_partial(self):
+        entry = mock.Mock(spec=ldapom.LDAPEntry)
+        entry.dn = 'raw_one=x,dc=test'
+        entry._attributes = []
+
+        obj = self.unit.from_entry(entry, fetch=False)
+
+        self.assertEqual(obj._saved_state['raw_two'], frozenset())
+        with self.assertRaises(ValueError):
+            obj.get_state()
 
     @mock.patch('esauth.orm.Base.from_entry')
     def test_get_entry_exists(self, from_entry):
@@ -121,7 +184,9 @@ class BaseTestCase(base.UnitTestCase):
 
         ret = self.unit.get('yyy')
 
-        self.unit._connection.get_entry.assert_called_with('raw_one=yyy,dc=test')
+        self.unit._connection.get_entry.assert_called_with(
+            'raw_one=yyy,dc=test', retrieve_attributes=['raw_one', 'raw_two'],
+        )
         expected_entry.exists.assert_called_with()
         from_entry.assert_called_with(expected_entry)
         self.assertEqual(ret, from_entry(expected_entry))
@@ -138,6 +203,350 @@ class BaseTestCase(base.UnitTestCase):
         ret = self.unit.get('yyy')
         self.assertIsNone(ret)
 
+    def test_exists_base_scope_search(self):
+        self.unit.all_search_filter = 'class=x'
+        self.unit._connection = mock.Mock(spec=ldapom.LDAPConnection)
+        self.unit._connection.search.return_value = iter([mock.Mock()])
+
+        self.assertTrue(self.unit.exists('yyy'))
+        self.unit._connection.search.assert_called_with(
+            search_filter='(class=x)',
+            base='raw_one=yyy,dc=test',
+            scope=ldapom.LDAP_SCOPE_BASE,
+            retrieve_attributes=['1.1'],
+        )
+
+    def test_exists_instance(self):
+        self.unit.all_search_filter = 'class=x'
+        self.unit._connection = mock.Mock(spec=ldapom.LDAPConnection)
+        self.unit._connection.search.return_value = iter([])
+        self.assertFalse(self.unit(one='yyy').exists())
+        self.assertEqual(self.unit._connection.search.call_args[1]['base'], 'raw_one=yyy,dc=test')
+
+    def test_exists_negative_cached(self):
+        self.unit.all_search_filter = 'class=x'
+        self.unit._connection = mock.Mock(spec=ldapom.LDAPConnection)
+        self.unit._connection.search.return_value = iter([])
+        self.unit._missing_cache = esauth.cache.LRUCache()
+
+        self.assertFalse(self.unit.exists('yyy'))
+        self.assertFalse(self.unit.exists('yyy'))
+        self.assertIsNone(self.unit.get('yyy'))
+        self.assertEqual(self.unit._connection.search.call_count, 1)
+        self.assertFalse(self.unit._connection.get_entry.called)
+
+    @mock.patch('esauth.connection.add')
+    def test_save_new_clears_negative_cache(self, add):
+        self.unit._missing_cache = esauth.cache.LRUCache()
+        self.unit._missing_cache.set(('entry', 'raw_one=yyy,dc=test'), True)
+        self.unit(one='yyy', two=1).save()
+        self.assertIsNone(self.unit._missing_cache.get(('entry', 'raw_one=yyy,dc=test')))
+
+    @mock.patch('esauth.connection.add', side_effect=esauth.connection.EntryAlreadyExists('exists'))
+    def test_save_new_conflict_clears_negative_cache(self, add):
+        self.unit._missing_cache = esauth.cache.LRUCache()
+        self.unit._missing_cache.set(('entry', 'raw_one=yyy,dc=test'), True)
+        obj = self.unit(one='yyy', two=1)
+        with self.assertRaises(esauth.connection.EntryAlreadyExists):
+            obj.save()
+        self.assertIsNone(self.unit._missing_cache.get(('entry', 'raw_one=yyy,dc=test')))
+        self.assertIsNone(obj._saved_state)
+
+    def test_get_candidate_dns(self):
+        self.unit.search_bases = ['dc=test', 'dc=other']
+        self.assertEqual(self.unit.get_candidate_dns('x'), ['raw_one=x,dc=test', 'raw_one=x,dc=other'])
+        self.assertEqual(self.unit.get_candidate_dns('raw_one=x, dc=Other'), ['raw_one=x, dc=Other'])
+
+    def test_search_entries_several_bases(self):
+        self.unit.search_bases = ['dc=test', 'dc=other']
+        self.unit._connection = mock.Mock(spec=ldapom.LDAPConnection)
+        self.unit._connection.search.side_effect = lambda base, **kwargs: iter([base])
+
+        ret = self.unit.search_entries('(x=1)', retrieve_attributes=['1.1'])
+
+        self.assertEqual(sorted(ret), ['dc=other', 'dc=test'])
+        self.assertEqual(self.unit._connection.search.call_count, 2)
+
+    def test_search_repeated_when_consumer_down(self):
+        consumer = mock.Mock(spec=ldapom.LDAPConnection)
+        consumer.search.side_effect = ldapom.LDAPServerDownError('down')
+        provider = mock.Mock(spec=ldapom.LDAPConnection)
+        provider.search.return_value = iter(['entry'])
+        self.unit._connection = mock.Mock(spec=esauth.connection.RoutingConnection)
+        self.unit._connection.for_read.return_value = consumer
+        self.unit._connection.read_failed.return_value = provider
+
+        self.assertEqual(list(self.unit.search_entries('(x=1)')), ['entry'])
+        self.unit._connection.read_failed.assert_called_once_with(consumer)
+
+    def test_search_not_repeated_on_provider(self):
+        self.unit._connection = mock.Mock(spec=esauth.connection.RoutingConnection)
+        self.unit._connection.for_read.return_value.search.side_effect = ldapom.LDAPServerDownError('down')
+        self.unit._connection.read_failed.return_value = None
+        with self.assertRaises(ldapom.LDAPServerDownError):
+            list(self.unit.search_entries('(x=1)'))
+
+    def test_search_several_bases_routed(self):
+        self.unit.search_bases = ['dc=test', 'dc=other']
+        self.unit._connection = mock.Mock(spec=esauth.connection.RoutingConnection)
+        reader = self.unit._connection.for_read.return_value
+        reader.search.side_effect = lambda base, **kwargs: iter([base])
+
+        ret = self.unit.search_entries('(x=1)', retrieve_attributes=['1.1'])
+
+        self.assertEqual(sorted(ret), ['dc=other', 'dc=test'])
+        self.unit._connection.use_reader.assert_called_once_with(reader)
+
+    def test_get_dn_keeps_loaded_parent(self):
+        self.unit.search_bases = ['dc=test', 'dc=other']
+        entry = mock.Mock(spec=ldapom.LDAPEntry, dn='raw_one=x,dc=other', raw_one='x', raw_two='a')
+        entry._attributes = [mock.Mock(), mock.Mock()]
+        entry._attributes[0].name = 'raw_one'
+        entry._attributes[1].name = 'raw_two'
+        obj = self.unit.from_entry(entry, fetch=False)
+        self.assertEqual(obj.get_dn(), 'raw_one=x,dc=other')
+        self.assertEqual(self.unit(one='y').get_dn(), 'raw_one=y,dc=test')
+
+    def test_slots(self):
+        obj = self.unit(one=1, two=2)
+        self.assertFalse(hasattr(obj, '__dict__'))
+        self.assertIn('_field_raw_one_value', self.unit.__slots__)
+        with self.assertRaises(AttributeError):
+            obj.three = 3
+
+    def test_decoded_value_cached(self):
+        decoder = mock.Mock(return_value='decoded')
+        self.unit.two.decoder(decoder)
+        obj = self.unit(one=1, two=2)
+
+        self.assertEqual(obj.two, 'decoded')
+        self.assertEqual(obj.two, 'decoded')
+        decoder.assert_called_once_with(obj, 2)
+
+    def test_decoded_value_reset_on_set(self):
+        decoder = mock.Mock(side_effect=lambda obj, value: value * 10)
+        self.unit.two.decoder(decoder)
+        obj = self.unit(one=1, two=2)
+
+        self.assertEqual(obj.two, 20)
+        obj.two = 3
+        self.assertEqual(obj.two, 30)
+        self.assertEqual(decoder.call_count, 2)
+
+    def test_decoded_value_reset_on_refresh(self):
+        self.unit._connection = mock.Mock(spec=ldapom.LDAPConnection)
+        entry = self.unit._connection.get_entry.return_value
+        entry.dn = 'raw_one=1,dc=test'
+        entry._attributes = []
+        decoder = mock.Mock(return_value='decoded')
+        self.unit.two.decoder(decoder)
+        obj = self.unit(one=1, two=2)
+
+        obj.two
+        obj.refresh()
+        obj.two
+        self.assertEqual(decoder.call_count, 2)
+
+    def make_saved(self, **kwargs):
+        obj = self.unit(**kwargs)
+        obj._saved_state = obj.get_state(validate=False)
+        return obj
+
+    @mock.patch('esauth.connection.modify')
+    def test_save_no_changes(self, modify):
+        obj = self.make_saved(one=1, two=2)
+        obj.two = 2
+        obj.save()
+        self.assertFalse(modify.called)
+
+    @mock.patch('esauth.connection.modify')
+    def test_save_changed_field_only(self, modify):
+        self.unit._connection = mock.Mock(spec=ldapom.LDAPConnection)
+        self.unit._connection.search.return_value = []
+        obj = self.make_saved(one=1, two=[1, 2])
+        obj.two = [2, 3]
+        obj.save()
+        modify.assert_called_once_with(self.unit._connection, 'raw_one=1,dc=test', [
+            (esauth.connection.MOD_DELETE, 'raw_two', [1]),
+            (esauth.connection.MOD_ADD, 'raw_two', [3]),
+        ])
+        self.assertEqual(obj.get_changes(), [])
+
+    @mock.patch('esauth.connection.modify')
+    def test_save_changes_against_current_entry(self, modify):
+        self.unit._connection = mock.Mock(spec=ldapom.LDAPConnection)
+        entry = mock.Mock(spec=ldapom.LDAPEntry)
+        entry.raw_two = {1, 4}
+        self.unit._connection.search.return_value = [entry]
+        # Loaded from stale cache, entry was changed since
+        obj = self.make_saved(one=1, two=[1, 2])
+        obj.two = [2, 3]
+        obj.save()
+
+        self.unit._connection.search.assert_called_once_with(
+            search_filter='(objectClass=*)',
+            base='raw_one=1,dc=test',
+            scope=ldapom.LDAP_SCOPE_BASE,
+            retrieve_attributes=['raw_two'],
+        )
+        modify.assert_called_once_with(self.unit._connection, 'raw_one=1,dc=test', [
+            (esauth.connection.MOD_DELETE, 'raw_two', [1, 4]),
+            (esauth.connection.MOD_ADD, 'raw_two', [2, 3]),
+        ])
+
+    @mock.patch('esauth.connection.modify')
+    def test_save_add_and_delete_attribute(self, modify):
+        self.unit._connection = mock.Mock(spec=ldapom.LDAPConnection)
+        self.unit._connection.search.return_value = []
+        obj = self.make_saved(one=1, two=None)
+        obj.two = 'x'
+        self.assertEqual(obj.get_changes(), [(esauth.connection.MOD_ADD, 'raw_two', ['x'])])
+        obj.save()
+        obj.two = ''
+        self.assertEqual(obj.get_changes(), [(esauth.connection.MOD_DELETE, 'raw_two', [])])
+
+    def test_directory_state_cached(self):
+        self.unit.all_search_filter = 'objectClass=x'
+        with mock.patch.object(self.unit, 'search_entries', return_value=[]) as search_entries:
+            self.assertEqual(self.unit.get_directory_state(), (None, 0))
+            self.unit.get_directory_state()
+            self.assertEqual(search_entries.call_count, 2)
+
+            self.make_saved(one=1)._written()
+            self.unit.get_directory_state()
+            self.assertEqual(search_entries.call_count, 4)
+
+    def test_directory_state_from_context_csn(self):
+        self.unit.context_csn_base = 'dc=test'
+        self.unit._connection = mock.Mock(spec=ldapom.LDAPConnection)
+        entry = mock.Mock(spec=ldapom.LDAPEntry)
+        entry.get_attribute.return_value.value = set(['20240101000000.000001Z#1', '20240102000000.000001Z#2'])
+        self.unit._connection.search.return_value = [entry]
+
+        with mock.patch.object(self.unit, 'search_entries') as search_entries:
+            self.assertEqual(self.unit.get_directory_state(), ('20240102000000.000001Z#2', None))
+            self.assertFalse(search_entries.called)
+        self.unit._connection.search.assert_called_once_with(
+            search_filter='(objectClass=*)', base='dc=test',
+            scope=ldapom.LDAP_SCOPE_BASE, retrieve_attributes=['contextCSN'],
+        )
+
+    def test_changes_single_value_replaced(self):
+        self.unit = type('Model', (orm.Base,), {
+            'one': orm.Field('raw_one', primary=True),
+            'two': orm.SingleValueField('raw_two'),
+            'base_dn': 'dc=test',
+        })
+        obj = self.make_saved(one=1, two='a')
+        obj.two = 'b'
+        self.assertEqual(obj.get_changes(), [(esauth.connection.MOD_REPLACE, 'raw_two', ['b'])])
+
+    @mock.patch('esauth.connection.add')
+    @mock.patch('esauth.connection.modify')
+    def test_save_new(self, modify, add):
+        self.unit._connection = mock.Mock(spec=ldapom.LDAPConnection)
+        obj = self.unit(one=1, two=2)
+        obj.save()
+        self.assertFalse(modify.called)
+        add.assert_called_with(self.unit._connection, 'raw_one=1,dc=test', [
+            (esauth.connection.MOD_ADD, 'objectClass', ['top']),
+            (esauth.connection.MOD_ADD, 'raw_one', [1]),
+            (esauth.connection.MOD_ADD, 'raw_two', [2]),
+        ])
+        self.assertEqual(obj._saved_state, obj.get_state())
+
+    def test_get_cached(self):
+        self.unit._connection = mock.Mock(spec=ldapom.LDAPConnection)
+        self.unit._cache = esauth.cache.LRUCache()
+        self.unit._cache.set(('entry', 'raw_one=1,dc=test'), self.make_saved(one=1, two=2)._get_cache_value())
+
+        obj = self.unit.get('1')
+
+        self.assertFalse(self.unit._connection.get_entry.called)
+        self.assertEqual((obj.one, obj.two), (1, 2))
+        self.assertEqual(obj.get_changes(), [])
+
+    @mock.patch('esauth.connection.modify')
+    def test_save_invalidates_cache(self, modify):
+        self.unit._connection = mock.Mock(spec=ldapom.LDAPConnection)
+        self.unit._connection.search.return_value = []
+        self.unit._cache = esauth.cache.LRUCache()
+        obj = self.make_saved(one=1, two=2)
+        self.unit._cache.set(('entry', 'raw_one=1,dc=test'), obj._get_cache_value())
+        self.unit._cache.set(('search', 'dc=test'), {})
+        obj.two = 3
+        obj.save()
+        self.assertIsNone(self.unit._cache.get(('entry', 'raw_one=1,dc=test')))
+        self.assertIsNone(self.unit._cache.get(('search', 'dc=test')))
+
+    def test_search_cached(self):
+        self.unit.all_search_filter = 'class=x'
+        self.unit._connection = mock.Mock(spec=ldapom.LDAPConnection)
+        self.unit._cache = esauth.cache.LRUCache()
+        entry = mock.Mock(spec=ldapom.LDAPEntry, dn='raw_one=1,dc=test', raw_one=1, raw_two=2)
+        entry._attributes = [mock.Mock(), mock.Mock()]
+        entry._attributes[0].name = 'raw_one'
+        entry._attributes[1].name = 'raw_two'
+        self.unit._connection.search.return_value = [entry]
+
+        first = list(self.unit.all())
+        second = list(self.unit.all())
+
+        self.assertEqual(self.unit._connection.search.call_count, 1)
+        self.assertEqual([(obj.one, obj.two) for obj in second], [(1, 2)])
+        self.assertIsNot(first[0], second[0])
+
+    def test_search_not_cached_over_limit(self):
+        self.unit.all_search_filter = 'class=x'
+        self.unit.search_cache_limit = 1
+        self.unit._connection = mock.Mock(spec=ldapom.LDAPConnection)
+        self.unit._cache = esauth.cache.LRUCache()
+        entries = [mock.Mock(spec=ldapom.LDAPEntry, dn='raw_one={0},dc=test'.format(i), _attributes=[])
+                   for i in range(2)]
+        self.unit._connection.search.return_value = entries
+
+        self.assertEqual(len(list(self.unit.all())), 2)
+        self.assertEqual(len(list(self.unit.all())), 2)
+
+        self.assertEqual(self.unit._connection.search.call_count, 2)
+        self.assertIsNone(self.unit._cache.get(('search', 'dc=test')))
+
+    @mock.patch('esauth.connection.pipeline')
+    def test_bulk_save(self, pipeline):
+        pipeline.return_value = [(0, None), (1, ldapom.error.LDAPError('failed'))]
+        saved = self.make_saved(one=1, two=2)
+        saved.two = 3
+        unchanged = self.make_saved(one=3, two=3)
+        new = self.unit(one=2, two=[2, 1])
+        invalid = self.unit()
+
+        result = self.unit.bulk_save([saved, new, unchanged, invalid], window=10)
+
+        pipeline.assert_called_once_with(self.unit._connection, [
+            (0, 'modify', 'raw_one=1,dc=test', [(esauth.connection.MOD_DELETE, 'raw_two', [2]),
+                                                (esauth.connection.MOD_ADD, 'raw_two', [3])]),
+            (1, 'add', 'raw_one=2,dc=test', [(esauth.connection.MOD_ADD, 'objectClass', ['top']),
+                                             (esauth.connection.MOD_ADD, 'raw_one', [2]),
+                                             (esauth.connection.MOD_ADD, 'raw_two', [1, 2])]),
+        ], 10)
+        self.assertEqual([obj for obj, error in result], [saved, new, unchanged, invalid])
+        self.assertIsNone(result[0][1])
+        self.assertIsInstance(result[1][1], ldapom.error.LDAPError)
+        self.assertIsNone(result[2][1])
+        self.assertIsInstance(result[3][1], ValueError)
+        self.assertEqual(saved.get_changes(), [])
+        self.assertIsNone(new._saved_state)
+
+    @mock.patch('esauth.connection.pipeline')
+    def test_bulk_remove(self, pipeline):
+        pipeline.return_value = [(0, None)]
+        obj = self.make_saved(one=1, two=2)
+        self.assertEqual(self.unit.bulk_remove([obj]), [(obj, None)])
+        pipeline.assert_called_once_with(self.unit._connection, [
+            (0, 'delete', 'raw_one=1,dc=test', None),
+        ], self.unit.bulk_window)
+        self.assertIsNone(obj._saved_state)
+
 
     # def setUp(self):
     #     self.unit = type('Base', (orm.Base,), {})
@@ -178,6 +587,234 @@ class BaseTestCase(base.UnitTestCase):
     #     self.assertEqual(obj.oa2, 'TWO')
 
 
+class SingleValueFieldTestCase(base.UnitTestCase):
+
+    def setUp(self):
+        self.unit = type('Model', (orm.Base,), {
+            'one': orm.SingleValueField('raw_one', primary=True),
+        })
+
+    def test_single_value_set(self):
+        obj = self.unit(one={'value'})
+        self.assertEqual(obj.one, 'value')
+
+    def test_scalar(self):
+        obj = self.unit(one='value')
+        self.assertEqual(obj.one, 'value')
+
+    def test_multiple_values(self):
+        obj = self.unit(one={'value1', 'value2'})
+        with self.assertRaises(ValueError):
+            obj.one
+
+
+class QueryTestCase(base.UnitTestCase):
+
+    def setUp(self):
+        self.model = type('Model', (orm.Base,), {
+            'username': orm.SingleValueField('uid', primary=True),
+            'last_name': orm.SingleValueField('sn'),
+            'first_name': orm.SingleValueField('givenName'),
+            'base_dn': 'dc=test',
+            'all_search_filter': 'objectClass=person',
+            'page_size': 0,
+        })
+        self.model._connection = mock.Mock(spec=ldapom.LDAPConnection)
+
+    def test_filter(self):
+        query = self.model.query().filter(uid__startswith='jo', last_name='Smith')
+        self.assertEqual(query.get_filter(), '(&(objectClass=person)(sn=Smith)(uid=jo*))')
+
+    def test_filter_escaped(self):
+        query = self.model.query().filter(username__contains='a*(b)')
+        self.assertEqual(query.get_filter(), '(&(objectClass=person)(uid=*a\\2a\\28b\\29*))')
+
+    def test_exclude_and_present(self):
+        query = self.model.query().exclude(givenName__present=True)
+        self.assertEqual(query.get_filter(), '(&(objectClass=person)(!(givenName=*)))')
+
+    def test_unknown_lookup(self):
+        with self.assertRaises(ValueError):
+            self.model.query().filter(uid__like='x')
+
+    def test_template_cached(self):
+        self.model.query().filter(uid='one').get_filter()
+        query = self.model.query().filter(uid='two')
+        self.assertEqual(len(self.model._filter_templates), 1)
+        self.assertEqual(query.get_filter(), '(&(objectClass=person)(uid=two))')
+
+    def test_chaining_does_not_modify_query(self):
+        query = self.model.query()
+        query.filter(uid='one').limit(10)
+        self.assertEqual(query._conditions, [])
+        self.assertEqual(query._size_limit, 0)
+
+    def test_only_includes_primary(self):
+        query = self.model.query().only('sn')
+        self.assertEqual(query.get_attributes(), ['sn', 'uid'])
+
+    def test_iter(self):
+        entries = [mock.Mock(spec=ldapom.LDAPEntry, dn='uid={0},dc=test'.format(i)) for i in range(3)]
+        for entry in entries:
+            entry._attributes = []
+        self.model._connection.search.return_value = iter(entries)
+
+        ret = list(self.model.query().filter(uid='x').only('sn').limit(2).scope(ldapom.LDAP_SCOPE_ONELEVEL))
+
+        self.assertEqual(len(ret), 2)
+        self.model._connection.search.assert_called_with(
+            search_filter='(&(objectClass=person)(uid=x))',
+            base='dc=test',
+            scope=ldapom.LDAP_SCOPE_ONELEVEL,
+            retrieve_attributes=['sn', 'uid'],
+        )
+
+    def test_count(self):
+        self.model._connection.search.return_value = [mock.Mock(), mock.Mock()]
+        self.assertEqual(self.model.query().count(), 2)
+        self.assertEqual(self.model._connection.search.call_args[1]['retrieve_attributes'], ['1.1'])
+
+
+    def test_contains_any(self):
+        query = self.model.query().contains_any('j*', 'username', 'sn').filter(givenName='x')
+        self.assertEqual(query.get_filter(), '(&(objectClass=person)(|(uid=*j\\2a*)(sn=*j\\2a*))(givenName=x))')
+
+    def make_entry(self, uid, sn):
+        entry = mock.Mock(spec=ldapom.LDAPEntry, dn='uid={0},dc=test'.format(uid), uid=uid, sn=sn)
+        attributes = {'uid': mock.Mock(_values={uid}), 'sn': mock.Mock(_values={sn})}
+        for name, attribute in attributes.items():
+            attribute.name = name
+        entry.get_attribute.side_effect = attributes.get
+        entry._attributes = attributes.values()
+        return entry
+
+    def test_filter_without_conditions(self):
+        self.assertEqual(self.model.query().get_filter(), '(objectClass=person)')
+
+    @mock.patch('esauth.connection.sorted_search')
+    def test_paginate_sorted_on_server(self, sorted_search):
+        sorted_search.return_value = [self.make_entry('b', 'beta')], 3
+        page = self.model.query().order_by('-last_name').paginate(2, 2)
+
+        self.assertEqual(page.total, 3)
+        self.assertEqual(page.number, 2)
+        self.assertEqual([obj.username for obj in page.items], ['b'])
+        sorted_search.assert_called_once_with(
+            self.model._connection,
+            search_filter='(objectClass=person)',
+            base='dc=test',
+            sort_key='-sn:caseIgnoreOrderingMatch',
+            offset=3,
+            count=2,
+            scope=ldapom.LDAP_SCOPE_SUBTREE,
+            retrieve_attributes=self.model._load_attributes,
+        )
+        self.assertFalse(self.model._connection.search.called)
+
+    @mock.patch('esauth.connection.sorted_search')
+    def test_paginate_on_server_number_clamped(self, sorted_search):
+        sorted_search.side_effect = [([], 3), ([self.make_entry('c', 'Alpha')], 3)]
+        page = self.model.query().paginate(5, 2)
+        self.assertEqual(page.number, 2)
+        self.assertEqual([obj.username for obj in page.items], ['c'])
+        self.assertEqual(sorted_search.call_args[1]['offset'], 3)
+
+    @mock.patch('esauth.connection.sorted_search', side_effect=esauth.connection.SortUnavailable())
+    def test_paginate(self, sorted_search):
+        keys = [self.make_entry('c', 'Alpha'), self.make_entry('a', 'gamma'), self.make_entry('b', 'beta')]
+        page_entries = [self.make_entry('a', 'gamma'), self.make_entry('b', 'beta')]
+        self.model._connection.search.side_effect = [iter(keys), iter(page_entries)]
+
+        page = self.model.query().order_by('-last_name').paginate(1, 2)
+
+        self.assertEqual(page.total, 3)
+        self.assertEqual(page.pages, 2)
+        self.assertTrue(page.has_next)
+        self.assertFalse(page.has_previous)
+        self.assertEqual([(obj.username, obj.last_name) for obj in page.items], [('a', 'gamma'), ('b', 'beta')])
+        first_call, second_call = self.model._connection.search.call_args_list
+        self.assertEqual(first_call[1]['retrieve_attributes'], ['sn', 'uid'])
+        self.assertEqual(second_call[1]['search_filter'], '(&(objectClass=person)(|(uid=a)(uid=b)))')
+
+    @mock.patch('esauth.connection.sorted_search', side_effect=esauth.connection.SortUnavailable())
+    def test_paginate_number_clamped(self, sorted_search):
+        self.model._connection.search.return_value = iter([])
+        page = self.model.query().paginate(5, 10)
+        self.assertEqual(page.number, 1)
+        self.assertEqual(page.items, [])
+        self.assertEqual(self.model._connection.search.call_count, 1)
+
+class IdentityMapTestCase(base.UnitTestCase):
+
+    def setUp(self):
+        self.model = type('Model', (orm.Base,), {
+            'one': orm.SingleValueField('raw_one', primary=True),
+            'base_dn': 'dc=test',
+            'all_search_filter': 'objectClass=x',
+            'page_size': 0,
+        })
+        self.model._connection = mock.Mock(spec=ldapom.LDAPConnection)
+        orm.identity_map.begin()
+
+    def tearDown(self):
+        orm.identity_map.end()
+
+    def make_entry(self, dn):
+        entry = mock.Mock(spec=ldapom.LDAPEntry)
+        entry.dn = dn
+        entry._attributes = []
+        return entry
+
+    def test_get_returns_loaded(self):
+        obj = self.model(one='a')
+        orm.identity_map.add(obj)
+        self.assertIs(self.model.get('a'), obj)
+        self.assertIs(self.model.get('raw_one=a, dc=test'), obj)
+        self.assertFalse(self.model._connection.get_entry.called)
+
+    def test_get_registers(self):
+        entry = self.model._connection.get_entry.return_value
+        entry.exists.return_value = True
+        entry.dn = 'raw_one=a,dc=test'
+        attr = mock.Mock()
+        attr.name = 'raw_one'
+        entry._attributes = [attr]
+        entry.raw_one = 'a'
+
+        obj = self.model.get('a')
+        self.assertIs(self.model.get('a'), obj)
+        self.assertEqual(self.model._connection.get_entry.call_count, 1)
+
+    def test_from_entry_returns_loaded(self):
+        obj = self.model(one='a')
+        orm.identity_map.add(obj)
+        entry = self.make_entry('raw_one=a,dc=test')
+        self.assertIs(self.model.from_entry(entry), obj)
+        self.assertFalse(entry.fetch.called)
+
+    def test_other_model_not_returned(self):
+        other = type('Other', (orm.Base,), {'one': orm.Field('raw_one', primary=True), 'base_dn': 'dc=test'})
+        orm.identity_map.add(other(one='a'))
+        entry = self.make_entry('raw_one=a,dc=test')
+        self.assertIsInstance(self.model.from_entry(entry), self.model)
+
+    def test_filter_existing_skips_loaded(self):
+        orm.identity_map.add(self.model(one='a'))
+        ret = self.model.filter_existing(['raw_one=a,dc=test'])
+        self.assertEqual(ret, ['raw_one=a,dc=test'])
+        self.assertFalse(self.model._connection.search.called)
+
+    def test_partial_query_not_registered(self):
+        self.model._connection.search.return_value = [self.make_entry('raw_one=a,dc=test')]
+        list(self.model.query().only('raw_one'))
+        self.assertIsNone(orm.identity_map.get(self.model, 'raw_one=a,dc=test'))
+
+    def test_inactive(self):
+        orm.identity_map.end()
+        orm.identity_map.add(self.model(one='a'))
+        self.assertIsNone(orm.identity_map.get(self.model, 'raw_one=a,dc=test'))
+
+
 # class FieldTestCase(base.UnitTestCase):
 
 #     def get_unit(self, obj_name, **field_kw):
@@ -209,3 +846,109 @@ class BaseTestCase(base.UnitTestCase):
 #         self.entry.raw = 300
 #         with self.assertRaises(ValueError):
 #             obj.attr = 200
+
+
+class EscapeFilterValueTestCase(base.UnitTestCase):
+
+    def test_escape(self):
+        ret = orm.escape_filter_value(u'a*b(c)\\d')
+        self.assertEqual(ret, u'a\\2ab\\28c\\29\\5cd')
+
+    def test_no_special_chars(self):
+        self.assertEqual(orm.escape_filter_value(u'john'), u'john')
+
+
+class FilterExistingTestCase(base.UnitTestCase):
+
+    def setUp(self):
+        self.unit = type('Model', (orm.Base,), {
+            'one': orm.Field('raw_one', primary=True),
+            'base_dn': 'dc=test',
+            'all_search_filter': 'objectClass=x',
+            'page_size': 0,
+        })
+        self.unit._connection = mock.Mock(spec=ldapom.LDAPConnection)
+
+    def make_entry(self, dn):
+        entry = mock.Mock(spec=ldapom.LDAPEntry)
+        entry.dn = dn
+        return entry
+
+    def test_batched(self):
+        self.unit._connection.search.return_value = [self.make_entry('raw_one=a,dc=test')]
+        ret = self.unit.filter_existing(['raw_one=a,dc=test', 'raw_one=b,dc=test', 'raw_one=c,dc=test'], batch_size=2)
+
+        self.assertEqual(ret, ['raw_one=a,dc=test'])
+        self.assertEqual(self.unit._connection.search.call_count, 2)
+        self.unit._connection.search.assert_any_call(
+            search_filter='(&(objectClass=x)(|(raw_one=a)(raw_one=b)))',
+            base='dc=test',
+            scope=ldapom.LDAP_SCOPE_SUBTREE,
+            retrieve_attributes=['1.1'],
+        )
+
+    def test_other_base_skipped(self):
+        ret = self.unit.filter_existing(['raw_one=a,dc=other', 'cn=a,dc=test'])
+        self.assertEqual(ret, [])
+        self.assertFalse(self.unit._connection.search.called)
+
+    def test_scan_threshold(self):
+        self.unit._connection.search.return_value = [self.make_entry('raw_one=b, DC=test')]
+        ret = self.unit.filter_existing(['raw_one=a,dc=test', 'raw_one=b,dc=test'], scan_threshold=1)
+
+        self.assertEqual(ret, ['raw_one=b,dc=test'])
+        self.unit._connection.search.assert_called_once_with(
+            search_filter='(objectClass=x)',
+            base='dc=test',
+            scope=ldapom.LDAP_SCOPE_SUBTREE,
+            retrieve_attributes=['1.1'],
+        )
+
+
+class LazyFieldTestCase(base.UnitTestCase):
+
+    def setUp(self):
+        self.model = type('Model', (orm.Base,), {
+            'one': orm.SingleValueField('raw_one', primary=True),
+            'many': orm.Field('raw_many', default=[], lazy=True),
+            'base_dn': 'dc=test',
+            'all_search_filter': 'objectClass=x',
+            'page_size': 0,
+        })
+        self.model._connection = mock.Mock(spec=ldapom.LDAPConnection)
+
+    def make_entry(self, **values):
+        entry = mock.Mock(spec=ldapom.LDAPEntry)
+        entry.dn = 'raw_one=a,dc=test'
+        entry._attributes = []
+        for name, value in values.items():
+            attr = mock.Mock()
+            attr.name = name
+            entry._attributes.append(attr)
+            setattr(entry, name, value)
+        entry.get_attribute.side_effect = lambda name: next(
+            (attr for attr in entry._attributes if attr.name == name), None
+        )
+        return entry
+
+    def test_not_requested(self):
+        self.assertEqual(self.model._load_attributes, ['raw_one'])
+        self.model._connection.search.return_value = []
+        list(self.model.all())
+        self.assertEqual(self.model._connection.search.call_args[1]['retrieve_attributes'], ['raw_one'])
+
+    def test_fetched_on_access(self):
+        obj = self.model.from_entry(self.make_entry(raw_one={'a'}), fetch=False)
+        self.assertEqual(obj.get_state(), {'objectClass': frozenset(['top']), 'raw_one': frozenset(['a'])})
+        self.assertEqual(obj._get_cache_value()[1]['many'], orm.NOT_LOADED)
+
+        self.model._connection.get_entry.return_value = self.make_entry(raw_many={'x', 'y'})
+        self.assertEqual(obj.many, {'x', 'y'})
+        self.model._connection.get_entry.assert_called_once_with('raw_one=a,dc=test', retrieve_attributes=['raw_many'])
+        self.assertEqual(obj._saved_state['raw_many'], frozenset(['x', 'y']))
+        self.assertEqual(obj.get_changes(), [])
+
+    def test_new_model_not_fetched(self):
+        obj = self.model(one='a', many=['x'])
+        self.assertEqual(obj.many, ['x'])
+        self.assertFalse(self.model._connection.get_entry.called)